@@ -0,0 +1,202 @@
+"""Офлайн-бенчмарк конвейера восстановления на поддельных rac и pyodbc, результат - JSON.
+
+Не нужны ни кластер 1С, ни сервер SQL: rac заменяет benchmarks.fake_rac, соединения - benchmarks.fake_pyodbc.
+Время ответа подделок известно (вызов rac замеряется отдельно), поэтому для async_do_restore отдельно считается
+накладной расход оркестрации.
+
+Запуск (Linux): python -m benchmarks.bench_pipeline --infobases 1000 --output bench.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from benchmarks import fake_pyodbc, fake_rac
+from services.metrics import percentile
+
+SOURCE = 'Srvr="pg-1c-01";Ref="test_base_0";'
+TARGET = 'Srvr="pg-test-01";Ref="test_base_1";'
+
+
+class CountingQueue:
+    def __init__(self):
+        self.messages = 0
+
+    def put_nowait(self, msg):
+        self.messages += 1
+
+
+def get_stats(durations: List[float]) -> Dict[str, float]:
+    """Длительности в миллисекундах."""
+    return {
+        'runs': len(durations),
+        'min': round(min(durations) * 1000, 3),
+        'median': round(statistics.median(durations) * 1000, 3),
+        'p95': round(percentile(durations, 0.95) * 1000, 3),
+        'mean': round(statistics.fmean(durations) * 1000, 3),
+        'max': round(max(durations) * 1000, 3),
+    }
+
+
+def measure(func: Callable[[], object], repeat: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        func()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def count_rac_calls(log_path: Path) -> int:
+    if not log_path.exists():
+        return 0
+    return len(log_path.read_text(encoding='utf-8').splitlines())
+
+
+def bench_rac(args, rac_dir) -> Dict[str, dict]:
+    from services.rac_tools import AsyncRacClient, RacCache, RacClient, async_get_infobase, get_infobase
+
+    lines = fake_rac.format_records(fake_rac.infobase_summary_list(args.infobases)).splitlines(keepends=True)
+    rac_client = RacClient(exe_path=rac_dir)
+    cache = RacCache(ttl=3600)
+    get_infobase(rac_client, TARGET, 'bench', 'bench', cache=cache)
+
+    async def async_lookup():
+        return await async_get_infobase(AsyncRacClient(exe_path=rac_dir), TARGET, 'bench', 'bench', cache=None)
+
+    return {
+        # один вызов поддельного rac: задержка плюс запуск интерпретатора, из этого складывается ожидание rac
+        'rac_call': get_stats(measure(lambda: rac_client.get('cluster list', 'pg-test-01', 1545), args.repeat)),
+        '_process_output': get_stats(measure(lambda: RacClient._process_output(lines), args.repeat * 10)),
+        'get_infobase (no cache)': get_stats(measure(
+            lambda: get_infobase(rac_client, TARGET, 'bench', 'bench', cache=None), args.repeat
+        )),
+        'get_infobase (cache)': get_stats(measure(
+            lambda: get_infobase(rac_client, TARGET, 'bench', 'bench', cache=cache), args.repeat
+        )),
+        'async_get_infobase (no cache)': get_stats(measure(lambda: asyncio.run(async_lookup()), args.repeat)),
+    }
+
+
+def bench_sql(args, server: fake_pyodbc.FakeSqlServer) -> Dict[str, dict]:
+    from services.sql_tools import BackupType, get_backup_path, prepare_sql_query_for_restore
+
+    conn = server.connect()
+    full_paths, _ = get_backup_path(conn, server.database, BackupType.full, server.now)
+    diff_paths, _ = get_backup_path(conn, server.database, BackupType.diff, server.now)
+    return {
+        'get_backup_path': get_stats(measure(
+            lambda: get_backup_path(conn, server.database, BackupType.full, server.now), args.repeat * 10
+        )),
+        'prepare_sql_query_for_restore': get_stats(measure(
+            lambda: prepare_sql_query_for_restore(conn, full_paths, 'test_base_1', diff_paths), args.repeat * 10
+        )),
+    }
+
+
+def bench_restore(args, server: fake_pyodbc.FakeSqlServer, rac_dir, work_dir: Path, rac_log: Path,
+                  rac_call: float) -> dict:
+    """rac_call - медианное время одного вызова поддельного rac, секунд."""
+    from services.rac_tools import rac_cache
+    from services.service import async_do_restore
+    from settings import Settings
+
+    settings = Settings(
+        _env_file=None,
+        ib_username='bench',
+        ib_user_pwd='bench',
+        sql_user='bench',
+        sql_user_pwd='bench',
+        rac_path=rac_dir,
+        backup_catalog_path=str(work_dir / 'backup_catalog.sqlite3'),
+        history_path=str(work_dir / 'restore_history.sqlite3'),
+        # msdb опрашивается при каждом восстановлении, но дозагружаются только новые бекапы
+        backup_catalog_max_age=0,
+    )
+    backup_date = server.now.isoformat(timespec='seconds')
+
+    durations, overheads = [], []
+    for run in range(args.repeat + 1):
+        rac_cache.invalidate()
+        rac_calls, messages = count_rac_calls(rac_log), server.messages
+        started = time.perf_counter()
+        asyncio.run(async_do_restore(CountingQueue(), SOURCE, TARGET, backup_date, settings))
+        duration = time.perf_counter() - started
+        simulated = (count_rac_calls(rac_log) - rac_calls) * rac_call + \
+            (server.messages - messages) * args.message_delay
+        # первый прогон наполняет каталог бекапов и кеш списка файлов
+        if run:
+            durations.append(duration)
+            overheads.append(max(duration - simulated, 0))
+    return {
+        'async_do_restore': get_stats(durations),
+        'async_do_restore (overhead)': get_stats(overheads),
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк конвейера восстановления без 1С и SQL Server')
+    parser.add_argument('--infobases', type=int, default=1000, help='баз в кластере поддельного rac')
+    parser.add_argument('--sessions', type=int, default=10, help='сеансов на базу')
+    parser.add_argument('--rac_latency', type=float, default=0.02, help='задержка ответа rac, секунд')
+    parser.add_argument('--message_delay', type=float, default=0.001,
+                        help='задержка каждого сообщения RESTORE, секунд')
+    parser.add_argument('--history_days', type=int, default=30, help='дней истории бекапов в msdb')
+    parser.add_argument('--repeat', type=int, default=10, help='число повторов')
+    parser.add_argument('--output', help='записать JSON в файл вместо stdout')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    args = get_args()
+    if os.name == 'nt':
+        sys.exit('Поддельный rac запускается только на Linux')
+
+    with tempfile.TemporaryDirectory(prefix='db_restore_bench_') as tmp:
+        work_dir = Path(tmp)
+        rac_log = work_dir / 'rac_calls.log'
+        os.environ.update({
+            'FAKE_RAC_INFOBASES': str(args.infobases),
+            'FAKE_RAC_SESSIONS': str(args.sessions),
+            'FAKE_RAC_LATENCY': str(args.rac_latency),
+            'FAKE_RAC_LOG': str(rac_log),
+        })
+        rac_dir = fake_rac.install(work_dir)
+        server = fake_pyodbc.FakeSqlServer(work_dir / 'backup', history_days=args.history_days,
+                                           message_delay=args.message_delay)
+        fake_pyodbc.install(server)
+
+        results = {}
+        results.update(bench_rac(args, rac_dir))
+        results.update(bench_sql(args, server))
+        results.update(bench_restore(args, server, rac_dir, work_dir, rac_log, results['rac_call']['median'] / 1000))
+
+    report = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {name: value for name, value in vars(args).items() if name != 'output'},
+        'unit': 'ms',
+        'results': results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
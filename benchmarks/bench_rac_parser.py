@@ -0,0 +1,77 @@
+"""Сравнение разбора вывода rac: прежний _process_output и потоковый iter_records.
+
+Запуск: python -m benchmarks.bench_rac_parser --records 10000
+"""
+import argparse
+import timeit
+import tracemalloc
+
+from services.rac_tools import iter_records
+
+
+def legacy_process_output(output, separator=''):
+    # копия RacClient._process_output до перехода на iter_records
+    objects = []
+    is_new_object = True
+    for row in output:
+        if not row and row != separator:
+            continue
+        if (row.startswith(separator) and bool(separator)) or separator == row:
+            is_new_object = True
+            continue
+        if is_new_object:
+            obj = {}
+            objects.append(obj)
+            is_new_object = False
+        key, value = row.replace(' ', '').split(':', maxsplit=1)
+        obj[key] = value
+    if len(objects) == 1:
+        return objects[0]
+    return objects
+
+
+def make_listing(records):
+    rows = []
+    for i in range(records):
+        rows.extend([
+            f'infobase : 3f2b2c10-{i:04x}-11ed-8000-0050569f5c{i % 256:02x}',
+            f'name     : test_base_{i}',
+            f'descr    : "Тестовая база {i}"',
+            '',
+        ])
+    return rows
+
+
+def measure_peak(func, rows):
+    tracemalloc.start()
+    func(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк разбора вывода rac')
+    parser.add_argument('--records', type=int, default=10000, help='число записей в выводе')
+    parser.add_argument('--repeat', type=int, default=5, help='число повторов')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    rows = make_listing(args.records)
+    target = f'test_base_{args.records // 2}'
+
+    cases = {
+        'legacy _process_output': lambda r: legacy_process_output(r),
+        'iter_records (list)': lambda r: list(iter_records(r)),
+        'iter_records (early exit)': lambda r: next(ib for ib in iter_records(r) if ib['name'] == target),
+    }
+    for name, func in cases.items():
+        best = min(timeit.repeat(lambda: func(rows), number=1, repeat=args.repeat))
+        peak = measure_peak(func, rows)
+        print(f'{name:<28} {best * 1000:8.2f} ms  peak {peak / 1024:8.1f} KiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Поддельный сервер SQL для бенчмарков: соединения pyodbc отвечают строками msdb и сообщениями RESTORE.
+
+install() подменяет pyodbc.connect до импорта services.sql_tools. Если pyodbc не загружается (на машине нет
+unixODBC), подставляется модуль с теми же классами ошибок - бенчмаркам настоящий драйвер не нужен.
+"""
+import datetime
+import sys
+import threading
+import time
+import types
+from decimal import Decimal
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from services.backup_catalog import MSDB_BACKUPSETS_QUERY
+from services.file_mapping import DEFAULT_PATHS_QUERY, RECEIVER_FILES_QUERY
+from services.restore_state import LAST_RESTORED_QUERY
+from services.snapshots import SNAPSHOTS_QUERY
+
+MB = 1024 * 1024
+FILELIST_COLUMNS = ('LogicalName', 'PhysicalName', 'Type', 'FileGroupName', 'Size', 'MaxSize', 'FileId')
+
+
+class FakeSqlServer:
+    """История бекапов за history_days дней: полный в полночь, диф каждые 6 часов, журнал каждый час.
+
+    Файлы бекапов создаются пустыми в backup_dir - восстановление проверяет, что они существуют.
+    Каждое сообщение RESTORE отдается через message_delay секунд, как при чтении бекапа сервером.
+    """
+
+    def __init__(self, backup_dir, database='test_base_0', history_days=30, stripes=1, message_delay=0.001,
+                 now: Optional[datetime.datetime] = None, stamp_messages=False):
+        self.backup_dir = Path(backup_dir)
+        self.database = database
+        self.message_delay = message_delay
+        # метка time.monotonic() в начале текста сообщения - по ней считается задержка доставки в браузер
+        self.stamp_messages = stamp_messages
+        self.now = (now or datetime.datetime.now()).replace(minute=0, second=0, microsecond=0)
+        self.rows = self._make_history(history_days, stripes)
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.messages = 0
+
+    def _make_history(self, history_days, stripes) -> List[tuple]:
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        rows = []
+        start = self.now - datetime.timedelta(days=history_days)
+        lsn, full_checkpoint, backup_set_id = 10 ** 15, None, 0
+        for hour in range(history_days * 24 + 1):
+            finish = start + datetime.timedelta(hours=hour)
+            first_lsn, lsn = lsn, lsn + 1000
+            if finish.hour == 0:
+                backup_type, full_checkpoint, size, devices = 'D', lsn - 500, 40960 * MB, stripes
+            elif finish.hour % 6 == 0:
+                backup_type, size, devices = 'I', 2048 * MB, 1
+            else:
+                backup_type, size, devices = 'L', 128 * MB, 1
+            if full_checkpoint is None:
+                continue
+            backup_set_id += 1
+            values = (
+                backup_set_id, self.database, backup_type, finish - datetime.timedelta(minutes=10), finish,
+                size, size // 4,
+                Decimal(first_lsn if backup_type == 'L' else lsn - 900), Decimal(lsn),
+                Decimal(full_checkpoint if backup_type == 'D' else lsn - 500), Decimal(full_checkpoint),
+                Decimal(full_checkpoint) if backup_type == 'I' else None, False, False,
+            )
+            for number in range(1, devices + 1):
+                path = self.backup_dir / f'{self.database}_{backup_type}_{finish:%Y%m%d%H%M}_{number}.bak'
+                path.touch()
+                rows.append((*values, number, str(path)))
+        return rows
+
+    def connect(self, conn_str='', timeout=0, **kwargs) -> 'FakeConnection':
+        return FakeConnection(self)
+
+    def count(self, queries=0, messages=0) -> None:
+        with self._lock:
+            self.queries += queries
+            self.messages += messages
+
+    def backupsets(self, database_name, last_id) -> List[tuple]:
+        return [row for row in self.rows if row[1] == database_name and row[0] > last_id]
+
+    def backup_path(self, database_name, backup_type, backup_date) -> List[Tuple[str, datetime.datetime]]:
+        candidates = [row for row in self.rows
+                      if row[1] == database_name and row[2] == backup_type and row[4] <= backup_date]
+        if not candidates:
+            return []
+        backup_set_id = candidates[-1][0]
+        return [(row[15], row[4]) for row in candidates if row[0] == backup_set_id]
+
+    @staticmethod
+    def file_list(database_name) -> List[tuple]:
+        return [
+            (database_name, f'D:\\Data\\{database_name}.mdf', 'D', 'PRIMARY', 40960 * MB, 0, 1),
+            (f'{database_name}_log', f'E:\\Log\\{database_name}_log.ldf', 'L', None, 8192 * MB, 0, 2),
+        ]
+
+    @staticmethod
+    def restore_messages(script) -> List[str]:
+        statement = 'RESTORE LOG' if 'RESTORE LOG' in script else 'RESTORE DATABASE'
+        messages = [f'{percent} percent processed.' for percent in range(5, 101, 5)]
+        messages.append("Processed 5242880 pages for database 'test', file 'test' on file 1.")
+        messages.append(f'{statement} successfully processed 5242882 pages in 61.234 seconds (668.910 MB/sec).')
+        return messages
+
+    def format_message(self, message) -> str:
+        stamp = f'@{time.monotonic():.6f} ' if self.stamp_messages else ''
+        return f'[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]{stamp}{message}'
+
+
+class FakeCursor:
+    def __init__(self, server: FakeSqlServer):
+        self.server = server
+        self.description = None
+        self.messages: List[Tuple[str, str]] = []
+        self._rows: List[tuple] = []
+        self._pending: List[str] = []
+
+    def execute(self, query, *params):
+        self.server.count(queries=1)
+        self.description, self._rows, self._pending, self.messages = None, [], [], []
+        if query == MSDB_BACKUPSETS_QUERY:
+            self._rows = self.server.backupsets(*params)
+        elif 'TOP (1) media_set_id' in query:
+            self._rows = self.server.backup_path(*params)
+        elif query.startswith('RESTORE FILELISTONLY'):
+            self.description = [(column,) for column in FILELIST_COLUMNS]
+            self._rows = self.server.file_list(self.server.database)
+        elif query == RECEIVER_FILES_QUERY:
+            self._rows = [(0, f'D:\\Data\\{params[0]}.mdf'), (1, f'E:\\Log\\{params[0]}_log.ldf')]
+        elif query == DEFAULT_PATHS_QUERY:
+            self._rows = [('D:\\Data\\', 'E:\\Log\\')]
+        elif query == 'SELECT 1':
+            self._rows = [(1,)]
+        elif 'dm_os_sys_info' in query:
+            self._rows = [(16, 64 * 1024 * 1024)]
+        elif query.startswith(SNAPSHOTS_QUERY) or query == LAST_RESTORED_QUERY:
+            self._rows = []
+        elif 'RESTORE DATABASE' in query or 'RESTORE LOG' in query:
+            self._pending = self.server.restore_messages(query)
+        return self
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def nextset(self) -> bool:
+        if not self._pending:
+            return False
+        time.sleep(self.server.message_delay)
+        self.server.count(messages=1)
+        self.messages = [('[01000] (3211)', self.server.format_message(self._pending.pop(0)))]
+        return True
+
+    def cancel(self):
+        self._pending = []
+
+
+class FakeConnection:
+    def __init__(self, server: FakeSqlServer):
+        self.server = server
+        self.autocommit = False
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self.server)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_pyodbc_module() -> types.ModuleType:
+    module = types.ModuleType('pyodbc')
+    module.Error = type('Error', (Exception,), {})
+    module.InterfaceError = type('InterfaceError', (module.Error,), {})
+    module.DatabaseError = type('DatabaseError', (module.Error,), {})
+    for name in ('OperationalError', 'ProgrammingError', 'IntegrityError', 'DataError', 'NotSupportedError'):
+        setattr(module, name, type(name, (module.DatabaseError,), {}))
+    return module
+
+
+def install(server: FakeSqlServer):
+    """pyodbc.connect отдает соединения с server. Вызывать до импорта services.sql_tools и services.service."""
+    try:
+        import pyodbc
+    except ImportError:
+        pyodbc = sys.modules['pyodbc'] = make_pyodbc_module()
+    pyodbc.connect = server.connect
+    return pyodbc
@@ -0,0 +1,192 @@
+"""Заменитель rac для бенчмарков: отвечает как кластер 1С с заданным числом баз и сеансов.
+
+Вывод в cp866 с переводами строк системы (os.linesep), как у настоящего rac: \\r\\n на Windows, \\n на Linux.
+Размер и задержка задаются переменными окружения: FAKE_RAC_INFOBASES - число баз, FAKE_RAC_SESSIONS - сеансов
+на базу, FAKE_RAC_LATENCY - задержка ответа, секунд, FAKE_RAC_DB_SERVER - сервер SQL баз, FAKE_RAC_LOG - файл,
+в который дописывается каждый вызов, FAKE_RAC_NEWLINE - crlf или lf вместо перевода строк системы.
+"""
+import os
+import stat
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+CLUSTER_ID = 'b2e9c8a4-5d1f-4c3e-9a7b-0e6f1d2c3b4a'
+
+
+def get_infobase_id(index: int) -> str:
+    return f'{index:08x}-3f2b-11ed-8000-0050569f5c01'
+
+
+def get_infobase_index(infobase_id: str) -> int:
+    return int(infobase_id.split('-', 1)[0], 16)
+
+
+def format_records(records: List[Dict[str, str]]) -> str:
+    lines = []
+    for record in records:
+        width = max(len(key) for key in record)
+        lines.extend(f'{key:<{width}} : {value}' for key, value in record.items())
+        lines.append('')
+    newline = get_newline()
+    return newline.join(lines) + newline
+
+
+def get_newline() -> str:
+    return {'crlf': '\r\n', 'lf': '\n'}.get(os.environ.get('FAKE_RAC_NEWLINE', ''), os.linesep)
+
+
+def cluster_list() -> List[Dict[str, str]]:
+    return [{
+        'cluster': CLUSTER_ID,
+        'host': 'pg-test-01',
+        'port': '1541',
+        'name': '"Локальный кластер"',
+        'expiration-timeout': '60',
+        'lifetime-limit': '0',
+        'max-memory-size': '0',
+        'security-level': '0',
+        'session-fault-tolerance-level': '0',
+        'load-balancing-mode': 'performance',
+        'errors-count-threshold': '0',
+        'kill-problem-processes': '1',
+    }]
+
+
+def infobase_summary_list(infobases: int) -> List[Dict[str, str]]:
+    return [
+        {'infobase': get_infobase_id(i), 'name': f'test_base_{i}', 'descr': f'"Тестовая база №{i}"'}
+        for i in range(infobases)
+    ]
+
+
+def infobase_info(index: int, db_server: str) -> List[Dict[str, str]]:
+    return [{
+        'infobase': get_infobase_id(index),
+        'name': f'test_base_{index}',
+        'dbms': 'MSSQLServer',
+        'db-server': db_server,
+        'db-name': f'test_base_{index}',
+        'db-user': 'sa',
+        'security-level': '0',
+        'license-distribution': 'allow',
+        'scheduled-jobs-deny': 'off',
+        'sessions-deny': 'off',
+        'denied-from': '',
+        'denied-message': '',
+        'denied-parameter': '',
+        'denied-to': '',
+        'permission-code': '',
+        'external-session-manager-connection-string': '',
+        'external-session-manager-required': 'no',
+        'security-profile-name': '',
+        'safe-mode-security-profile-name': '',
+        'reserve-working-processes': 'no',
+        'descr': f'"Тестовая база №{index}"',
+    }]
+
+
+def session_list(infobase_ids: List[str], sessions: int) -> List[Dict[str, str]]:
+    return [
+        {
+            'session': f'{n:08x}-{get_infobase_index(infobase_id):04x}-4a1e-9c2b-6f0d3e5a7b81',
+            'session-id': str(n + 1),
+            'infobase': infobase_id,
+            'connection': f'{n:08x}-0000-4000-8000-00000000c0de',
+            'process': 'a1b2c3d4-0000-4000-8000-000000000001',
+            'user-name': f'Пользователь {n}',
+            'host': f'ws-{n:03d}',
+            'app-id': 'BackgroundJob' if n % 5 == 0 else '1CV8C',
+            'locale': 'ru_RU',
+            'started-at': '2023-03-01T08:00:00',
+            'last-active-at': '2023-03-01T09:30:00',
+            'hibernate': 'no',
+        }
+        for infobase_id in infobase_ids for n in range(sessions)
+    ]
+
+
+def connection_list(infobase_ids: List[str], sessions: int) -> List[Dict[str, str]]:
+    return [
+        {
+            'connection': f'{n:08x}-0000-4000-8000-00000000c0de',
+            'conn-id': str(n + 1),
+            'host': f'ws-{n:03d}',
+            'process': 'a1b2c3d4-0000-4000-8000-000000000001',
+            'infobase': infobase_id,
+            'application': '"1CV8C"',
+            'connected-at': '2023-03-01T08:00:00',
+            'session-number': str(n + 1),
+            'blocked-by-ls': '0',
+        }
+        for infobase_id in infobase_ids for n in range(sessions)
+    ]
+
+
+def get_options(args: List[str]) -> Dict[str, str]:
+    options = {}
+    for arg in args:
+        if arg.startswith('--'):
+            key, _, value = arg[2:].partition('=')
+            options[key] = value
+    return options
+
+
+def respond(args: List[str]) -> List[Dict[str, str]]:
+    infobases = int(os.environ.get('FAKE_RAC_INFOBASES', 100))
+    sessions = int(os.environ.get('FAKE_RAC_SESSIONS', 10))
+    db_server = os.environ.get('FAKE_RAC_DB_SERVER', 'sql-test-01')
+    command = ' '.join(arg for arg in args[:-1] if not arg.startswith('--'))
+    options = get_options(args)
+    infobase_ids = [options['infobase']] if options.get('infobase') else \
+        [get_infobase_id(i) for i in range(infobases)]
+
+    if command == 'cluster list':
+        return cluster_list()
+    if command == 'infobase summary list':
+        return infobase_summary_list(infobases)
+    if command == 'infobase info':
+        return infobase_info(get_infobase_index(options['infobase']), db_server)
+    if command == 'session list':
+        return session_list(infobase_ids, sessions)
+    if command == 'connection list':
+        return connection_list(infobase_ids, sessions)
+    if command in ('session terminate', 'infobase update'):
+        return []
+    raise ValueError(f'Неизвестная команда rac: {command}')
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if os.environ.get('FAKE_RAC_LOG'):
+        with open(os.environ['FAKE_RAC_LOG'], 'a', encoding='utf-8') as f:
+            f.write(' '.join(args) + '\n')
+    time.sleep(float(os.environ.get('FAKE_RAC_LATENCY', 0.05)))
+    try:
+        output = format_records(respond(args))
+    except (ValueError, KeyError) as e:
+        sys.stderr.buffer.write(f'Ошибка: {e}{get_newline()}'.encode('cp866'))
+        sys.exit(1)
+    sys.stdout.buffer.write(output.encode('cp866'))
+
+
+def install(directory) -> str:
+    """Создает в directory исполняемый rac, который вызывает этот модуль; directory подходит для rac_path."""
+    path = Path(directory) / 'rac'
+    path.write_text(
+        f'#!{sys.executable}\n'
+        f'import sys\n'
+        f'sys.path.insert(0, {str(BASE_DIR)!r})\n'
+        f'from benchmarks.fake_rac import main\n'
+        f'main()\n',
+        encoding='utf-8'
+    )
+    path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return str(directory)
+
+
+if __name__ == '__main__':
+    main()
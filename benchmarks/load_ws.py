@@ -0,0 +1,261 @@
+"""Нагрузочный тест server.py: N браузеров по websocket запускают восстановления на поддельных rac и pyodbc.
+
+Сервер работает в отдельном потоке со своим циклом событий, как отдельный процесс server.py, клиенты - в основном
+потоке. Измеряются задержка доставки сообщений RESTORE от сервера SQL до браузера (p50/p95/p99), отставание
+цикла событий сервера, рост памяти процесса и сообщений в секунду. Результат - JSON.
+
+Запуск (Linux): python -m benchmarks.load_ws --clients 50 --restores 2 --rate 20 --output load.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from benchmarks import fake_pyodbc, fake_rac
+from services.metrics import percentile
+
+SOURCE = 'Srvr="pg-1c-01";Ref="test_base_0";'
+STAMP_RE = re.compile(r'@(\d+\.\d+) ')
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.received = 0
+        self.frames = 0
+        self.statuses: Dict[str, int] = {}
+        self.job_durations: List[float] = []
+
+    def add_status(self, status) -> None:
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+def get_rss() -> int:
+    """Резидентная память процесса, байт."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_percentiles(values: List[float], scale=1000) -> Dict[str, float]:
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 0.5) * scale, 3),
+        'p95': round(percentile(values, 0.95) * scale, 3),
+        'p99': round(percentile(values, 0.99) * scale, 3),
+        'max': round(max(values) * scale, 3),
+    }
+
+
+class ServerThread(threading.Thread):
+    """server.create_app в своем цикле событий; lags - отставание этого цикла от расписания, секунд."""
+
+    def __init__(self, settings, lag_interval: float):
+        super().__init__(name='load-server', daemon=True)
+        self.settings = settings
+        self.lag_interval = lag_interval
+        self.lags: List[float] = []
+        self.port: Optional[int] = None
+        self.ready = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+
+    async def _monitor_lag(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            self.lags.append(max(time.monotonic() - started - self.lag_interval, 0))
+
+    async def _serve(self) -> None:
+        from aiohttp import web
+        from server import create_app
+
+        self._loop, self._stopped = asyncio.get_running_loop(), asyncio.Event()
+        runner = web.AppRunner(create_app(self.settings))
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        monitor = asyncio.create_task(self._monitor_lag())
+        self.ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            monitor.cancel()
+            await runner.cleanup()
+
+    def run(self) -> None:
+        asyncio.run(self._serve())
+
+    def stop(self) -> None:
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        self.join()
+
+
+async def run_client(session: aiohttp.ClientSession, url, index: int, args, backup_date, stats: LoadStats) -> None:
+    target = f'Srvr="pg-test-01";Ref="test_base_{index + 1}";'
+    # итоговая строка fan-out: "<приемник>: done за 1 с, из них в очереди 0 с"
+    summary_re = re.compile(rf'^{re.escape(target)}: (\w+) за')
+    async with session.ws_connect(url, max_msg_size=0) as ws:
+        for _ in range(args.restores):
+            started = time.monotonic()
+            await ws.send_str(json.dumps({'type': 'restore_db', 'source': SOURCE, 'target': target,
+                                          'backup_date': backup_date}))
+            status = None
+            while status is None:
+                try:
+                    msg = await ws.receive(timeout=args.job_timeout)
+                except asyncio.TimeoutError:
+                    status = 'timeout'
+                    break
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    status = 'closed'
+                    break
+                received_at = time.monotonic()
+                stats.frames += 1
+                frame = json.loads(msg.data)
+                for message in frame if isinstance(frame, list) else [frame]:
+                    stats.received += 1
+                    text = message.get('text') or ''
+                    match = STAMP_RE.search(text)
+                    if match:
+                        stats.latencies.append(received_at - float(match.group(1)))
+                    match = summary_re.search(text)
+                    if match:
+                        status = match.group(1)
+            stats.add_status(status)
+            stats.job_durations.append(time.monotonic() - started)
+
+
+async def run_load(args, port, backup_date, stats: LoadStats, rss: List[int]) -> float:
+    url = f'http://127.0.0.1:{port}/ws'
+
+    async def sample_memory():
+        while True:
+            rss.append(get_rss())
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.create_task(sample_memory())
+    started = time.monotonic()
+    try:
+        async with aiohttp.ClientSession() as session:
+            clients = []
+            for index in range(args.clients):
+                clients.append(asyncio.create_task(run_client(session, url, index, args, backup_date, stats)))
+                # браузеры подключаются не одновременно
+                await asyncio.sleep(args.ramp_up / max(args.clients, 1))
+            await asyncio.gather(*clients)
+    finally:
+        sampler.cancel()
+        rss.append(get_rss())
+    return time.monotonic() - started
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест websocket server.py на поддельных rac и pyodbc')
+    parser.add_argument('--clients', type=int, default=20, help='одновременных браузеров')
+    parser.add_argument('--restores', type=int, default=1, help='восстановлений подряд на каждого клиента')
+    parser.add_argument('--rate', type=float, default=20, help='сообщений RESTORE в секунду на одно восстановление')
+    parser.add_argument('--workers', type=int, help='job_workers сервера, по умолчанию - по числу клиентов')
+    parser.add_argument('--batch_interval', type=float, default=0.1, help='ws_batch_interval сервера, секунд')
+    parser.add_argument('--rac_latency', type=float, default=0.02, help='задержка ответа rac, секунд')
+    parser.add_argument('--ramp_up', type=float, default=1, help='за сколько секунд подключаются все клиенты')
+    parser.add_argument('--lag_interval', type=float, default=0.01, help='период замера отставания цикла, секунд')
+    parser.add_argument('--job_timeout', type=float, default=120, help='сколько ждать сообщений задания, секунд')
+    parser.add_argument('--output', help='записать JSON в файл вместо stdout')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    args = get_args()
+    if os.name == 'nt':
+        sys.exit('Поддельный rac запускается только на Linux')
+
+    with tempfile.TemporaryDirectory(prefix='db_restore_load_') as tmp:
+        work_dir = Path(tmp)
+        os.environ.update({
+            'FAKE_RAC_INFOBASES': str(args.clients + 1),
+            'FAKE_RAC_LATENCY': str(args.rac_latency),
+        })
+        rac_dir = fake_rac.install(work_dir)
+        server = fake_pyodbc.FakeSqlServer(work_dir / 'backup', message_delay=1 / args.rate, stamp_messages=True)
+        fake_pyodbc.install(server)
+
+        from settings import Settings
+
+        workers = args.workers or args.clients
+        settings = Settings(
+            _env_file=None,
+            ib_username='load',
+            ib_user_pwd='load',
+            sql_user='load',
+            sql_user_pwd='load',
+            rac_path=rac_dir,
+            backup_catalog_path=str(work_dir / 'backup_catalog.sqlite3'),
+            history_path=str(work_dir / 'restore_history.sqlite3'),
+            job_store_path=str(work_dir / 'jobs.sqlite3'),
+            job_workers=workers,
+            ws_batch_interval=args.batch_interval,
+            # все приемники на одном поддельном сервере SQL, ограничения на сервер и папку сняты
+            restore_max_per_server=workers,
+            restore_max_per_share=workers,
+            sql_pool_max_size=workers + 2,
+        )
+        server_thread = ServerThread(settings, args.lag_interval)
+        server_thread.start()
+        if not server_thread.ready.wait(30):
+            sys.exit('Сервер не запустился')
+
+        stats, rss = LoadStats(), [get_rss()]
+        try:
+            duration = asyncio.run(run_load(args, server_thread.port, server.now.isoformat(timespec='seconds'),
+                                            stats, rss))
+        finally:
+            server_thread.stop()
+
+    report = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {name: value for name, value in vars(args).items() if name != 'output'},
+        'duration': round(duration, 3),
+        'jobs': stats.statuses,
+        'job_duration_ms': get_percentiles(stats.job_durations),
+        'messages': stats.received,
+        'frames': stats.frames,
+        'messages_per_sec': round(stats.received / duration, 1) if duration else None,
+        'restore_messages_sent': server.messages,
+        # прогресс, не успевший уйти в браузер, заменяется более новым - доставлено может быть меньше отправленного
+        'restore_messages_delivered': len(stats.latencies),
+        'latency_ms': get_percentiles(stats.latencies),
+        'loop_lag_ms': get_percentiles(server_thread.lags),
+        'memory_mb': {
+            'start': round(rss[0] / 1024 / 1024, 1),
+            'end': round(rss[-1] / 1024 / 1024, 1),
+            'peak': round(max(rss) / 1024 / 1024, 1),
+            'growth': round((rss[-1] - rss[0]) / 1024 / 1024, 1),
+        },
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
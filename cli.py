@@ -1,58 +1,168 @@
 import argparse
+import asyncio
 import datetime
+import json
 import logging
 import os
+import sys
+import time
+from pathlib import Path
+from typing import List
 
 import pyodbc
 
-from services.rac_tools import get_infobase, RacClient
 from services.exceptions import BDInvalidName, BackupFilesError
-from services.sql_tools import SQLServer, get_backup_path, restore_db, get_connection, BackupType
-from settings import settings
+from services.metrics import format_report, get_restore_history
+from services.progress import describe_message
+from services.rac_tools import rac_cache
+from services.restore_plan import PlanJobResult, get_summary, load_plan
+from services.restore_state import RecoveryMode
+from services.scheduler import restore_scheduler
+from services.service import async_do_fan_out, async_do_plan, async_do_reset, async_list_snapshots
+from services.sql_tools import sql_pools
+from settings import Settings
+
+BASE_DIR = Path(__file__).resolve().parent
 
 logger = logging.getLogger('db_restore')
 
 
-def get_args():
+class LoggingQueue:
+    """Вместо отправки в браузер пишет сообщения восстановления в лог."""
+
+    @staticmethod
+    def put_nowait(msg):
+        logger.info(describe_message(msg))
+
+
+COMMANDS = ('restore', 'plan', 'reset', 'snapshots', 'report')
+
+
+def add_flag(parser, name, help):
+    """Пара --name/--no_name; без них значение берется из настроек."""
+    parser.add_argument(f'--{name}', dest=name, action='store_true', default=None, help=help)
+    parser.add_argument(f'--no_{name}', dest=name, action='store_false', default=None, help=f'отменить --{name}')
+
+
+def get_args(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # старый вызов без подкоманды - восстановление
+    if argv and argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        argv.insert(0, 'restore')
+
     parser = argparse.ArgumentParser(description='Скрипт для перезаливки тестовой базы')
-    parser.add_argument('source_db', help='имя базы источника в SQL')
-    parser.add_argument('receiver_db', help='имя базы приемника в SQL')
-    parser.add_argument('--source_server', default='pg-1c-01', help='имя источника сервера SQL')
-    parser.add_argument('--receiver_server', default='pg-test-01', help='имя приемника сервера SQL')
     parser.add_argument('-v', '--verbose', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], default='INFO',
                         help='logging level')
-    args = parser.parse_args()
+    commands = parser.add_subparsers(dest='command', required=True)
+    # -v можно указать и после подкоманды
+    verbose = argparse.ArgumentParser(add_help=False)
+    verbose.add_argument('-v', '--verbose', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                         default=argparse.SUPPRESS, help='logging level')
+
+    restore = commands.add_parser('restore', parents=[verbose], help='восстановить базы (по умолчанию)')
+    restore.add_argument('source_db', help='строка подключения к базе источнику, Srvr="pg-1c-01";Ref="image";')
+    restore.add_argument('receiver_db', nargs='+',
+                         help='строки подключения к базам приемникам, Srvr="pg-test-01";Ref="test_image";')
+    restore.add_argument('--date', default=datetime.datetime.now().isoformat(timespec='seconds'),
+                         help='на какой момент восстановить базу, по умолчанию - текущий')
+    restore.add_argument('--max_per_server', type=int, help='одновременных восстановлений на один сервер приемник')
+    restore.add_argument('--max_per_share', type=int, help='одновременных восстановлений из одной папки бекапов')
+    restore.add_argument('--tuning', choices=['default', 'auto', 'manual'],
+                         help='BUFFERCOUNT/MAXTRANSFERSIZE: по умолчанию SQL Server, подбор или только заданные явно')
+    restore.add_argument('--buffer_count', type=int, help='BUFFERCOUNT для RESTORE')
+    restore.add_argument('--max_transfer_size', type=int, help='MAXTRANSFERSIZE для RESTORE, байт')
+    restore.add_argument('--block_size', type=int, help='BLOCKSIZE для RESTORE, байт')
+    add_flag(restore, 'snapshot', 'создать снимок базы после восстановления для быстрого сброса')
+    add_flag(restore, 'logs', 'применить бекапы журнала до момента --date (STOPAT)')
+    restore.add_argument('--mode', choices=RecoveryMode.all,
+                         help='norecovery/standby оставляют базу "теплой": следующие обновления '
+                              'накатывают только новые бекапы журнала')
+    add_flag(restore, 'skip_if_current', 'пропустить базы, уже восстановленные из выбранного бекапа')
+    add_flag(restore, 'optimize', 'после восстановления: SIMPLE, сжатие журнала, статистика (настройки post_restore_*)')
+    add_flag(restore, 'rebuild_indexes', 'перестроить фрагментированные индексы при --optimize')
+    restore.add_argument('--index_budget', type=int, help='сколько секунд можно перестраивать индексы')
+    add_flag(restore, 'terminate_sessions',
+             'запретить начало сеансов 1С базы приемника и завершить текущие на время восстановления')
+
+    plan = commands.add_parser('plan', parents=[verbose],
+                               help='восстановить базы по плану из файла JSON/TOML, итог - JSON в stdout')
+    plan.add_argument('plan_path', help='файл плана: jobs = [{source, target или targets, backup_date}]')
+    plan.add_argument('--max_workers', type=int, help='одновременных восстановлений во всем плане')
+    plan.add_argument('--max_per_server', type=int, help='одновременных восстановлений на один сервер приемник')
+    plan.add_argument('--max_per_share', type=int, help='одновременных восстановлений из одной папки бекапов')
+    plan.add_argument('--summary', help='записать итог в файл вместо stdout')
+
+    reset = commands.add_parser('reset', parents=[verbose], help='откатить базы к снимку после восстановления')
+    reset.add_argument('receiver_db', nargs='+', help='строки подключения к базам приемникам')
+    add_flag(reset, 'terminate_sessions', 'запретить начало сеансов 1С и завершить текущие на время отката')
+
+    snapshots = commands.add_parser('snapshots', parents=[verbose], help='снимки баз приемников и их возраст')
+    snapshots.add_argument('receiver_db', nargs='+', help='строки подключения к базам приемникам')
+
+    report = commands.add_parser('report', parents=[verbose], help='p50/p95 длительности фаз по парам серверов')
+    report.add_argument('--days', type=int, default=30, help='за сколько последних дней, по умолчанию 30')
+
+    args = parser.parse_args(argv)
     return args
 
 
-def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    args = get_args()
-
-    logger.setLevel(args.verbose)
-    logging.getLogger('rac_tools').setLevel(args.verbose)
-    rac_client = RacClient(exe_path=settings.rac_path)
-
-    try:
-        logger.debug(args.source_db)
-        source_infobase = get_infobase(rac_client, args.source_db, settings.ib_username, settings.ib_user_pwd)
-    except (ChildProcessError, BDInvalidName, FileNotFoundError) as e:
-        logger.error(e)
-        return
+def report(args, settings):
+    since = datetime.datetime.now() - datetime.timedelta(days=args.days)
+    print(format_report(get_restore_history(settings.history_path).runs(since=since)))
+
+
+def reset(args, settings):
+    if args.terminate_sessions is not None:
+        settings = settings.copy(update={'terminate_sessions': args.terminate_sessions})
+    restore_scheduler.configure(settings.restore_max_per_server, settings.restore_max_per_share,
+                                settings.restore_max_bytes_per_server())
+    results = asyncio.run(async_do_reset(LoggingQueue(), args.receiver_db, settings))
+    if any(result.status == 'error' for result in results):
+        logger.error('Не все базы сброшены')
+
+
+def snapshots(args, settings):
+    for receiver_db in args.receiver_db:
+        try:
+            target_snapshots = asyncio.run(async_list_snapshots(receiver_db, settings))
+        except (ChildProcessError, BDInvalidName, ValueError, pyodbc.Error) as e:
+            logger.error(f'{receiver_db}: {e}')
+            continue
+        print(receiver_db)
+        for snapshot in target_snapshots:
+            print(f'  {snapshot.name}  {snapshot.create_date:%d.%m.%Y %H:%M}  возраст {snapshot.age()}')
+        if not target_snapshots:
+            print('  нет снимков')
+
+
+def restore(args, settings):
+    settings = settings.copy(update={
+        name: value for name, value in {
+            'restore_tuning': args.tuning,
+            'restore_buffer_count': args.buffer_count,
+            'restore_max_transfer_size': args.max_transfer_size,
+            'restore_block_size': args.block_size,
+            'snapshot_after_restore': args.snapshot,
+            'skip_if_current': args.skip_if_current,
+            'restore_logs': args.logs,
+            'restore_mode': args.mode,
+            'terminate_sessions': args.terminate_sessions,
+            'post_restore': args.optimize,
+            'post_restore_rebuild_indexes': args.rebuild_indexes,
+            'post_restore_index_budget': args.index_budget,
+        }.items() if value is not None
+    })
+    restore_scheduler.configure(
+        args.max_per_server or settings.restore_max_per_server,
+        args.max_per_share or settings.restore_max_per_share,
+        settings.restore_max_bytes_per_server()
+    )
 
     try:
-        receiver_infobase = get_infobase(rac_client, args.receiver_db, settings.ib_username, settings.ib_user_pwd)
-    except (ChildProcessError, BDInvalidName, FileNotFoundError) as e:
+        results = asyncio.run(async_do_fan_out(LoggingQueue(), args.source_db, args.receiver_db, args.date, settings))
+    except (ChildProcessError, BDInvalidName, FileNotFoundError, ValueError) as e:
         logger.error(e)
         return
-
-    try:
-        with get_connection(SQLServer(server=source_infobase.db_server)) as source_conn:
-            full_backup_path, full_backup_date = get_backup_path(source_conn, source_infobase.db_name, BackupType.full,
-                                                                 datetime.datetime.now())
-            diff_backup_path, _ = get_backup_path(source_conn, source_infobase.db_name, BackupType.diff,
-                                                  full_backup_date)
     except pyodbc.OperationalError:
         logger.error('Сервер источник не найден или недоступен')
         return
@@ -60,25 +170,57 @@ def main():
         logger.error('Не удалось найти пути файлов бекапов')
         return
 
-    if not os.path.exists(full_backup_path):
-        logger.error(f'File does not exist {full_backup_path}')
+    logger.debug(f'sql pools: {sql_pools.stats()}')
+    if any(result.status == 'error' for result in results):
+        logger.error('Не все базы восстановлены')
         return
+    logger.info('DONE!')
 
-    if not os.path.exists(diff_backup_path):
-        logger.debug(f'File does not exist {diff_backup_path}')
-        diff_backup_path = None
 
+def plan(args, settings):
     try:
-        with get_connection(SQLServer(server=receiver_infobase.db_server)) as receiver_conn:
-            restore_db(receiver_conn, receiver_infobase.db_name, full_backup_path, diff_backup_path)
-    except pyodbc.OperationalError:
-        logger.error('Сервер приемник не найден или недоступен')
-        return
-    except pyodbc.ProgrammingError:
-        logger.error('БД приемник недоступна или не найдена')
-        return
+        restore_plan = load_plan(args.plan_path)
+    except (OSError, ValueError) as e:
+        logger.error(f'Не удалось прочитать план {args.plan_path}: {e}')
+        sys.exit(2)
+    if args.max_workers:
+        restore_plan.max_workers = args.max_workers
+    restore_scheduler.configure(
+        args.max_per_server or restore_plan.max_per_server or settings.restore_max_per_server,
+        args.max_per_share or restore_plan.max_per_share or settings.restore_max_per_share,
+        settings.restore_max_bytes_per_server()
+    )
+
+    started = time.monotonic()
+    results: List[PlanJobResult] = []
+    try:
+        asyncio.run(async_do_plan(LoggingQueue(), restore_plan, settings, results=results))
+    finally:
+        # итог выводится и при прерванном плане - с заданиями, которые успели завершиться
+        summary = get_summary(results, time.monotonic() - started)
+        logger.debug(f'sql pools: {sql_pools.stats()}')
 
-    logger.info('DONE!')
+        output = json.dumps(summary, ensure_ascii=False, indent=2)
+        if args.summary:
+            with open(args.summary, 'w', encoding='utf-8') as f:
+                f.write(output)
+        else:
+            print(output)
+    sys.exit(summary['exit_code'])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    args = get_args()
+
+    logger.setLevel(args.verbose)
+    logging.getLogger('rac_tools').setLevel(args.verbose)
+    settings = Settings(_env_file=os.path.join(BASE_DIR, '.env'))
+    rac_cache.ttl = settings.rac_cache_ttl
+    sql_pools.configure(**settings.sql_pool_options())
+    commands = {'restore': restore, 'plan': plan, 'reset': reset, 'snapshots': snapshots, 'report': report}
+    commands[args.command](args, settings)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,35 @@
+import asyncio
+import functools
+import gzip
+import hashlib
 import json
 import logging
 import os.path
-from asyncio import Queue
+import weakref
 from pathlib import Path
+from typing import Optional
 
 import aiohttp
 import pyodbc
 from aiohttp import web
-from anyio import create_task_group
+from anyio import to_thread
 
 from services.exceptions import BDInvalidName, BackupFilesError
-from services.service import async_do_restore
+from services.broadcast import send_batches
+from services.jobs import JobManager, JobStore
+from services.metrics import get_restore_history, render_prometheus
+from services.progress import to_message
+from services.rac_tools import rac_cache
+from services.restore_state import RecoveryMode
+from services.scheduler import restore_scheduler
+from services.service import (
+    async_estimate_restore,
+    async_get_restore_points,
+    async_list_snapshots,
+    async_run_job,
+    get_rac_client
+)
+from services.sql_tools import sql_pools
 from settings import Settings
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -18,97 +37,280 @@ BASE_DIR = Path(__file__).resolve().parent
 logger = logging.getLogger(__name__)
 
 
+class IndexPage:
+    """index.html, прочитанный и сжатый один раз при старте сервера."""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=9)
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+    @classmethod
+    def load(cls, path) -> 'IndexPage':
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def response(self, request) -> web.Response:
+        # no-cache: браузер каждый раз сверяет ETag, после обновления сервера получит новую страницу
+        headers = {'ETag': self.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if self.etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        headers['Content-Type'] = 'text/html; charset=utf-8'
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            return web.Response(body=self.gzip_body, headers={**headers, 'Content-Encoding': 'gzip'})
+        return web.Response(body=self.body, headers=headers)
+
+
 async def handle(request):
-    index_path = os.path.join(BASE_DIR, 'index.html')
-    with open(index_path, 'r') as f:
-        file = f.read()
+    return request.app['index'].response(request)
+
+
+async def restore_points(request):
+    try:
+        backup_sets = await async_get_restore_points(request.query['source'], request.app['settings'],
+                                                     rac_client=request.app['rac_client'])
+    except (ChildProcessError, BDInvalidName, FileNotFoundError, ValueError, KeyError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except pyodbc.OperationalError:
+        raise web.HTTPServiceUnavailable(text='Сервер не найден или недоступен')
+
+    return web.json_response([
+        {
+            'type': backup_set.type,
+            'backup_finish_date': backup_set.backup_finish_date.isoformat(),
+            'backup_size': backup_set.backup_size,
+        }
+        for backup_set in backup_sets
+    ])
+
+
+async def snapshots(request):
+    try:
+        target_snapshots = await async_list_snapshots(request.query['target'], request.app['settings'],
+                                                      rac_client=request.app['rac_client'])
+    except (ChildProcessError, BDInvalidName, ValueError, KeyError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except pyodbc.OperationalError:
+        raise web.HTTPServiceUnavailable(text='Сервер не найден или недоступен')
+
+    return web.json_response([
+        {
+            'name': snapshot.name,
+            'create_date': snapshot.create_date.isoformat(),
+            'age': snapshot.age().total_seconds(),
+        }
+        for snapshot in target_snapshots
+    ])
+
+
+async def estimate(request):
+    try:
+        estimates = await async_estimate_restore(request.query['source'], request.query.getall('target'),
+                                                 request.query['backup_date'], request.app['settings'],
+                                                 rac_client=request.app['rac_client'])
+    except (ChildProcessError, BDInvalidName, BackupFilesError, FileNotFoundError, ValueError, KeyError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except pyodbc.OperationalError:
+        raise web.HTTPServiceUnavailable(text='Сервер не найден или недоступен')
+
+    return web.json_response(text=f'[{",".join(estimate.json(ensure_ascii=False) for estimate in estimates)}]')
+
+
+async def sql_pools_stats(request):
+    return web.json_response(sql_pools.stats())
+
+
+async def metrics(request):
+    history = get_restore_history(request.app['settings'].history_path)
+    runs = await to_thread.run_sync(history.runs)
+    statuses = await to_thread.run_sync(history.status_counts)
+    return web.Response(body=render_prometheus(runs, statuses).encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def get_targets(data: dict) -> list:
+    return data.get('targets') or [data['target']]
+
+
+def get_restore_params(data: dict) -> dict:
+    params = {'source': data['source'], 'targets': get_targets(data), 'backup_date': data['backup_date']}
+    for option in ('snapshot', 'skip_if_current', 'logs', 'terminate_sessions', 'optimize'):
+        if data.get(option) is not None:
+            params[option] = bool(data[option])
+    if data.get('mode'):
+        if data['mode'] not in RecoveryMode.all:
+            raise ValueError(f'неизвестный режим восстановления {data["mode"]}')
+        params['mode'] = data['mode']
+    return params
+
+
+def get_job_params(kind, data: dict) -> dict:
+    if kind == 'reset':
+        params = {'targets': get_targets(data)}
+        if data.get('terminate_sessions') is not None:
+            params['terminate_sessions'] = bool(data['terminate_sessions'])
+        return params
+    if kind == 'restore':
+        return get_restore_params(data)
+    raise ValueError(f'неизвестный тип задания {kind}')
+
 
-    return web.Response(body=file, headers={'Content-Type': 'text/html', })
+def job_response(job, status=200):
+    return web.json_response(text=job.json(ensure_ascii=False), status=status)
 
 
-async def send_msg(messages_queue, ws):
-    while True:
-        try:
-            message = await messages_queue.get()
-            # logger.debug(f'send msg to browser {message}')
-            await ws.send_str(message)
-        except ConnectionResetError:
-            logger.error('ConnectionResetError')
+async def submit_job(request):
+    try:
+        data = await request.json()
+        kind = data.get('kind', 'restore')
+        params = get_job_params(kind, data)
+    except (ValueError, KeyError) as e:
+        raise web.HTTPBadRequest(text=f'Неверные параметры задания: {e}')
+    job = await request.app['jobs'].submit(params, kind=kind)
+    return job_response(job, status=201)
+
+
+async def list_jobs(request):
+    jobs = await request.app['jobs'].list(limit=int(request.query.get('limit', 100)))
+    return web.json_response(text=f'[{",".join(job.json(ensure_ascii=False) for job in jobs)}]')
+
+
+async def get_job(request):
+    job_id = request.match_info['job_id']
+    job = await request.app['jobs'].get(job_id)
+    if not job:
+        raise web.HTTPNotFound(text='Задание не найдено')
+    data = json.loads(job.json())
+    data['messages'] = [json.loads(message) for message in await request.app['jobs'].messages(job_id)]
+    return web.json_response(data)
+
+
+async def send_msg(jobs: JobManager, job_id, ws, tick: float):
+    subscriber = await jobs.subscribe(job_id)
+    try:
+        await send_batches(subscriber, ws.send_str, tick)
+    finally:
+        jobs.unsubscribe(job_id, subscriber)
 
 
 async def websocket_handler(request):
     logger.debug('start websocket')
     ws = web.WebSocketResponse()
     await ws.prepare(request)
+    request.app['websockets'].add(ws)
+
+    jobs: JobManager = request.app['jobs']
+    subscriptions = {}
 
-    settings = Settings(_env_file=os.path.join(BASE_DIR, '.env'))
-
-    messages_queue = Queue()
-
-    async for msg in ws:
-        logger.debug(f'{msg=}')
-        if msg.type == aiohttp.WSMsgType.ERROR:
-            logger.error('ws connection closed with exception %s' % ws.exception())
-            continue
-
-        if msg.data == 'close':
-            await ws.close()
-            continue
-
-        msg = json.loads(msg.data)
-        if msg['type'] != 'restore_db':
-            continue
-        try:
-            print(msg)
-            async with create_task_group() as tg:
-                tg.start_soon(
-                    async_do_restore,
-                    messages_queue,
-                    msg['source'],
-                    msg['target'],
-                    msg['backup_date'],
-                    settings
-                )
-                tg.start_soon(send_msg, messages_queue, ws)
-        except (ChildProcessError, BDInvalidName, FileNotFoundError, ValueError) as e:
-            msg = f'Что-то пошло не так \n {str(e)}'
-            await log_send_msg(msg, ws)
-            logger.exception(e)
-        except pyodbc.OperationalError:
-            msg = 'Сервер не найден или недоступен. Операция прервана!'
-            await log_send_msg(msg, ws)
-        except BackupFilesError:
-            msg = 'Не удалось найти пути файлов бекапов. Операция прервана!'
-            await log_send_msg(msg, ws)
-        except pyodbc.ProgrammingError:
-            msg = 'БД приемник недоступна. Операция прервана!'
-            await log_send_msg(msg, ws)
-        except FileNotFoundError:
-            msg = 'Файлы бекапа не найдены на диске. Операция прервана!'
-            await log_send_msg(msg, ws)
+    def subscribe(job_id):
+        if job_id not in subscriptions:
+            task = asyncio.create_task(send_msg(jobs, job_id, ws, request.app['settings'].ws_batch_interval))
+            task.add_done_callback(lambda _: subscriptions.pop(job_id, None))
+            subscriptions[job_id] = task
+
+    try:
+        async for msg in ws:
+            logger.debug(f'{msg=}')
+            if msg.type == aiohttp.WSMsgType.ERROR:
+                logger.error('ws connection closed with exception %s' % ws.exception())
+                continue
+
+            if msg.data == 'close':
+                await ws.close()
+                continue
+
+            msg = json.loads(msg.data)
+            if msg['type'] in ('restore_db', 'reset_db'):
+                kind = 'restore' if msg['type'] == 'restore_db' else 'reset'
+                try:
+                    job = await jobs.submit(get_job_params(kind, msg), kind=kind)
+                except (KeyError, ValueError) as e:
+                    await ws.send_str(to_message(f'Неверные параметры задания: {e}'))
+                    continue
+                await ws.send_str(to_message({'type': 'job', 'job_id': job.id}))
+                await ws.send_str(to_message(f'Задание {job.id} поставлено в очередь'))
+                subscribe(job.id)
+            elif msg['type'] == 'subscribe':
+                subscribe(msg['job_id'])
+            elif msg['type'] == 'unsubscribe' and msg['job_id'] in subscriptions:
+                subscriptions[msg['job_id']].cancel()
+    finally:
+        # задания продолжают выполняться, отключается только этот браузер
+        for task in list(subscriptions.values()):
+            task.cancel()
 
     logger.debug('websocket connection closed')
     return ws
 
 
-async def log_send_msg(msg, ws):
-    await ws.send_str(msg)
-    await ws.send_str('Операция прервана!')
-    logger.error(msg)
+async def start_context(app):
+    """Общие для всех обработчиков и заданий ресурсы создаются один раз при старте."""
+    # настройки можно передать в create_app, например для нагрузочного теста
+    if 'settings' not in app:
+        app['settings'] = Settings(_env_file=os.path.join(BASE_DIR, '.env'))
+    settings = app['settings']
+    rac_cache.ttl = settings.rac_cache_ttl
+    sql_pools.configure(**settings.sql_pool_options())
+    restore_scheduler.configure(settings.restore_max_per_server, settings.restore_max_per_share,
+                                settings.restore_max_bytes_per_server())
+    # один клиент на сервер: rac_max_concurrency ограничивает вызовы rac всех заданий вместе
+    app['rac_client'] = get_rac_client(settings)
+    app['index'] = IndexPage.load(os.path.join(BASE_DIR, 'index.html'))
+    app['websockets'] = weakref.WeakSet()
 
 
-def main():
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    rac_logger = logging.getLogger('rac_tools')
-    rac_logger.setLevel('INFO')
+async def start_jobs(app):
+    settings = app['settings']
+    runner = functools.partial(async_run_job, settings=settings, rac_client=app['rac_client'])
+    app['jobs'] = JobManager(JobStore(settings.job_store_path), runner, workers=settings.job_workers,
+                             buffer_size=settings.ws_buffer_size)
+    await app['jobs'].start()
 
+
+async def drain_jobs(app):
+    # браузеры еще подключены и видят, как завершаются их задания
+    await app['jobs'].stop(timeout=app['settings'].job_shutdown_timeout)
+    for ws in list(app['websockets']):
+        await ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message=b'Server shutdown')
+
+
+async def stop_jobs(app):
+    await app['jobs'].stop()
+    app['jobs'].store.close()
+
+
+async def close_context(app):
+    sql_pools.close()
+
+
+def create_app(settings: Optional[Settings] = None) -> web.Application:
     app = web.Application()
+    if settings is not None:
+        app['settings'] = settings
     app.add_routes([
         web.get('/', handle),
         web.get('/ws', websocket_handler),
+        web.get('/restore_points', restore_points),
+        web.get('/snapshots', snapshots),
+        web.get('/estimate', estimate),
+        web.get('/stats/sql_pools', sql_pools_stats),
+        web.get('/metrics', metrics),
+        web.post('/jobs', submit_job),
+        web.get('/jobs', list_jobs),
+        web.get('/jobs/{job_id}', get_job),
     ])
+    app.on_startup.extend([start_context, start_jobs])
+    app.on_shutdown.append(drain_jobs)
+    app.on_cleanup.extend([stop_jobs, close_context])
+    return app
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    rac_logger = logging.getLogger('rac_tools')
+    rac_logger.setLevel('INFO')
 
-    web.run_app(app, port=8888)
+    web.run_app(create_app(), port=8888)
 
 
 if __name__ == '__main__':
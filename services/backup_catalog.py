@@ -0,0 +1,267 @@
+import datetime
+import functools
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+MSDB_BACKUPSETS_QUERY = '''
+SELECT bs.backup_set_id, bs.database_name, bs.type, bs.backup_start_date, bs.backup_finish_date,
+       bs.backup_size, bs.compressed_backup_size, bs.first_lsn, bs.last_lsn, bs.checkpoint_lsn,
+       bs.database_backup_lsn, bs.differential_base_lsn, bs.is_copy_only, bs.is_snapshot,
+       bmf.family_sequence_number, bmf.physical_device_name
+FROM   msdb.dbo.backupset AS bs LEFT OUTER JOIN msdb.dbo.backupmediafamily AS bmf ON bs.media_set_id = bmf.media_set_id
+WHERE  bs.database_name = ? AND bs.backup_set_id > ?
+ORDER BY bs.backup_set_id, bmf.family_sequence_number'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backupset (
+    server TEXT NOT NULL,
+    backup_set_id INTEGER NOT NULL,
+    database_name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    backup_start_date TEXT,
+    backup_finish_date TEXT NOT NULL,
+    backup_size INTEGER,
+    compressed_backup_size INTEGER,
+    first_lsn TEXT,
+    last_lsn TEXT,
+    checkpoint_lsn TEXT,
+    database_backup_lsn TEXT,
+    differential_base_lsn TEXT,
+    is_copy_only INTEGER NOT NULL DEFAULT 0,
+    is_snapshot INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (server, backup_set_id)
+);
+CREATE INDEX IF NOT EXISTS backupset_lookup
+    ON backupset (server, database_name, type, backup_finish_date);
+CREATE TABLE IF NOT EXISTS backup_device (
+    server TEXT NOT NULL,
+    backup_set_id INTEGER NOT NULL,
+    family_sequence_number INTEGER NOT NULL,
+    physical_device_name TEXT NOT NULL,
+    PRIMARY KEY (server, backup_set_id, family_sequence_number)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    server TEXT NOT NULL,
+    database_name TEXT NOT NULL,
+    last_backup_set_id INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (server, database_name)
+);
+'''
+
+BACKUPSET_COLUMNS = (
+    'backup_set_id', 'database_name', 'type', 'backup_start_date', 'backup_finish_date', 'backup_size',
+    'compressed_backup_size', 'first_lsn', 'last_lsn', 'checkpoint_lsn', 'database_backup_lsn',
+    'differential_base_lsn', 'is_copy_only', 'is_snapshot',
+)
+LSN_COLUMNS = ('first_lsn', 'last_lsn', 'checkpoint_lsn', 'database_backup_lsn', 'differential_base_lsn')
+
+
+class BackupSet(BaseModel):
+    server: str
+    backup_set_id: int
+    database_name: str
+    type: str
+    backup_start_date: Optional[datetime.datetime]
+    backup_finish_date: datetime.datetime
+    backup_size: Optional[int]
+    compressed_backup_size: Optional[int]
+    first_lsn: Optional[int]
+    last_lsn: Optional[int]
+    checkpoint_lsn: Optional[int]
+    database_backup_lsn: Optional[int]
+    differential_base_lsn: Optional[int]
+    is_copy_only: bool = False
+    devices: List[str] = []
+
+
+class RestoreChain(BaseModel):
+    full: BackupSet
+    diff: Optional[BackupSet]
+    logs: List[BackupSet] = []
+
+    @property
+    def backup_date(self) -> datetime.datetime:
+        return (self.diff or self.full).backup_finish_date
+
+
+def _format_date(value):
+    return value.strftime(DATE_FORMAT) if value else None
+
+
+def _format_lsn(value):
+    # LSN - numeric(25, 0), в целое SQLite не помещается
+    return str(int(value)) if value is not None else None
+
+
+class BackupCatalog:
+    """Локальный индекс msdb.dbo.backupset/backupmediafamily в SQLite.
+
+    Синхронизация инкрементальная по backup_set_id, выбор бекапов выполняется локально.
+    """
+
+    def __init__(self, path: str, max_age: float = 300, clock=time.time):
+        self.path = path
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    @staticmethod
+    def _key(server):
+        return server.lower()
+
+    def _last_backup_set_id(self, server, database_name) -> int:
+        row = self._db.execute(
+            'SELECT last_backup_set_id FROM sync_state WHERE server = ? AND database_name = ?',
+            (self._key(server), database_name)
+        ).fetchone()
+        return row['last_backup_set_id'] if row else 0
+
+    def is_fresh(self, server, database_name) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                'SELECT synced_at FROM sync_state WHERE server = ? AND database_name = ?',
+                (self._key(server), database_name)
+            ).fetchone()
+        return bool(row) and self._clock() - row['synced_at'] < self.max_age
+
+    def sync(self, conn, server, database_names: Iterable[str]) -> int:
+        """Дозагружает из msdb бекапы, появившиеся после последней синхронизации. Возвращает их число."""
+        added = 0
+        cursor = conn.cursor()
+        for database_name in database_names:
+            with self._lock:
+                last_id = self._last_backup_set_id(server, database_name)
+            cursor.execute(MSDB_BACKUPSETS_QUERY, database_name, last_id)
+            rows = cursor.fetchall()
+            with self._lock:
+                added += self._store(server, database_name, last_id, rows)
+            logger.debug(f'catalog sync {server}/{database_name}: {len(rows)} rows')
+        return added
+
+    def _store(self, server, database_name, last_id, rows) -> int:
+        server = self._key(server)
+        backup_set_ids = set()
+        with self._db:
+            for row in rows:
+                values = dict(zip(BACKUPSET_COLUMNS, row[:len(BACKUPSET_COLUMNS)]))
+                family_sequence_number, physical_device_name = row[len(BACKUPSET_COLUMNS):]
+                if values['backup_set_id'] not in backup_set_ids:
+                    backup_set_ids.add(values['backup_set_id'])
+                    for column in LSN_COLUMNS:
+                        values[column] = _format_lsn(values[column])
+                    values['backup_start_date'] = _format_date(values['backup_start_date'])
+                    values['backup_finish_date'] = _format_date(values['backup_finish_date'])
+                    self._db.execute(
+                        f'INSERT OR REPLACE INTO backupset (server, {", ".join(BACKUPSET_COLUMNS)}) '
+                        f'VALUES (?, {", ".join("?" * len(BACKUPSET_COLUMNS))})',
+                        (server, *values.values())
+                    )
+                if physical_device_name:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO backup_device VALUES (?, ?, ?, ?)',
+                        (server, values['backup_set_id'], family_sequence_number or 1, physical_device_name)
+                    )
+            self._db.execute(
+                'INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)',
+                (server, database_name, max(backup_set_ids, default=last_id), self._clock())
+            )
+        return len(backup_set_ids)
+
+    def _to_backup_sets(self, rows) -> List[BackupSet]:
+        if not rows:
+            return []
+        server = rows[0]['server']
+        ids = [row['backup_set_id'] for row in rows]
+        devices: Dict[int, List[str]] = {backup_set_id: [] for backup_set_id in ids}
+        for device in self._db.execute(
+            f'SELECT backup_set_id, physical_device_name FROM backup_device '
+            f'WHERE server = ? AND backup_set_id IN ({", ".join("?" * len(ids))}) '
+            f'ORDER BY backup_set_id, family_sequence_number',
+            (server, *ids)
+        ):
+            devices[device['backup_set_id']].append(device['physical_device_name'])
+        return [BackupSet(**dict(row), devices=devices[row['backup_set_id']]) for row in rows]
+
+    def _select(self, where, params, order='backup_finish_date DESC', limit=None) -> List[BackupSet]:
+        query = f'SELECT * FROM backupset WHERE is_snapshot = 0 AND {where} ORDER BY {order}'
+        if limit:
+            query = f'{query} LIMIT {int(limit)}'
+        with self._lock:
+            return self._to_backup_sets(self._db.execute(query, params).fetchall())
+
+    def find_backup(self, server, database_name, backup_type: str,
+                    as_of: datetime.datetime) -> Optional[BackupSet]:
+        """Последний бекап указанного типа, завершенный не позже as_of."""
+        backup_sets = self._select(
+            'server = ? AND database_name = ? AND type = ? AND backup_finish_date <= ?',
+            (self._key(server), database_name, backup_type, _format_date(as_of)),
+            limit=1
+        )
+        return backup_sets[0] if backup_sets else None
+
+    def restore_chain(self, server, database_name, as_of: datetime.datetime) -> Optional[RestoreChain]:
+        """Полный бекап + последний дифференциальный к нему + цепочка логов на момент as_of."""
+        full = self.find_backup(server, database_name, 'D', as_of)
+        if not full:
+            return None
+
+        diffs = self._select(
+            'server = ? AND database_name = ? AND type = ? AND backup_finish_date <= ? AND differential_base_lsn = ?',
+            (self._key(server), database_name, 'I', _format_date(as_of), _format_lsn(full.checkpoint_lsn)),
+            limit=1
+        )
+        diff = diffs[0] if diffs else None
+
+        logs = self.log_chain(server, database_name, (diff or full).last_lsn, (diff or full).backup_finish_date, as_of)
+        return RestoreChain(full=full, diff=diff, logs=logs)
+
+    def log_chain(self, server, database_name, last_lsn: Optional[int], after: datetime.datetime,
+                  as_of: datetime.datetime) -> List[BackupSet]:
+        """Непрерывная цепочка бекапов журнала после last_lsn, до первого бекапа, покрывающего as_of."""
+        logs = []
+        candidates = self._select(
+            'server = ? AND database_name = ? AND type = ? AND backup_finish_date > ?',
+            (self._key(server), database_name, 'L', _format_date(after)),
+            order='backup_finish_date'
+        )
+        for log in candidates:
+            if last_lsn is None or log.last_lsn is None or log.last_lsn <= last_lsn:
+                continue
+            if log.first_lsn > last_lsn:
+                # разрыв цепочки логов
+                break
+            logs.append(log)
+            last_lsn = log.last_lsn
+            if log.backup_finish_date >= as_of:
+                break
+        return logs
+
+    def restore_points(self, server, database_name, limit=50) -> List[BackupSet]:
+        return self._select(
+            'server = ? AND database_name = ? AND type IN (?, ?)',
+            (self._key(server), database_name, 'D', 'I'),
+            limit=limit
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_backup_catalog(path: str, max_age: float = 300) -> BackupCatalog:
+    return BackupCatalog(path, max_age)
@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Set
+
+from services.progress import to_message
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+    """Ограниченный буфер сообщений одного подписчика.
+
+    Сообщение с ключом заменяет еще не отправленное сообщение с тем же ключом: отстающий браузер получит
+    последний процент, а не все промежуточные. Когда буфер полон, отбрасываются самые старые сообщения.
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._messages: 'OrderedDict[Hashable, str]' = OrderedDict()
+        self._counter = itertools.count()
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, message: str, key: Optional[str] = None) -> None:
+        if self.closed:
+            return
+        if key is None:
+            key = next(self._counter)
+        else:
+            self._messages.pop(key, None)
+        self._messages[key] = message
+        while len(self._messages) > self.maxsize:
+            self._messages.popitem(last=False)
+            self.dropped += 1
+        self._ready.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self._ready.set()
+
+    async def get(self, max_batch: int = 100) -> Optional[List[str]]:
+        """Все накопленные сообщения, не больше max_batch; None - канал закрыт и сообщений больше не будет."""
+        while not self._messages:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+
+        batch = []
+        if self.dropped:
+            batch.append(to_message(f'Пропущено сообщений: {self.dropped}, полный журнал - в истории задания'))
+            self.dropped = 0
+        while self._messages and len(batch) < max_batch:
+            batch.append(self._messages.popitem(last=False)[1])
+        return batch
+
+
+class Broadcast:
+    """Рассылка сообщений одного задания всем подписчикам."""
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self.subscribers: Set[Subscriber] = set()
+
+    def subscribe(self, subscriber: Optional[Subscriber] = None) -> Subscriber:
+        if subscriber is None:
+            subscriber = Subscriber(self.maxsize)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+        subscriber.close()
+
+    def publish(self, message: str, key: Optional[str] = None) -> None:
+        for subscriber in self.subscribers:
+            subscriber.put(message, key)
+
+    def close(self) -> None:
+        for subscriber in self.subscribers:
+            subscriber.close()
+        self.subscribers.clear()
+
+
+def to_frame(batch: List[str]) -> str:
+    """Одно сообщение уходит как есть, несколько - одним кадром в виде JSON массива."""
+    if len(batch) == 1:
+        return batch[0]
+    return f'[{",".join(batch)}]'
+
+
+async def send_batches(subscriber: Subscriber, send, tick: float = 0.1, timeout: float = 30) -> None:
+    """Отправляет сообщения подписчика кадрами не чаще раза в tick секунд.
+
+    Заканчивает работу, когда канал закрыт или получатель не принимает кадр timeout секунд.
+    """
+    while True:
+        batch = await subscriber.get()
+        if batch is None:
+            return
+        try:
+            await asyncio.wait_for(send(to_frame(batch)), timeout)
+        except (ConnectionResetError, asyncio.TimeoutError) as e:
+            logger.debug(f'subscriber is gone: {e!r}')
+            subscriber.close()
+            return
+        # пока ждем, сообщения копятся и сливаются в один кадр
+        await asyncio.sleep(tick)
@@ -0,0 +1,75 @@
+import datetime
+import statistics
+from typing import Optional
+
+from pydantic import BaseModel
+
+from services.metrics import MB, RESTORE_PHASES, RestoreHistory, RestoreRun
+
+GB = 1024 * MB
+
+# сколько последних восстановлений учитывать: скорость сети и дисков со временем меняется
+SAMPLES = 20
+
+
+class RestoreEstimate(BaseModel):
+    """Прогноз длительности восстановления до его начала."""
+    target: Optional[str]
+    target_server: str
+    backup_share: str
+    backup_size: int
+    compressed_backup_size: int
+    # МБ/с по backup_size, как RestoreRun.throughput
+    throughput: float
+    duration: float
+    # share - по восстановлениям с той же папки на тот же сервер, server - на тот же сервер, default - истории нет
+    basis: str
+    samples: int = 0
+    # через сколько секунд сервер примет восстановление с учетом очереди; None - неизвестно
+    start_in: Optional[float]
+
+    def describe(self) -> str:
+        basis = {
+            'share': f'по {self.samples} восстановлениям с {self.backup_share} на {self.target_server}',
+            'server': f'по {self.samples} восстановлениям на {self.target_server}',
+            'default': 'истории восстановлений нет',
+        }[self.basis]
+        return f'Прогноз: {self.backup_size / GB:.1f} ГБ (сжато {self.compressed_backup_size / GB:.1f} ГБ), ' \
+               f'~{self.duration / 60:.0f} мин при {self.throughput:.0f} МБ/с ({basis})'
+
+
+def describe_start(server, start_in: Optional[float]) -> str:
+    if start_in is None:
+        return f'Сервер {server} занят, восстановление ждет в очереди'
+    start = datetime.datetime.now() + datetime.timedelta(seconds=start_in)
+    return f'Сервер {server} занят, ожидаемое начало восстановления в {start:%H:%M} (через ~{start_in / 60:.0f} мин)'
+
+
+def get_overhead(run: RestoreRun) -> float:
+    """Время восстановления вне RESTORE и очереди: rac, подготовка, обработка базы, снимок."""
+    restore_time = sum(run.phases.get(phase, 0) for phase in RESTORE_PHASES)
+    return max(run.duration - restore_time - run.phases.get('queue', 0), 0)
+
+
+def estimate_restore(history: RestoreHistory, backup_size: int, compressed_backup_size: int, backup_share,
+                     target_server, default_throughput: float, samples=SAMPLES) -> RestoreEstimate:
+    """Медианная скорость последних восстановлений с той же папки бекапов на тот же сервер, если их нет -
+    любых на этот сервер, иначе default_throughput, МБ/с."""
+    basis, runs = 'share', history.recent(target_server, backup_share, limit=samples)
+    if not runs:
+        basis, runs = 'server', history.recent(target_server, limit=samples)
+    if runs:
+        throughput = statistics.median(run.throughput for run in runs)
+        overhead = statistics.median(get_overhead(run) for run in runs)
+    else:
+        basis, throughput, overhead = 'default', default_throughput, 0
+    return RestoreEstimate(
+        target_server=target_server,
+        backup_share=backup_share,
+        backup_size=backup_size,
+        compressed_backup_size=compressed_backup_size,
+        throughput=throughput,
+        duration=backup_size / MB / throughput + overhead,
+        basis=basis,
+        samples=len(runs),
+    )
@@ -4,3 +4,11 @@ class BDInvalidName(Exception):
 
 class BackupFilesError(Exception):
     pass
+
+
+class ConnectionPoolTimeout(Exception):
+    pass
+
+
+class SnapshotNotFound(Exception):
+    pass
@@ -0,0 +1,145 @@
+import logging
+import ntpath
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Union
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# типы файлов в RESTORE FILELISTONLY
+DATA, LOG, FULL_TEXT, FILESTREAM = 'D', 'L', 'F', 'S'
+
+RECEIVER_FILES_QUERY = '''
+SELECT type, physical_name FROM sys.master_files WHERE database_id = DB_ID(?) ORDER BY file_id
+'''
+DEFAULT_PATHS_QUERY = '''
+SELECT CAST(SERVERPROPERTY('InstanceDefaultDataPath') AS nvarchar(260)),
+       CAST(SERVERPROPERTY('InstanceDefaultLogPath') AS nvarchar(260))
+'''
+
+
+class BackupFile(BaseModel):
+    logical_name: str
+    physical_name: str
+    type: str
+    file_id: int
+
+
+def quote(value: str) -> str:
+    return value.replace("'", "''")
+
+
+def get_disks(backup_paths: Union[str, List[str]]) -> str:
+    """FROM DISK = ..., DISK = ... для всех файлов набора, SQL Server читает их параллельно."""
+    if isinstance(backup_paths, str):
+        backup_paths = [backup_paths]
+    return ', '.join(f"DISK = N'{quote(path)}'" for path in backup_paths)
+
+
+def read_backup_files(conn, backup_paths: List[str]) -> List[BackupFile]:
+    """Файлы базы в бекапе по RESTORE FILELISTONLY."""
+    cursor = conn.cursor()
+    cursor.execute(f'RESTORE FILELISTONLY FROM {get_disks(backup_paths)} WITH FILE = 1')
+    columns = [column[0] for column in cursor.description]
+    files = []
+    for row in cursor.fetchall():
+        values = dict(zip(columns, row))
+        files.append(BackupFile(logical_name=values['LogicalName'], physical_name=values['PhysicalName'],
+                                type=values['Type'], file_id=values['FileId']))
+    return files
+
+
+class FileListCache:
+    """Список файлов бекапа по ключу (путь, размер, время изменения) всех файлов набора."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._files: 'OrderedDict[tuple, List[BackupFile]]' = OrderedDict()
+
+    @staticmethod
+    def _key(backup_paths: List[str]) -> tuple:
+        key = []
+        for path in backup_paths:
+            stat = os.stat(path)
+            key.append((path.lower(), stat.st_size, stat.st_mtime))
+        return tuple(key)
+
+    def get(self, conn, backup_paths: List[str]) -> List[BackupFile]:
+        try:
+            key = self._key(backup_paths)
+        except OSError as e:
+            # файл недоступен с сервера приложения, но может быть доступен серверу SQL
+            logger.debug(f'file list is not cached: {e}')
+            return read_backup_files(conn, backup_paths)
+
+        with self._lock:
+            files = self._files.get(key)
+            if files is not None:
+                self._files.move_to_end(key)
+                return files
+
+        files = read_backup_files(conn, backup_paths)
+        with self._lock:
+            self._files[key] = files
+            while len(self._files) > self.maxsize:
+                self._files.popitem(last=False)
+        return files
+
+
+file_list_cache = FileListCache()
+
+
+def get_receiver_directories(conn, db_name) -> Tuple[str, str]:
+    """Папки данных и журнала базы приемника, для новой базы - папки сервера по умолчанию."""
+    cursor = conn.cursor()
+    cursor.execute(RECEIVER_FILES_QUERY, db_name)
+    data_dir = log_dir = None
+    for file_type, physical_name in cursor.fetchall():
+        # 0 - ROWS, 1 - LOG
+        if file_type == 0 and data_dir is None:
+            data_dir = ntpath.dirname(physical_name)
+        elif file_type == 1 and log_dir is None:
+            log_dir = ntpath.dirname(physical_name)
+
+    if data_dir is None or log_dir is None:
+        cursor.execute(DEFAULT_PATHS_QUERY)
+        default_data_dir, default_log_dir = cursor.fetchone()
+        data_dir = data_dir or default_data_dir.rstrip('\\/')
+        log_dir = log_dir or default_log_dir.rstrip('\\/')
+    return data_dir, log_dir
+
+
+def join_path(directory: str, name: str) -> str:
+    # сервер SQL на Linux использует прямые слеши
+    if '/' in directory and '\\' not in directory:
+        return f'{directory.rstrip("/")}/{name}'
+    return ntpath.join(directory, name)
+
+
+def map_files(files: List[BackupFile], db_name, data_dir, log_dir) -> List[Tuple[str, str]]:
+    """Новые пути всех файлов бекапа: (логическое имя, путь) в папках приемника с именем базы приемника."""
+    mapping = []
+    first = {}
+    for file in sorted(files, key=lambda file: file.file_id):
+        _, ext = ntpath.splitext(file.physical_name)
+        if file.type == LOG:
+            directory, base_name = log_dir, f'{db_name}_log'
+        else:
+            directory, base_name = data_dir, db_name
+        if file.type in (FULL_TEXT, FILESTREAM):
+            # каталоги, а не файлы
+            ext = ''
+        # первый файл данных и журнала называются как раньше, остальные - по логическому имени
+        if first.setdefault(file.type, file.file_id) != file.file_id or file.type in (FULL_TEXT, FILESTREAM):
+            base_name = f'{base_name}_{file.logical_name}'
+        mapping.append((file.logical_name, join_path(directory, f'{base_name}{ext}')))
+    return mapping
+
+
+def get_move_options(mapping: List[Tuple[str, str]]) -> str:
+    """MOVE для WITH, с завершающей запятой, как RestoreTuning.get_options."""
+    return ''.join(f"MOVE N'{quote(logical_name)}' TO N'{quote(path)}', " for logical_name, path in mapping)
@@ -0,0 +1,315 @@
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from anyio import to_thread
+from pydantic import BaseModel
+
+from services.broadcast import Broadcast, Subscriber
+from services.progress import coalesce_key, to_message
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    error TEXT,
+    results TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+CREATE TABLE IF NOT EXISTS job_messages (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+'''
+
+
+class JobStatus:
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+    error = 'error'
+
+    finished = (done, error)
+
+
+class Job(BaseModel):
+    id: str
+    kind: str = 'restore'
+    params: dict
+    status: str = JobStatus.queued
+    created_at: datetime.datetime
+    started_at: Optional[datetime.datetime]
+    finished_at: Optional[datetime.datetime]
+    error: Optional[str]
+    results: Optional[list]
+
+
+class JobStore:
+    """Состояние и журнал заданий в SQLite, переживают перезапуск сервера."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    @staticmethod
+    def _to_job(row) -> Job:
+        values = dict(row)
+        values['params'] = json.loads(values['params'])
+        values['results'] = json.loads(values['results']) if values['results'] else None
+        return Job(**values)
+
+    def save(self, job: Job) -> None:
+        values = job.dict()
+        values['params'] = json.dumps(values['params'], ensure_ascii=False)
+        values['results'] = json.dumps(values['results'], ensure_ascii=False, default=str) \
+            if values['results'] is not None else None
+        with self._lock, self._db:
+            self._db.execute(
+                f'INSERT OR REPLACE INTO jobs ({", ".join(values)}) VALUES ({", ".join("?" * len(values))})',
+                tuple(values.values())
+            )
+
+    def get(self, job_id) -> Optional[Job]:
+        with self._lock:
+            row = self._db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def list(self, limit=100, statuses=None) -> List[Job]:
+        query, params = 'SELECT * FROM jobs', ()
+        if statuses:
+            query = f'{query} WHERE status IN ({", ".join("?" * len(statuses))})'
+            params = tuple(statuses)
+        with self._lock:
+            rows = self._db.execute(f'{query} ORDER BY created_at DESC LIMIT {int(limit)}', params).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def add_messages(self, messages: List[Tuple[str, str]]) -> None:
+        """Пишет пачку сообщений (job_id, message) одной транзакцией."""
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO job_messages SELECT ?, COALESCE(MAX(seq), 0) + 1, ? FROM job_messages WHERE job_id = ?',
+                [(job_id, message, job_id) for job_id, message in messages]
+            )
+
+    def messages(self, job_id) -> List[str]:
+        with self._lock:
+            rows = self._db.execute('SELECT message FROM job_messages WHERE job_id = ? ORDER BY seq', (job_id,))
+            return [row['message'] for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class JobLog:
+    """Очередь сообщений одного задания: пишет в журнал и рассылает подписчикам в виде JSON."""
+
+    def __init__(self, manager: 'JobManager', job_id: str):
+        self.manager = manager
+        self.job_id = job_id
+
+    def put_nowait(self, msg):
+        self.manager.publish(self.job_id, to_message(msg), coalesce_key(msg))
+
+
+class JobManager:
+    """Выполняет задания восстановления в фоне, независимо от подключенных браузеров.
+
+    Сообщения заданий пишутся в журнал не из цикла событий, а отдельной задачей в потоке, пачками раз в
+    flush_interval секунд; из прогресса восстановления за это время в журнал попадает только последний.
+    """
+
+    def __init__(self, store: JobStore, runner, workers: int = 4, buffer_size: int = 1000,
+                 flush_interval: float = 0.5):
+        # runner(job, log) - корутина, выполняющая задание и возвращающая его результаты
+        self.store = store
+        self.runner = runner
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._writer_task: Optional[asyncio.Task] = None
+        # ещё не записанные сообщения: (job_id, ключ схлопывания или номер) -> (сообщение, ключ схлопывания)
+        self._pending: Dict[tuple, Tuple[str, Optional[str]]] = {}
+        self._counter = itertools.count()
+        self._dirty: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._broadcasts: Dict[str, Broadcast] = {}
+        # число выполняющихся заданий; _idle установлено, когда их нет
+        self._running = 0
+        self._idle: Optional[asyncio.Event] = None
+        self._closing = False
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._dirty = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        for job in await to_thread.run_sync(self.store.list, 1000, [JobStatus.running]):
+            job.status, job.error = JobStatus.error, 'Задание прервано перезапуском сервера'
+            job.finished_at = datetime.datetime.now()
+            await to_thread.run_sync(self.store.save, job)
+        for job in reversed(await to_thread.run_sync(self.store.list, 1000, [JobStatus.queued])):
+            self._queue.put_nowait(job.id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._writer_task = asyncio.create_task(self._writer())
+
+    async def stop(self, timeout: float = 0) -> None:
+        """Останавливает исполнителей. Новые задания из очереди больше не берутся, уже выполняющимся дается
+        timeout секунд на завершение, затем они прерываются. Оставшиеся в очереди выполнятся после перезапуска."""
+        self._closing = True
+        if timeout > 0 and self._running:
+            logger.info(f'waiting for {self._running} running jobs')
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f'{self._running} jobs interrupted after {timeout} s')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._writer_task:
+            self._writer_task.cancel()
+            await asyncio.gather(self._writer_task, return_exceptions=True)
+            self._writer_task = None
+        await self.flush()
+
+    async def submit(self, params: dict, kind='restore') -> Job:
+        job = Job(id=uuid.uuid4().hex, kind=kind, params=params, created_at=datetime.datetime.now())
+        await to_thread.run_sync(self.store.save, job)
+        # при остановке задание остается в очереди в хранилище и выполнится после перезапуска
+        if not self._closing:
+            self._queue.put_nowait(job.id)
+        logger.info(f'job {job.id} queued: {params}')
+        return job
+
+    async def get(self, job_id) -> Optional[Job]:
+        return await to_thread.run_sync(self.store.get, job_id)
+
+    async def list(self, limit=100) -> List[Job]:
+        return await to_thread.run_sync(self.store.list, limit)
+
+    def _read(self, job_id) -> Tuple[Optional[Job], List[str]]:
+        return self.store.get(job_id), self.store.messages(job_id)
+
+    def _get_pending(self, job_id) -> List[Tuple[str, Optional[str]]]:
+        return [value for (pending_job_id, _), value in self._pending.items() if pending_job_id == job_id]
+
+    async def messages(self, job_id) -> List[str]:
+        """Все сообщения задания: записанные в журнал и еще нет."""
+        # пока журнал читается, запись не идет: сообщения не окажутся ни в прочитанном, ни в _pending
+        async with self._flush_lock:
+            _, messages = await to_thread.run_sync(self._read, job_id)
+            return messages + [message for message, _ in self._get_pending(job_id)]
+
+    async def subscribe(self, job_id) -> Subscriber:
+        """Подписка на сообщения задания: сначала уже накопленные, затем новые; None - задание завершено."""
+        subscriber = Subscriber(self.buffer_size)
+        async with self._flush_lock:
+            job, messages = await to_thread.run_sync(self._read, job_id)
+            for message in messages:
+                subscriber.put(message, coalesce_key(json.loads(message)))
+            for message, key in self._get_pending(job_id):
+                subscriber.put(message, key)
+            # задание завершается только после записи журнала, то есть не раньше, чем подписчик добавлен
+            if not job or job.status in JobStatus.finished:
+                subscriber.close()
+            else:
+                self._broadcasts.setdefault(job_id, Broadcast(self.buffer_size)).subscribe(subscriber)
+        return subscriber
+
+    def unsubscribe(self, job_id, subscriber: Subscriber) -> None:
+        broadcast = self._broadcasts.get(job_id)
+        if broadcast:
+            broadcast.unsubscribe(subscriber)
+            if not broadcast.subscribers:
+                self._broadcasts.pop(job_id, None)
+
+    def publish(self, job_id, message: str, key: Optional[str] = None) -> None:
+        # как в Broadcast: новый прогресс заменяет незаписанный старый и встает в конец
+        pending_key = (job_id, key if key is not None else next(self._counter))
+        self._pending.pop(pending_key, None)
+        self._pending[pending_key] = (message, key)
+        if self._dirty:
+            self._dirty.set()
+        broadcast = self._broadcasts.get(job_id)
+        if broadcast:
+            broadcast.publish(message, key)
+
+    async def flush(self) -> None:
+        """Записывает накопленные сообщения в журнал."""
+        async with self._flush_lock:
+            self._dirty.clear()
+            batch, self._pending = self._pending, {}
+            if batch:
+                await to_thread.run_sync(self.store.add_messages, [
+                    (job_id, message) for (job_id, _), (message, _) in batch.items()
+                ])
+
+    async def _writer(self) -> None:
+        while True:
+            await self._dirty.wait()
+            await self.flush()
+            await asyncio.sleep(self.flush_interval)
+
+    def _finish(self, job_id) -> None:
+        broadcast = self._broadcasts.pop(job_id, None)
+        if broadcast:
+            broadcast.close()
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            if self._closing:
+                return
+            job = await to_thread.run_sync(self.store.get, job_id)
+            if self._closing:
+                return
+            if not job or job.status != JobStatus.queued:
+                continue
+
+            job.status, job.started_at = JobStatus.running, datetime.datetime.now()
+            self._running += 1
+            self._idle.clear()
+            try:
+                await to_thread.run_sync(self.store.save, job)
+                job.results = await self.runner(job, JobLog(self, job.id))
+                job.status = JobStatus.done
+            except asyncio.CancelledError:
+                job.status, job.error = JobStatus.error, 'Задание прервано остановкой сервера'
+                raise
+            except Exception as e:
+                logger.exception(e)
+                job.status, job.error = JobStatus.error, str(e)
+            finally:
+                job.finished_at = datetime.datetime.now()
+                try:
+                    # журнал задания полон раньше, чем оно станет завершенным
+                    await self.flush()
+                finally:
+                    await to_thread.run_sync(self.store.save, job)
+                self._finish(job.id)
+                self._running -= 1
+                if not self._running:
+                    self._idle.set()
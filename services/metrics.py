@@ -0,0 +1,222 @@
+import datetime
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS restore_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    source_server TEXT,
+    source_db TEXT,
+    target_server TEXT,
+    target_db TEXT,
+    status TEXT NOT NULL,
+    backup_size INTEGER,
+    compressed_backup_size INTEGER,
+    duration REAL NOT NULL,
+    throughput REAL,
+    phases TEXT NOT NULL,
+    backup_share TEXT
+);
+CREATE INDEX IF NOT EXISTS restore_runs_started_at ON restore_runs (started_at);
+'''
+
+# столбцы, добавленные после первой версии схемы: в уже созданную базу истории они добавляются при открытии
+MIGRATIONS = {
+    'backup_share': 'ALTER TABLE restore_runs ADD COLUMN backup_share TEXT',
+}
+
+# фазы, в которых SQL Server читает бекап - по ним считается скорость
+RESTORE_PHASES = ('full', 'diff', 'log')
+
+
+class PhaseTimer:
+    """Длительность фаз восстановления, в секундах."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self.phases: Dict[str, float] = {}
+
+    @contextmanager
+    def span(self, phase: str):
+        started = self._clock()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0) + self._clock() - started
+            logger.debug(f'phase {phase}: {self.phases[phase]:.3f} s')
+
+
+class RestoreRun(BaseModel):
+    started_at: datetime.datetime
+    source_server: Optional[str]
+    source_db: Optional[str]
+    target_server: Optional[str]
+    target_db: Optional[str]
+    status: str
+    backup_size: Optional[int]
+    compressed_backup_size: Optional[int]
+    duration: float
+    throughput: Optional[float]
+    phases: Dict[str, float] = {}
+    # папка бекапов источника, см. scheduler.get_share
+    backup_share: Optional[str]
+
+    @staticmethod
+    def get_throughput(backup_size, phases: Dict[str, float]) -> Optional[float]:
+        restore_time = sum(phases.get(phase, 0) for phase in RESTORE_PHASES)
+        if not backup_size or not restore_time:
+            return None
+        return backup_size / MB / restore_time
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0
+    index = (len(values) - 1) * q
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+class RestoreHistory:
+    """История восстановлений с длительностью фаз в SQLite."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+            columns = {row['name'] for row in self._db.execute('PRAGMA table_info(restore_runs)')}
+            for column, script in MIGRATIONS.items():
+                if column not in columns:
+                    self._db.execute(script)
+
+    def add(self, run: RestoreRun) -> None:
+        values = run.dict()
+        values['phases'] = json.dumps(values['phases'])
+        with self._lock, self._db:
+            self._db.execute(
+                f'INSERT INTO restore_runs ({", ".join(values)}) VALUES ({", ".join("?" * len(values))})',
+                tuple(values.values())
+            )
+
+    def runs(self, since: Optional[datetime.datetime] = None, limit=10000) -> List[RestoreRun]:
+        query, params = 'SELECT * FROM restore_runs', ()
+        if since:
+            query, params = f'{query} WHERE started_at >= ?', (since.isoformat(sep=' '),)
+        with self._lock:
+            rows = self._db.execute(f'{query} ORDER BY started_at DESC LIMIT {int(limit)}', params).fetchall()
+        return self._to_runs(rows)
+
+    def status_counts(self) -> Dict[str, int]:
+        """Число восстановлений по статусам за всю историю - для счетчиков, которые не должны уменьшаться."""
+        with self._lock:
+            rows = self._db.execute('SELECT status, COUNT(*) FROM restore_runs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def recent(self, target_server, backup_share: Optional[str] = None, limit=20) -> List[RestoreRun]:
+        """Последние успешные восстановления на сервер приемник с известной скоростью."""
+        query, params = 'SELECT * FROM restore_runs WHERE status = ? AND throughput IS NOT NULL ' \
+                        'AND target_server = ? COLLATE NOCASE', ('done', target_server)
+        if backup_share is not None:
+            query, params = f'{query} AND backup_share = ?', (*params, backup_share)
+        with self._lock:
+            rows = self._db.execute(f'{query} ORDER BY started_at DESC LIMIT {int(limit)}', params).fetchall()
+        return self._to_runs(rows)
+
+    @staticmethod
+    def _to_runs(rows) -> List[RestoreRun]:
+        return [RestoreRun(**{**dict(row), 'phases': json.loads(row['phases'])}) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_restore_history(path: str) -> RestoreHistory:
+    return RestoreHistory(path)
+
+
+def get_phase_stats(runs: Iterable[RestoreRun]) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """p50/p95 длительности фаз по паре серверов: {'src -> dst': {phase: {'p50', 'p95', 'count', 'sum'}}}."""
+    durations: Dict[str, Dict[str, List[float]]] = {}
+    for run in runs:
+        if run.status != 'done':
+            continue
+        pair = f'{run.source_server} -> {run.target_server}'
+        for phase, duration in {**run.phases, 'total': run.duration}.items():
+            durations.setdefault(pair, {}).setdefault(phase, []).append(duration)
+    return {
+        pair: {
+            phase: {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'count': len(values),
+                    'sum': sum(values)}
+            for phase, values in phases.items()
+        }
+        for pair, phases in durations.items()
+    }
+
+
+def _labels(**labels) -> str:
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus(runs: List[RestoreRun], statuses: Dict[str, int]) -> str:
+    """Метрики в текстовом формате Prometheus: statuses - RestoreHistory.status_counts, runs - последние
+    восстановления для длительности фаз и скорости."""
+    lines = [
+        '# HELP restore_runs_total Restores by status.',
+        '# TYPE restore_runs_total counter',
+    ]
+    lines.extend(f'restore_runs_total{_labels(status=status)} {count}' for status, count in sorted(statuses.items()))
+
+    lines.extend([
+        '# HELP restore_phase_seconds Restore phase duration by server pair.',
+        '# TYPE restore_phase_seconds summary',
+    ])
+    for pair, phases in get_phase_stats(runs).items():
+        source, target = pair.split(' -> ')
+        for phase, stats in phases.items():
+            labels = dict(source=source, target=target, phase=phase)
+            lines.append(f'restore_phase_seconds{_labels(**labels, quantile="0.5")} {stats["p50"]:.3f}')
+            lines.append(f'restore_phase_seconds{_labels(**labels, quantile="0.95")} {stats["p95"]:.3f}')
+            lines.append(f'restore_phase_seconds_sum{_labels(**labels)} {stats["sum"]:.3f}')
+            lines.append(f'restore_phase_seconds_count{_labels(**labels)} {stats["count"]}')
+
+    lines.extend([
+        '# HELP restore_throughput_mb_per_second Throughput of the last restore by server pair.',
+        '# TYPE restore_throughput_mb_per_second gauge',
+    ])
+    last_throughput = {}
+    for run in sorted(runs, key=lambda run: run.started_at):
+        if run.status == 'done' and run.throughput:
+            last_throughput[(run.source_server, run.target_server)] = run.throughput
+    for (source, target), throughput in last_throughput.items():
+        lines.append(f'restore_throughput_mb_per_second{_labels(source=source, target=target)} {throughput:.3f}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_report(runs: List[RestoreRun]) -> str:
+    rows = []
+    for pair, phases in sorted(get_phase_stats(runs).items()):
+        rows.append(pair)
+        for phase, stats in phases.items():
+            rows.append(f'  {phase:<14} p50 {stats["p50"]:9.1f} s  p95 {stats["p95"]:9.1f} s  n={stats["count"]}')
+    return '\n'.join(rows) or 'История восстановлений пуста'
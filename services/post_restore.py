@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from services.file_mapping import quote
+from services.metrics import PhaseTimer
+
+logger = logging.getLogger(__name__)
+
+LOG_FILES_QUERY = '''
+SELECT name FROM sys.master_files WHERE database_id = DB_ID(?) AND type = 1 ORDER BY file_id
+'''
+
+
+class PostRestoreOptions(BaseModel):
+    """Обработка тестовой базы после восстановления: база с настройками продуктива медленная и занимает много места."""
+    simple_recovery: bool = True
+    # до какого размера сжать журнал, МБ; None - не сжимать
+    log_size_mb: Optional[int] = 1024
+    # статистика обновляется в фоне, запросы не ждут ее пересчета
+    statistics_async: bool = True
+    update_statistics: bool = False
+    rebuild_indexes: bool = False
+    fragmentation: float = 30
+    min_pages: int = 1000
+    # сколько секунд можно потратить на перестроение индексов
+    index_budget: float = 600
+
+
+class FragmentedIndex(BaseModel):
+    schema_name: str
+    table_name: str
+    index_name: str
+    fragmentation: float
+    page_count: int
+
+
+def get_fragmented_indexes_query(db_name) -> str:
+    return f'''
+SELECT s.name, t.name, i.name, ps.avg_fragmentation_in_percent, ps.page_count
+FROM   sys.dm_db_index_physical_stats(DB_ID(?), NULL, NULL, NULL, 'LIMITED') AS ps
+       INNER JOIN [{db_name}].sys.indexes AS i ON i.object_id = ps.object_id AND i.index_id = ps.index_id
+       INNER JOIN [{db_name}].sys.tables AS t ON t.object_id = ps.object_id
+       INNER JOIN [{db_name}].sys.schemas AS s ON s.schema_id = t.schema_id
+WHERE  ps.index_id > 0 AND ps.alloc_unit_type_desc = 'IN_ROW_DATA'
+       AND ps.avg_fragmentation_in_percent >= ? AND ps.page_count >= ?
+ORDER BY ps.avg_fragmentation_in_percent * ps.page_count DESC'''
+
+
+def get_recovery_script(db_name) -> str:
+    return f'ALTER DATABASE [{db_name}] SET RECOVERY SIMPLE WITH NO_WAIT'
+
+
+def get_statistics_script(db_name, statistics_async: bool, update_statistics: bool) -> str:
+    script = []
+    if statistics_async:
+        script.append(f'ALTER DATABASE [{db_name}] SET AUTO_UPDATE_STATISTICS_ASYNC ON WITH NO_WAIT')
+    if update_statistics:
+        script.append(f'EXEC [{db_name}].sys.sp_updatestats')
+    return '\n'.join(script)
+
+
+def get_shrink_log_script(db_name, log_names: List[str], size_mb: int) -> str:
+    # DBCC SHRINKFILE работает в текущей базе: выполняем в контексте приемника, не меняя базу соединения
+    shrink = ' '.join(f"DBCC SHRINKFILE (N''{quote(quote(name))}'', {size_mb}) WITH NO_INFOMSGS;" for name in log_names)
+    return f"EXEC [{db_name}].sys.sp_executesql N'CHECKPOINT; {shrink}'"
+
+
+def get_rebuild_script(db_name, index: FragmentedIndex) -> str:
+    return f'ALTER INDEX [{index.index_name}] ON [{db_name}].[{index.schema_name}].[{index.table_name}] ' \
+           f'REBUILD WITH (SORT_IN_TEMPDB = ON)'
+
+
+def execute(cursor, script) -> None:
+    cursor.execute(script)
+    while cursor.nextset():
+        pass
+
+
+def execute_with_timeout(cursor, script, timeout: float) -> bool:
+    """Выполняет script не дольше timeout секунд: затем запрос отменяется, как при отмене задания.
+    False - запрос отменен, SQL Server откатывает его."""
+    expired = threading.Event()
+
+    def cancel():
+        expired.set()
+        cursor.cancel()
+
+    timer = threading.Timer(timeout, cancel)
+    timer.start()
+    try:
+        execute(cursor, script)
+    except Exception:
+        if not expired.is_set():
+            raise
+        return False
+    finally:
+        timer.cancel()
+    return True
+
+
+def get_fragmented_indexes(cursor, db_name, fragmentation: float, min_pages: int) -> List[FragmentedIndex]:
+    cursor.execute(get_fragmented_indexes_query(db_name), db_name, fragmentation, min_pages)
+    return [
+        FragmentedIndex(schema_name=schema_name, table_name=table_name, index_name=index_name,
+                        fragmentation=index_fragmentation, page_count=page_count)
+        for schema_name, table_name, index_name, index_fragmentation, page_count in cursor.fetchall()
+    ]
+
+
+def rebuild_indexes(cursor, db_name, options: PostRestoreOptions, messages_queue, clock=time.monotonic) -> int:
+    """Перестраивает самые фрагментированные индексы в пределах index_budget. Возвращает число индексов.
+
+    Индекс, который при скорости уже перестроенных не успеет за остаток времени, пропускается; перестроение,
+    не уложившееся в остаток, отменяется - бюджет не превышается даже на одном большом индексе.
+    """
+    started = clock()
+    indexes = get_fragmented_indexes(cursor, db_name, options.fragmentation, options.min_pages)
+    rebuilt, rebuilt_pages, rebuild_time = 0, 0, 0.0
+    for index in indexes:
+        now = clock()
+        remaining = options.index_budget - (now - started)
+        if remaining <= 0:
+            break
+        if rebuilt_pages and index.page_count * rebuild_time / rebuilt_pages > remaining:
+            logger.debug(f'skip {index}: not enough time')
+            continue
+        logger.debug(f'rebuild {index}')
+        if not execute_with_timeout(cursor, get_rebuild_script(db_name, index), remaining):
+            messages_queue.put_nowait(f'Перестроение индекса {index.index_name} отменено по истечении времени')
+            break
+        rebuilt += 1
+        rebuilt_pages += index.page_count
+        rebuild_time += clock() - now
+    if rebuilt < len(indexes):
+        messages_queue.put_nowait(f'Время на перестроение индексов истекло, осталось индексов: '
+                                  f'{len(indexes) - rebuilt}')
+    return rebuilt
+
+
+def run_post_restore(cursor, db_name, options: PostRestoreOptions, timer: PhaseTimer, messages_queue,
+                     clock=time.monotonic) -> None:
+    """Шаги после восстановления на соединении с autocommit; длительность каждого шага - фаза post_*."""
+
+    def step(phase, description):
+        messages_queue.put_nowait(f'{description}: {timer.phases[phase]:.1f} с')
+
+    if options.simple_recovery:
+        with timer.span('post_recovery'):
+            execute(cursor, get_recovery_script(db_name))
+        step('post_recovery', 'Модель восстановления SIMPLE')
+
+    if options.rebuild_indexes:
+        with timer.span('post_indexes'):
+            rebuilt = rebuild_indexes(cursor, db_name, options, messages_queue, clock)
+        step('post_indexes', f'Перестроено индексов: {rebuilt}')
+
+    if options.statistics_async or options.update_statistics:
+        with timer.span('post_statistics'):
+            execute(cursor, get_statistics_script(db_name, options.statistics_async, options.update_statistics))
+        step('post_statistics', 'Статистика' + (' обновлена' if options.update_statistics else ' в фоне'))
+
+    if options.log_size_mb is not None:
+        with timer.span('post_shrink'):
+            cursor.execute(LOG_FILES_QUERY, db_name)
+            log_names = [name for name, in cursor.fetchall()]
+            execute(cursor, get_shrink_log_script(db_name, log_names, options.log_size_mb))
+        step('post_shrink', f'Журнал сжат до {options.log_size_mb} МБ')
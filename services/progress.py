@@ -0,0 +1,114 @@
+import json
+import re
+import time
+from typing import Optional, Union
+
+from pydantic import BaseModel
+
+MB = 1024 * 1024
+
+NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+PERCENT_RE = re.compile(r'(\d+)\s*percent|процент\w*\D*(\d+)|(\d+)\s*процент', re.IGNORECASE)
+PAGES_RE = re.compile(r'processed\s+(\d+)\s+pages|обработано\s+страниц\D*(\d+)', re.IGNORECASE)
+DONE_RE = re.compile(r'RESTORE\s+(?:DATABASE|LOG).*(successfully|успешно)', re.IGNORECASE)
+
+
+class ProgressEvent(BaseModel):
+    type: str = 'progress'
+    target: Optional[str]
+    phase: str
+    percent: Optional[int]
+    pages: Optional[int]
+    mb_per_sec: Optional[float]
+    eta: Optional[float]
+    elapsed: float
+    text: str
+
+    def describe(self) -> str:
+        parts = [f'[{self.target}] {self.phase}' if self.target else self.phase]
+        if self.percent is not None:
+            parts.append(f'{self.percent}%')
+        if self.pages:
+            parts.append(f'{self.pages} стр.')
+        if self.mb_per_sec is not None:
+            parts.append(f'{self.mb_per_sec:.1f} МБ/с')
+        if self.eta is not None:
+            parts.append(f'осталось {time.strftime("%H:%M:%S", time.gmtime(self.eta))}')
+        return ' '.join(parts)
+
+
+def _first_int(match) -> int:
+    return int(next(group for group in match.groups() if group))
+
+
+def _to_float(value: str) -> float:
+    return float(value.replace(',', '.'))
+
+
+class RestoreProgress:
+    """Разбирает сообщения STATS = 5 одного восстановления в события с фазой, скоростью и оценкой времени."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self.phase = None
+        self.size = None
+        self._pages = 0
+        self._phase_started = clock()
+
+    def start_phase(self, phase: str, size: Optional[int] = None) -> None:
+        self.phase = phase
+        self.size = size
+        self._pages = 0
+        self._phase_started = self._clock()
+
+    def parse(self, msg: str) -> Union[ProgressEvent, str]:
+        """Событие прогресса или исходная строка, если сообщение не о ходе восстановления."""
+        text = msg.strip()
+        elapsed = self._clock() - self._phase_started
+
+        if DONE_RE.search(text):
+            numbers = [_to_float(number) for number in NUMBER_RE.findall(text)]
+            pages, seconds, mb_per_sec = ([None] * 3 + numbers)[-3:]
+            return ProgressEvent(type='phase_done', phase=self.phase, percent=100,
+                                 pages=int(pages) if pages is not None else self._pages,
+                                 mb_per_sec=mb_per_sec, eta=0, elapsed=seconds or elapsed, text=text)
+
+        match = PAGES_RE.search(text)
+        if match:
+            self._pages += _first_int(match)
+            return ProgressEvent(phase=self.phase, pages=self._pages, elapsed=elapsed, text=text)
+
+        match = PERCENT_RE.search(text)
+        if match:
+            percent = _first_int(match)
+            mb_per_sec = eta = None
+            if elapsed > 0 and self.size:
+                mb_per_sec = self.size * percent / 100 / MB / elapsed
+            if percent:
+                eta = elapsed * (100 - percent) / percent
+            return ProgressEvent(phase=self.phase, percent=percent, mb_per_sec=mb_per_sec, eta=eta,
+                                 elapsed=elapsed, text=text)
+
+        return msg
+
+
+def to_message(msg: Union[ProgressEvent, str, dict]) -> str:
+    """Сообщение для браузера: JSON с полем type."""
+    if isinstance(msg, BaseModel):
+        return msg.json(ensure_ascii=False)
+    if isinstance(msg, dict):
+        return json.dumps(msg, ensure_ascii=False)
+    return json.dumps({'type': 'log', 'text': msg}, ensure_ascii=False)
+
+
+def coalesce_key(msg: Union[ProgressEvent, str, dict]) -> Optional[str]:
+    """Ключ, по которому новый прогресс восстановления заменяет неотправленный старый."""
+    if isinstance(msg, ProgressEvent):
+        msg = msg.dict()
+    if isinstance(msg, dict) and msg.get('type') == 'progress':
+        return f'progress:{msg.get("target") or ""}'
+    return None
+
+
+def describe_message(msg: Union[ProgressEvent, str]) -> str:
+    return msg.describe() if isinstance(msg, ProgressEvent) else msg
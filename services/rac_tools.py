@@ -1,7 +1,15 @@
+import asyncio
+import io
 import logging
+import os
 import re
+import shlex
 import subprocess as sub
-from typing import Dict
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from pydantic import BaseModel, Field
 
@@ -15,6 +23,83 @@ class InfoBase(BaseModel):
     name: str
     db_server: str = Field(alias='db-server')
     db_name: str = Field(alias='db-name')
+    # блокировка начала сеансов и регламентных заданий, on/off
+    sessions_deny: Optional[str] = Field(alias='sessions-deny')
+    scheduled_jobs_deny: Optional[str] = Field(alias='scheduled-jobs-deny')
+    denied_message: Optional[str] = Field(alias='denied-message')
+
+
+class Session(BaseModel):
+    id: str = Field(alias='session')
+    infobase: str
+    user_name: Optional[str] = Field(alias='user-name')
+    host: Optional[str]
+    app_id: Optional[str] = Field(alias='app-id')
+
+
+class Connection(BaseModel):
+    id: str = Field(alias='connection')
+    process: Optional[str]
+    infobase: Optional[str]
+    host: Optional[str]
+    application: Optional[str]
+
+
+class RacRecord(Mapping):
+    """Одна запись из вывода rac.
+
+    Набор ключей хранится кортежем, общим для всех записей с одинаковой структурой,
+    поэтому сама запись занимает два указателя.
+    """
+    __slots__ = ('_keys', '_values')
+
+    _keys_cache: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+    def __init__(self, keys: Tuple[str, ...], values: Tuple[str, ...]):
+        self._keys = self._keys_cache.setdefault(keys, keys)
+        self._values = values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f'RacRecord({dict(self)})'
+
+
+def iter_records(lines: Iterable[str], separator='') -> Iterator[RacRecord]:
+    """Разбирает вывод rac построчно и отдает записи по мере чтения."""
+    keys: List[str] = []
+    values: List[str] = []
+    for row in lines:
+        row = row.rstrip('\r\n')
+        if row == separator or (separator and row.startswith(separator)):
+            if keys:
+                yield RacRecord(tuple(keys), tuple(values))
+                keys, values = [], []
+            continue
+        if not row.strip():
+            continue
+        key, _, value = row.partition(':')
+        keys.append(key.strip())
+        values.append(value.strip())
+    if keys:
+        yield RacRecord(tuple(keys), tuple(values))
+
+
+def get_rac_executable(exe_path) -> str:
+    # на Linux rac лежит в папке платформы без расширения
+    if os.name == 'nt':
+        return f'{exe_path}\\rac.exe'
+    return os.path.join(exe_path, 'rac')
 
 
 class RacClient:
@@ -22,89 +107,386 @@ class RacClient:
     def __init__(self, exe_path=r'C:\Program Files (x86)\1cv8\8.3.19.1723\bin'):
         self.exe_path = exe_path
 
-    def _get_command(self, command, server_name, ras_port):
-        return f'{self.exe_path}\\rac.exe {command} {server_name}:{ras_port}'
+    def _get_command(self, command, server_name, ras_port) -> List[str]:
+        return [get_rac_executable(self.exe_path), *shlex.split(command), f'{server_name}:{ras_port}']
+
+    @staticmethod
+    def _run_command(command) -> Iterator[str]:
+        # stderr во временный файл: читая только stdout, не заблокироваться на заполненном канале stderr
+        with tempfile.TemporaryFile() as errs_file:
+            try:
+                proc = sub.Popen(command, stdout=sub.PIPE, stderr=errs_file)
+            except FileNotFoundError:
+                raise FileNotFoundError('Неверный путь к клиенту rac')
+
+            with proc:
+                try:
+                    yield from io.TextIOWrapper(proc.stdout, encoding='cp866')
+                    proc.wait()
+                    errs_file.seek(0)
+                    errs = errs_file.read().decode('cp866')
+                    if errs or proc.returncode:
+                        raise ChildProcessError(f'Error {errs or f"код возврата rac {proc.returncode}"}')
+                finally:
+                    # при досрочном выходе из перебора процесс rac больше не нужен
+                    if proc.poll() is None:
+                        proc.kill()
 
     @staticmethod
-    def _run_command(command):
+    def _process_output(output, separator='') -> List[RacRecord]:
+        return list(iter_records(output, separator))
+
+    def iter(self, command, server_name, ras_port) -> Iterator[RacRecord]:
+        command = self._get_command(command, server_name, ras_port)
+        logger.debug(command)
+        return iter_records(self._run_command(command))
+
+    def get(self, command, server_name, ras_port) -> List[RacRecord]:
+        return list(self.iter(command, server_name, ras_port))
+
+    def find(self, command, server_name, ras_port, predicate: Callable[[RacRecord], bool]) -> Optional[RacRecord]:
+        """Возвращает первую подходящую запись, не дочитывая вывод rac."""
+        records = self.iter(command, server_name, ras_port)
         try:
-            proc = sub.Popen(command, stdout=sub.PIPE, stderr=sub.PIPE)
-            outs, errs = proc.communicate()
-            if errs:
-                raise ChildProcessError(f'Error {errs.decode("cp866")}')
-            else:
-                output = outs.decode('cp866')
+            return next((record for record in records if predicate(record)), None)
+        finally:
+            records.close()
+
+
+class AsyncRacClient:
+    """Асинхронный клиент rac на asyncio.create_subprocess_exec.
+
+    Число одновременных вызовов rac на один сервер ограничено семафором, каждый вызов ограничен по времени,
+    зависший процесс rac принудительно завершается.
+    """
 
+    def __init__(self, exe_path=r'C:\Program Files (x86)\1cv8\8.3.19.1723\bin', timeout: float = 30,
+                 max_concurrency: int = 8):
+        self.exe_path = exe_path
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _get_args(self, command, server_name, ras_port) -> List[str]:
+        return [get_rac_executable(self.exe_path), *shlex.split(command), f'{server_name}:{ras_port}']
+
+    def _get_semaphore(self, server_name) -> asyncio.Semaphore:
+        # семафоры создаются лениво, чтобы они принадлежали уже запущенному циклу событий
+        semaphore = self._semaphores.get(server_name.lower())
+        if semaphore is None:
+            semaphore = self._semaphores[server_name.lower()] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    @staticmethod
+    async def _run_command(args, timeout):
+        try:
+            proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE)
         except FileNotFoundError:
             raise FileNotFoundError('Неверный путь к клиенту rac')
-        except Exception as exc:
-            raise exc
-        return output.split('\r\n')
+
+        try:
+            outs, errs = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            raise ChildProcessError(f'rac не ответил за {timeout} с')
+        finally:
+            if proc.returncode is None:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+
+        if errs or proc.returncode:
+            raise ChildProcessError(f'Error {errs.decode("cp866") or f"код возврата rac {proc.returncode}"}')
+        # rac на Windows выводит \r\n, на Linux - \n
+        return outs.decode('cp866').splitlines()
+
+    async def get(self, command, server_name, ras_port, timeout: Optional[float] = None) -> List[RacRecord]:
+        args = self._get_args(command, server_name, ras_port)
+        logger.debug(args)
+        async with self._get_semaphore(server_name):
+            output = await self._run_command(args, timeout or self.timeout)
+        return RacClient._process_output(output)
+
+
+class RacCache:
+    """Общий для процесса кеш идентификаторов кластеров и списков баз, ключ - (host, ras_port)."""
+
+    def __init__(self, ttl: float = 300, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cluster_ids: Dict[Tuple[str, int], Tuple[float, str]] = {}
+        self._infobases: Dict[Tuple[str, int], Tuple[float, Dict[str, str]]] = {}
 
     @staticmethod
-    def _process_output(output, separator=''):
-        objects = []
-        is_new_object = True
-        for row in output:
-            if not row and row != separator:
-                continue
-            if (row.startswith(separator) and bool(separator)) or separator == row:
-                is_new_object = True
-                continue
-            if is_new_object:
-                obj = {}
-                objects.append(obj)
-                is_new_object = False
-            key, value = row.replace(' ', '').split(':', maxsplit=1)
-            obj[key] = value
-        if len(objects) == 1:
-            return objects[0]
-        return objects
-
-    def get(self, command, server_name, ras_port):
-        command = self._get_command(command, server_name, ras_port)
-        logger.debug(command)
-        output = self._run_command(command)
-        return self._process_output(output)
+    def _key(host, ras_port):
+        return host.lower(), int(ras_port)
 
+    def _get(self, store, host, ras_port):
+        key = self._key(host, ras_port)
+        with self._lock:
+            item = store.get(key)
+            if not item:
+                return None
+            expires, value = item
+            if expires < self._clock():
+                del store[key]
+                return None
+            return value
 
-class Cluster1C:
-    def __init__(self, host, rac_client: RacClient, ras_port=1545):
+    def _set(self, store, host, ras_port, value):
+        with self._lock:
+            store[self._key(host, ras_port)] = (self._clock() + self.ttl, value)
+
+    def get_cluster_id(self, host, ras_port) -> Optional[str]:
+        return self._get(self._cluster_ids, host, ras_port)
+
+    def set_cluster_id(self, host, ras_port, cluster_id: str) -> None:
+        self._set(self._cluster_ids, host, ras_port, cluster_id)
+
+    def get_infobases(self, host, ras_port) -> Optional[Dict[str, str]]:
+        return self._get(self._infobases, host, ras_port)
+
+    def set_infobases(self, host, ras_port, infobases: Dict[str, str]) -> None:
+        self._set(self._infobases, host, ras_port, infobases)
+
+    def invalidate(self, host=None, ras_port=None) -> None:
+        """Сбрасывает кеш целиком или только для указанного сервера (и порта)."""
+        with self._lock:
+            for store in (self._cluster_ids, self._infobases):
+                if host is None:
+                    store.clear()
+                    continue
+                for key in list(store):
+                    if key[0] == host.lower() and (ras_port is None or key[1] == int(ras_port)):
+                        del store[key]
+
+
+rac_cache = RacCache()
+
+
+class BaseCluster1C:
+    """Общее для синхронного и асинхронного кластера: кеш, разбор ответов rac и команды.
+
+    Обращения к rac - только в наследниках, id кластера они получают до построения команд.
+    """
+
+    def __init__(self, host, rac_client, ras_port=1545, cache: Optional[RacCache] = None):
         self.rac_client = rac_client
         self.host = host
         self.port = ras_port
-        self.id = None
+        self.cache = cache
+        self.id = cache.get_cluster_id(host, ras_port) if cache else None
 
-    def _get_cluster_id(self) -> None:
-        rac_method = 'cluster list'
-        response = self.rac_client.get(rac_method, self.host, self.port)
-        self.id = response['cluster']
+    def _set_cluster_id(self, response) -> None:
+        if not response:
+            raise ChildProcessError(f'На сервере {self.host} не найден кластер 1С')
+        self.id = response[0]['cluster']
         logger.debug(f'cluster_id: {self.id}')
+        if self.cache:
+            self.cache.set_cluster_id(self.host, self.port, self.id)
 
-    def _get_infobases(self) -> Dict[str, str]:
-        rac_method = f'infobase summary list {self._cluster_suffix}'
-        infobases = self.rac_client.get(rac_method, self.host, self.port)
-        return {ib['name'].lower(): ib['infobase'] for ib in infobases}
+    def _get_cached_infobases(self, refresh=False) -> Optional[Dict[str, str]]:
+        if self.cache and not refresh:
+            return self.cache.get_infobases(self.host, self.port)
+        return None
 
-    def get_infobase(self, infobase_name: str, username: str, pwd: str) -> InfoBase:
-        infobases = self._get_infobases()
+    def _set_infobases(self, response) -> Dict[str, str]:
+        infobases = {ib['name'].lower(): ib['infobase'] for ib in response}
+        if self.cache:
+            self.cache.set_infobases(self.host, self.port, infobases)
+        return infobases
+
+    @staticmethod
+    def _parse_infobase(response) -> InfoBase:
+        if not response:
+            raise BDInvalidName('Неверное имя базы 1с.')
+        return InfoBase.parse_obj(response[0])
+
+    @staticmethod
+    def _check_infobase_id(infobases, infobase_name, ib_id):
         logger.debug(f'{infobases=}')
         logger.debug(f'{infobase_name=}')
-        ib_id = infobases.get(infobase_name)
         if not ib_id:
             raise BDInvalidName('Неверное имя базы 1с.')
 
-        rac_method = f'infobase info --infobase={ib_id} ' \
-                     f'--infobase-user="{username}" --infobase-pwd="{pwd}" {self._cluster_suffix}'
-        response = self.rac_client.get(rac_method, self.host, self.port)
-        return InfoBase.parse_obj(response)
-
     @property
     def _cluster_suffix(self):
         if not self.id:
-            self._get_cluster_id()
+            raise RuntimeError('id кластера 1С еще не получен')
         return f'--cluster={self.id}'
 
+    def _infobase_list_method(self):
+        return f'infobase summary list {self._cluster_suffix}'
+
+    def _infobase_info_method(self, ib_id, username, pwd):
+        return f'infobase info --infobase={ib_id} ' \
+               f'--infobase-user="{username}" --infobase-pwd="{pwd}" {self._cluster_suffix}'
+
+    def _session_list_method(self, infobase_id=None):
+        return f'session list {self._cluster_suffix}' + (f' --infobase={infobase_id}' if infobase_id else '')
+
+    def _connection_list_method(self, infobase_id=None):
+        return f'connection list {self._cluster_suffix}' + (f' --infobase={infobase_id}' if infobase_id else '')
+
+    def _session_terminate_method(self, session_id, message=None):
+        return f'session terminate {self._cluster_suffix} --session={session_id}' + \
+               (f' --error-message="{message}"' if message else '')
+
+    def _sessions_deny_method(self, ib_id, username, pwd, sessions_deny: str, scheduled_jobs_deny: str,
+                              message=None):
+        return f'infobase update --infobase={ib_id} --infobase-user="{username}" --infobase-pwd="{pwd}" ' \
+               f'--sessions-deny={sessions_deny} --scheduled-jobs-deny={scheduled_jobs_deny}' + \
+               (f' --denied-message="{message}"' if message else '') + f' {self._cluster_suffix}'
+
+
+class Cluster1C(BaseCluster1C):
+    """Кластер 1С поверх синхронного RacClient."""
+    rac_client: RacClient
+
+    def _get_cluster_id(self) -> None:
+        rac_method = 'cluster list'
+        response = self.rac_client.get(rac_method, self.host, self.port)
+        self._set_cluster_id(response)
+
+    def _ensure_cluster_id(self) -> None:
+        if not self.id:
+            self._get_cluster_id()
+
+    def _get_infobases(self, refresh=False) -> Dict[str, str]:
+        infobases = self._get_cached_infobases(refresh)
+        if infobases is not None:
+            return infobases
+
+        self._ensure_cluster_id()
+        return self._set_infobases(self.rac_client.get(self._infobase_list_method(), self.host, self.port))
+
+    def _find_infobase_id(self, infobase_name: str) -> Optional[str]:
+        # без кеша весь список не нужен: перебор прекращается на искомой базе
+        self._ensure_cluster_id()
+        record = self.rac_client.find(self._infobase_list_method(), self.host, self.port,
+                                      lambda ib: ib['name'].lower() == infobase_name)
+        return record['infobase'] if record else None
+
+    def get_infobase(self, infobase_name: str, username: str, pwd: str) -> InfoBase:
+        if self.cache:
+            infobases = self._get_infobases()
+            ib_id = infobases.get(infobase_name)
+            if not ib_id:
+                # в кеше может не оказаться только что созданной базы
+                ib_id = self._get_infobases(refresh=True).get(infobase_name)
+        else:
+            infobases = None
+            ib_id = self._find_infobase_id(infobase_name)
+        self._check_infobase_id(infobases, infobase_name, ib_id)
+
+        self._ensure_cluster_id()
+        response = self.rac_client.get(self._infobase_info_method(ib_id, username, pwd), self.host, self.port)
+        return self._parse_infobase(response)
+
+    def get_sessions(self, infobase_id=None) -> List[Session]:
+        """Сеансы кластера, infobase_id - только сеансы этой базы."""
+        self._ensure_cluster_id()
+        response = self.rac_client.get(self._session_list_method(infobase_id), self.host, self.port)
+        return [Session.parse_obj(record) for record in response]
+
+    def get_connections(self, infobase_id=None) -> List[Connection]:
+        self._ensure_cluster_id()
+        response = self.rac_client.get(self._connection_list_method(infobase_id), self.host, self.port)
+        return [Connection.parse_obj(record) for record in response]
+
+    def terminate_session(self, session_id, message=None) -> None:
+        self._ensure_cluster_id()
+        self.rac_client.get(self._session_terminate_method(session_id, message), self.host, self.port)
+
+    def set_sessions_deny(self, infobase: InfoBase, username, pwd, deny: bool, message=None) -> None:
+        """Запрещает (или разрешает) начало сеансов и регламентные задания базы."""
+        self._ensure_cluster_id()
+        value = 'on' if deny else 'off'
+        method = self._sessions_deny_method(infobase.id, username, pwd, value, value, message)
+        self.rac_client.get(method, self.host, self.port)
+
+
+class AsyncCluster1C(BaseCluster1C):
+    """Кластер 1С поверх AsyncRacClient: все обращения к rac выполняются в цикле событий."""
+    rac_client: AsyncRacClient
+
+    async def _get_cluster_id(self) -> None:
+        response = await self.rac_client.get('cluster list', self.host, self.port)
+        self._set_cluster_id(response)
+
+    async def _ensure_cluster_id(self) -> None:
+        if not self.id:
+            await self._get_cluster_id()
+
+    async def _get_infobases(self, refresh=False) -> Dict[str, str]:
+        infobases = self._get_cached_infobases(refresh)
+        if infobases is not None:
+            return infobases
+
+        await self._ensure_cluster_id()
+        return self._set_infobases(await self.rac_client.get(self._infobase_list_method(), self.host, self.port))
+
+    async def get_infobase(self, infobase_name: str, username: str, pwd: str) -> InfoBase:
+        infobases = await self._get_infobases()
+        ib_id = infobases.get(infobase_name)
+        if not ib_id and self.cache:
+            ib_id = (await self._get_infobases(refresh=True)).get(infobase_name)
+        self._check_infobase_id(infobases, infobase_name, ib_id)
+
+        await self._ensure_cluster_id()
+        response = await self.rac_client.get(self._infobase_info_method(ib_id, username, pwd), self.host, self.port)
+        return self._parse_infobase(response)
+
+    async def get_sessions(self, infobase_id=None) -> List[Session]:
+        await self._ensure_cluster_id()
+        response = await self.rac_client.get(self._session_list_method(infobase_id), self.host, self.port)
+        return [Session.parse_obj(record) for record in response]
+
+    async def get_connections(self, infobase_id=None) -> List[Connection]:
+        await self._ensure_cluster_id()
+        response = await self.rac_client.get(self._connection_list_method(infobase_id), self.host, self.port)
+        return [Connection.parse_obj(record) for record in response]
+
+    async def terminate_session(self, session_id, message=None) -> None:
+        await self._ensure_cluster_id()
+        await self.rac_client.get(self._session_terminate_method(session_id, message), self.host, self.port)
+
+    async def terminate_sessions(self, sessions: List[Session], message=None) -> int:
+        """Завершает сеансы одновременно (не больше max_concurrency вызовов rac), возвращает число завершенных.
+
+        Сеанс мог закончиться сам, пока завершались остальные, - такие ошибки только пишутся в лог.
+        """
+        await self._ensure_cluster_id()
+        results = await asyncio.gather(
+            *(self.terminate_session(session.id, message) for session in sessions), return_exceptions=True
+        )
+        terminated = 0
+        for session, result in zip(sessions, results):
+            if isinstance(result, ChildProcessError):
+                logger.warning(f'session {session.id} ({session.user_name}, {session.app_id}) '
+                               f'is not terminated: {result}')
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                terminated += 1
+        return terminated
+
+    async def set_sessions_deny(self, infobase: InfoBase, username, pwd, deny: bool, message=None) -> None:
+        await self._ensure_cluster_id()
+        value = 'on' if deny else 'off'
+        method = self._sessions_deny_method(infobase.id, username, pwd, value, value, message)
+        await self.rac_client.get(method, self.host, self.port)
+
+    async def restore_sessions_deny(self, infobase: InfoBase, username, pwd) -> None:
+        """Возвращает блокировки, которые были у базы до set_sessions_deny."""
+        await self._ensure_cluster_id()
+        method = self._sessions_deny_method(infobase.id, username, pwd, infobase.sessions_deny or 'off',
+                                            infobase.scheduled_jobs_deny or 'off', infobase.denied_message)
+        await self.rac_client.get(method, self.host, self.port)
+
 
 # todo покрыть тестом
 def parse_infobase_connection_string(conn_string):
@@ -113,7 +495,30 @@ def parse_infobase_connection_string(conn_string):
     return server_name, infobase_name
 
 
-def get_infobase(rac_client, con_str, ib_username, ib_user_pwd):
+def get_infobase(rac_client, con_str, ib_username, ib_user_pwd, cache: Optional[RacCache] = rac_cache):
+    host_name, infobase_name = parse_infobase_connection_string(con_str)
+    cluster = Cluster1C(host_name, rac_client, cache=cache)
+    try:
+        return cluster.get_infobase(infobase_name.lower(), ib_username, ib_user_pwd)
+    except ChildProcessError:
+        # кластер мог быть пересоздан, закешированный id больше не годится
+        if cache:
+            cache.invalidate(cluster.host, cluster.port)
+        raise
+
+
+def get_async_cluster(rac_client, con_str, cache: Optional[RacCache] = rac_cache) -> AsyncCluster1C:
+    """Кластер сервера 1С из строки подключения к базе."""
+    host_name, _ = parse_infobase_connection_string(con_str)
+    return AsyncCluster1C(host_name, rac_client, cache=cache)
+
+
+async def async_get_infobase(rac_client, con_str, ib_username, ib_user_pwd, cache: Optional[RacCache] = rac_cache):
     host_name, infobase_name = parse_infobase_connection_string(con_str)
-    cluster = Cluster1C(host_name, rac_client)
-    return cluster.get_infobase(infobase_name.lower(), ib_username, ib_user_pwd)
+    cluster = AsyncCluster1C(host_name, rac_client, cache=cache)
+    try:
+        return await cluster.get_infobase(infobase_name.lower(), ib_username, ib_user_pwd)
+    except ChildProcessError:
+        if cache:
+            cache.invalidate(cluster.host, cluster.port)
+        raise
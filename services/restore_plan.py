@@ -0,0 +1,126 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, root_validator, validator
+
+from services.restore_state import RecoveryMode
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    tomllib = None
+
+# код завершения задания плана: 0 - база восстановлена или уже актуальна
+EXIT_CODES = {'done': 0, 'current': 0, 'error': 1}
+
+
+class PlanJob(BaseModel):
+    """Один источник в один или несколько приемников; в файле target или targets."""
+    source: str
+    targets: List[str]
+    backup_date: Optional[str]
+
+    @root_validator(pre=True)
+    def single_target(cls, values):
+        target = values.pop('target', None)
+        if target is not None:
+            values['targets'] = [target, *values.get('targets', [])]
+        return values
+
+    @validator('targets')
+    def not_empty(cls, targets):
+        if not targets:
+            raise ValueError('не указаны базы приемники')
+        return targets
+
+
+class PlanOptions(BaseModel):
+    """Параметры восстановления для всего плана, как у задания restore; пусто - из настроек."""
+    snapshot: Optional[bool]
+    skip_if_current: Optional[bool]
+    logs: Optional[bool]
+    mode: Optional[str]
+    terminate_sessions: Optional[bool]
+    optimize: Optional[bool]
+
+    class Config:
+        extra = 'forbid'
+
+    @validator('mode')
+    def known_mode(cls, mode):
+        if mode is not None and mode not in RecoveryMode.all:
+            raise ValueError(f'неизвестный режим восстановления {mode}')
+        return mode
+
+
+class RestorePlan(BaseModel):
+    jobs: List[PlanJob]
+    # дата по умолчанию для заданий без backup_date, пусто - текущий момент
+    backup_date: Optional[str]
+    # сколько восстановлений выполняется одновременно во всем плане
+    max_workers: int = 4
+    max_per_server: Optional[int]
+    max_per_share: Optional[int]
+    options: PlanOptions = PlanOptions()
+
+    @root_validator(skip_on_failure=True)
+    def unique_targets(cls, values):
+        # иначе при max_per_server > 1 в одну базу одновременно пойдут два восстановления
+        sources: Dict[str, Tuple[str, Optional[str]]] = {}
+        for job in values['jobs']:
+            key = (job.source, job.backup_date or values.get('backup_date'))
+            for target in job.targets:
+                if sources.setdefault(target.lower(), key) != key:
+                    raise ValueError(f'база приемник {target} указана в плане для разных источников или дат')
+        return values
+
+    def get_sources(self, default_date: str) -> Dict[Tuple[str, str], List[str]]:
+        """Приемники по (источник, дата): бекапы каждого источника ищутся один раз на весь план."""
+        sources: Dict[Tuple[str, str], List[str]] = {}
+        for job in self.jobs:
+            key = (job.source, job.backup_date or self.backup_date or default_date)
+            targets = sources.setdefault(key, [])
+            targets.extend(target for target in job.targets if target not in targets)
+        return sources
+
+
+class PlanJobResult(BaseModel):
+    source: str
+    target: str
+    backup_date: str
+    status: str
+    exit_code: int
+    error: Optional[str]
+    wait_time: float = 0
+    duration: float = 0
+    phases: Dict[str, float] = {}
+
+
+def load_plan(path) -> RestorePlan:
+    """План из JSON или TOML (по расширению .toml)."""
+    if os.path.splitext(path)[1].lower() == '.toml':
+        if tomllib is None:
+            raise ValueError('Для плана в TOML нужен python 3.11 или новее, используйте JSON')
+        with open(path, 'rb') as f:
+            data = tomllib.load(f)
+    else:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    return RestorePlan.parse_obj(data)
+
+
+def get_exit_code(results: List[PlanJobResult]) -> int:
+    return max((result.exit_code for result in results), default=0)
+
+
+def get_summary(results: List[PlanJobResult], duration: float) -> dict:
+    statuses: Dict[str, int] = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    return {
+        'exit_code': get_exit_code(results),
+        'duration': round(duration, 3),
+        'statuses': statuses,
+        'jobs': [result.dict() for result in results],
+    }
@@ -0,0 +1,137 @@
+import datetime
+import logging
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from services.backup_catalog import BackupSet
+
+logger = logging.getLogger(__name__)
+
+
+class RecoveryMode:
+    """Состояние базы приемника после восстановления."""
+    recovery = 'recovery'
+    # "теплый" приемник: следующие обновления применяют только новые бекапы журнала
+    norecovery = 'norecovery'
+    standby = 'standby'
+
+    all = (recovery, norecovery, standby)
+    warm = (norecovery, standby)
+
+
+# последний примененный к базе бекап по истории восстановлений на сервере приемнике
+LAST_RESTORED_QUERY = '''
+SELECT TOP (1) bs.database_name, bs.type, bs.first_lsn, bs.last_lsn, bs.checkpoint_lsn, bs.backup_finish_date,
+       rh.restore_date, rh.stop_at, CAST(DATABASEPROPERTYEX(rh.destination_database_name, 'Status') AS nvarchar(60)),
+       CAST(DATABASEPROPERTYEX(rh.destination_database_name, 'IsInStandBy') AS int), rh.recovery
+FROM   msdb.dbo.restorehistory AS rh INNER JOIN msdb.dbo.backupset AS bs ON bs.backup_set_id = rh.backup_set_id
+WHERE  rh.destination_database_name = ?
+ORDER BY rh.restore_history_id DESC'''
+
+
+class RestoredBackup(BaseModel):
+    database_name: str
+    type: str
+    first_lsn: Optional[int]
+    last_lsn: Optional[int]
+    checkpoint_lsn: Optional[int]
+    backup_finish_date: datetime.datetime
+    restore_date: datetime.datetime
+    stop_at: Optional[datetime.datetime]
+    status: Optional[str]
+    standby: bool = False
+    # последнее записанное восстановление было WITH RECOVERY
+    recovery: bool = True
+
+    @property
+    def restored_to(self) -> datetime.datetime:
+        return self.stop_at or self.backup_finish_date
+
+    @property
+    def is_warm(self) -> bool:
+        """База ждет следующих бекапов журнала: RESTORING после NORECOVERY или только чтение после STANDBY.
+
+        Прерванное полное восстановление тоже оставляет базу в RESTORING, но в restorehistory его нет - последняя
+        запись остается от прошлого восстановления WITH RECOVERY, и накатывать на такую базу нечего.
+        """
+        return not self.recovery and (self.status == 'RESTORING' or self.standby)
+
+    def matches(self, backup_set: BackupSet, stop_at: Optional[datetime.datetime] = None) -> bool:
+        """Тот же бекап и, для журнала, тот же момент STOPAT внутри него."""
+        return (
+            self.database_name.lower() == backup_set.database_name.lower()
+            and self.type == backup_set.type
+            and self.last_lsn == backup_set.last_lsn
+            and self.checkpoint_lsn == backup_set.checkpoint_lsn
+            and get_stop_point(self.stop_at, self.backup_finish_date)
+            == get_stop_point(stop_at, backup_set.backup_finish_date)
+        )
+
+
+def get_stop_point(stop_at: Optional[datetime.datetime], backup_finish_date) -> Optional[datetime.datetime]:
+    """STOPAT внутри бекапа; None - бекап применен до конца, как и STOPAT на его конец или позже."""
+    if stop_at is None or stop_at >= backup_finish_date:
+        return None
+    return stop_at
+
+
+def get_last_restored(conn, db_name) -> Optional[RestoredBackup]:
+    cursor = conn.cursor()
+    cursor.execute(LAST_RESTORED_QUERY, db_name)
+    row = cursor.fetchone()
+    if not row:
+        return None
+    (database_name, backup_type, first_lsn, last_lsn, checkpoint_lsn, backup_finish_date, restore_date, stop_at,
+     status, standby, recovery) = row
+    return RestoredBackup(
+        database_name=database_name,
+        type=backup_type,
+        first_lsn=int(first_lsn) if first_lsn is not None else None,
+        last_lsn=int(last_lsn) if last_lsn is not None else None,
+        checkpoint_lsn=int(checkpoint_lsn) if checkpoint_lsn is not None else None,
+        backup_finish_date=backup_finish_date,
+        restore_date=restore_date,
+        stop_at=stop_at,
+        status=status,
+        standby=bool(standby),
+        recovery=bool(recovery)
+    )
+
+
+def is_current(restored: Optional[RestoredBackup], last_backup: BackupSet,
+               stop_at: Optional[datetime.datetime] = None) -> bool:
+    """База приемник восстановлена из того же бекапа, который выбран сейчас (с тем же STOPAT), и доступна."""
+    if restored is None:
+        return False
+    # после прерванного восстановления база остается в RESTORING
+    if restored.status != 'ONLINE' or restored.standby:
+        return False
+    return restored.matches(last_backup, stop_at)
+
+
+def can_roll_forward(restored: Optional[RestoredBackup], source_db) -> bool:
+    """К базе приемнику можно применить только новые бекапы журнала вместо полного восстановления."""
+    return bool(restored) and restored.is_warm and restored.database_name.lower() == source_db.lower()
+
+
+def get_log_chain_start(restored: RestoredBackup) -> Tuple[Optional[int], datetime.datetime]:
+    """LSN и дата бекапа, после которых искать бекапы журнала для наката на базу приемник.
+
+    После STOPAT последний бекап журнала применен не до конца, а last_lsn в restorehistory - его конец:
+    следующий бекап SQL Server отвергнет как слишком новый, поэтому накат начинается с этого же бекапа.
+    """
+    if restored.stop_at and restored.type == 'L':
+        # log_chain берет бекапы, законченные строго позже after
+        return restored.first_lsn, restored.backup_finish_date - datetime.timedelta(seconds=1)
+    return restored.last_lsn, restored.backup_finish_date
+
+
+def get_roll_forward(restored: RestoredBackup, logs: List[BackupSet]) -> Optional[List[BackupSet]]:
+    """Бекапы журнала, продолжающие базу приемник с ее LSN; None - цепочка не продолжается."""
+    if not logs:
+        return []
+    first = logs[0]
+    if first.first_lsn is None or restored.last_lsn is None or first.first_lsn > restored.last_lsn:
+        return None
+    return logs
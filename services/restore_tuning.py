@@ -0,0 +1,88 @@
+import logging
+from typing import Optional, Tuple
+
+from pydantic import BaseModel, validator
+
+logger = logging.getLogger(__name__)
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+MAX_TRANSFER_SIZE_LIMIT = 4 * MB
+BUFFER_COUNT_LIMIT = 512
+# доля свободной памяти сервера, которую можно отдать под буферы RESTORE
+BUFFERS_MEMORY_SHARE = 0.1
+
+
+class RestoreTuning(BaseModel):
+    """Параметры ввода-вывода RESTORE. Пустое значение - оставить выбор SQL Server."""
+    profile: str = 'default'
+    buffer_count: Optional[int]
+    max_transfer_size: Optional[int]
+    block_size: Optional[int]
+
+    @validator('profile')
+    def check_profile(cls, value):
+        if value not in ('default', 'auto', 'manual'):
+            raise ValueError(f'unknown restore tuning profile {value}')
+        return value
+
+    @validator('max_transfer_size')
+    def check_max_transfer_size(cls, value):
+        if value is not None and (value % (64 * KB) or not 64 * KB <= value <= MAX_TRANSFER_SIZE_LIMIT):
+            raise ValueError('MAXTRANSFERSIZE must be a multiple of 64 KB up to 4 MB')
+        return value
+
+    @validator('block_size')
+    def check_block_size(cls, value):
+        if value is not None and (value & (value - 1) or not 512 <= value <= 64 * KB):
+            raise ValueError('BLOCKSIZE must be a power of 2 from 512 to 65536')
+        return value
+
+    def get_options(self) -> str:
+        """Опции для WITH, с завершающей запятой, чтобы подставлять перед остальными."""
+        options = {
+            'BUFFERCOUNT': self.buffer_count,
+            'MAXTRANSFERSIZE': self.max_transfer_size,
+            'BLOCKSIZE': self.block_size,
+        }
+        return ''.join(f'{name} = {value}, ' for name, value in options.items() if value)
+
+
+def auto_tuning(backup_size: Optional[int], cpu_count: int, available_memory: int, devices: int = 1) -> RestoreTuning:
+    """Подбирает BUFFERCOUNT и MAXTRANSFERSIZE по размеру бекапа, числу файлов и ресурсам сервера приемника."""
+    if not backup_size or backup_size < GB:
+        # на маленьких бекапах выигрыша нет
+        return RestoreTuning(profile='auto')
+
+    max_transfer_size = MAX_TRANSFER_SIZE_LIMIT if backup_size >= 10 * GB else 2 * MB
+    # каждому файлу набора - свои буферы, чтобы чтение полос шло параллельно
+    buffer_count = max(max(cpu_count, 1) * 4, devices * 8)
+    memory_limit = int(available_memory * BUFFERS_MEMORY_SHARE) // max_transfer_size
+    buffer_count = max(2, min(buffer_count, memory_limit, BUFFER_COUNT_LIMIT))
+    return RestoreTuning(profile='auto', buffer_count=buffer_count, max_transfer_size=max_transfer_size)
+
+
+def get_server_resources(conn) -> Tuple[int, int]:
+    """Число процессоров и свободная физическая память (байт) сервера SQL."""
+    cursor = conn.cursor()
+    cursor.execute('''
+SELECT si.cpu_count, sm.available_physical_memory_kb
+FROM   sys.dm_os_sys_info AS si CROSS JOIN sys.dm_os_sys_memory AS sm''')
+    cpu_count, available_memory_kb = cursor.fetchone()
+    return cpu_count, available_memory_kb * KB
+
+
+def get_restore_tuning(conn, profile='default', backup_size=None, devices=1, buffer_count=None,
+                       max_transfer_size=None, block_size=None) -> RestoreTuning:
+    if profile == 'auto':
+        tuning = auto_tuning(backup_size, *get_server_resources(conn), devices=devices)
+    else:
+        tuning = RestoreTuning(profile=profile)
+
+    # явно заданные значения важнее подобранных
+    explicit = {'buffer_count': buffer_count, 'max_transfer_size': max_transfer_size, 'block_size': block_size}
+    tuning = RestoreTuning(**{**tuning.dict(), **{name: value for name, value in explicit.items() if value}})
+    logger.debug(f'restore tuning: {tuning}')
+    return tuning
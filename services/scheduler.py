@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import math
+import ntpath
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, List, Optional
+
+
+def get_share(path: str) -> str:
+    """Сетевая папка (\\\\host\\share) или диск, на котором лежит файл бекапа."""
+    drive, _ = ntpath.splitdrive(path)
+    return (drive or ntpath.dirname(path)).lower()
+
+
+class Admission:
+    """Восстановление на сервере приемнике: size - байт бекапов, duration - прогноз длительности, секунд."""
+
+    def __init__(self, size: int = 0, duration: Optional[float] = None):
+        self.size = size
+        self.duration = duration
+        self.started: Optional[float] = None
+        self.future: Optional[asyncio.Future] = None
+
+
+class ServerQueue:
+    """Допуск восстановлений на один сервер приемник: не больше max_jobs одновременно и не больше max_bytes
+    бекапов в работе.
+
+    Очередь строго по порядку: маленькие бекапы не обгоняют большой, иначе он может ждать бесконечно.
+    Бекап больше max_bytes допускается на свободный сервер.
+    """
+
+    def __init__(self, max_jobs: int = 1, max_bytes: Optional[int] = None, clock=time.monotonic):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self.active: List[Admission] = []
+        self.waiting: Deque[Admission] = deque()
+
+    @property
+    def bytes_in_use(self) -> int:
+        return sum(admission.size for admission in self.active)
+
+    def _fits(self, size: int, jobs: int, bytes_in_use: int) -> bool:
+        if jobs >= self.max_jobs:
+            return False
+        return not self.max_bytes or not jobs or bytes_in_use + size <= self.max_bytes
+
+    def predict_start(self, size: int = 0, duration: Optional[float] = None,
+                      admission: Optional[Admission] = None) -> Optional[float]:
+        """Через сколько секунд начнется admission из очереди или новое восстановление размером size.
+
+        Восстановления в работе и впереди в очереди завершаются по своим прогнозам; None - у кого-то из них
+        прогноза нет.
+        """
+        now = self._clock()
+        if admission is None:
+            admission = Admission(size, duration)
+            ahead = [*self.waiting, admission]
+        else:
+            ahead = list(self.waiting)[:self.waiting.index(admission) + 1]
+
+        # (время завершения, размер) восстановлений, занимающих сервер; без прогноза - в конце
+        ends = [(max(item.started + item.duration, now) if item.duration is not None else math.inf, item.size)
+                for item in self.active]
+        heapq.heapify(ends)
+        jobs, bytes_in_use, start = len(self.active), self.bytes_in_use, now
+        for item in ahead:
+            while not self._fits(item.size, jobs, bytes_in_use):
+                end, size = heapq.heappop(ends)
+                if end == math.inf:
+                    return None
+                start, jobs, bytes_in_use = max(start, end), jobs - 1, bytes_in_use - size
+            if item is admission:
+                return start - now
+            heapq.heappush(ends, (start + item.duration if item.duration is not None else math.inf, item.size))
+            jobs, bytes_in_use = jobs + 1, bytes_in_use + item.size
+        return None
+
+    async def acquire(self, admission: Admission,
+                      on_wait: Optional[Callable[[Optional[float]], None]] = None) -> None:
+        if not self.waiting and self._fits(admission.size, len(self.active), self.bytes_in_use):
+            self._admit(admission)
+            return
+
+        admission.future = asyncio.get_running_loop().create_future()
+        self.waiting.append(admission)
+        if on_wait:
+            on_wait(self.predict_start(admission=admission))
+        try:
+            await admission.future
+        except asyncio.CancelledError:
+            if admission in self.waiting:
+                self.waiting.remove(admission)
+                self._wake()
+            elif admission in self.active:
+                # допущено, но задание отменили раньше, чем оно продолжилось
+                self.release(admission)
+            raise
+
+    def release(self, admission: Admission) -> None:
+        self.active.remove(admission)
+        self._wake()
+
+    def _admit(self, admission: Admission) -> None:
+        admission.started = self._clock()
+        self.active.append(admission)
+
+    def _wake(self) -> None:
+        while self.waiting:
+            admission = self.waiting[0]
+            if admission.future.done():
+                # ожидание отменено, но обработчик отмены еще не выполнился - не допускаем
+                self.waiting.popleft()
+                continue
+            if not self._fits(admission.size, len(self.active), self.bytes_in_use):
+                break
+            self.waiting.popleft()
+            self._admit(admission)
+            admission.future.set_result(None)
+
+
+class RestoreScheduler:
+    """Ограничивает восстановления на один сервер приемник (число и суммарный размер бекапов) и число
+    восстановлений с одной папки бекапов."""
+
+    def __init__(self, max_per_server: int = 1, max_per_share: int = 2, max_bytes_per_server: Optional[int] = None):
+        self.max_per_server = max_per_server
+        self.max_per_share = max_per_share
+        self.max_bytes_per_server = max_bytes_per_server
+        self._servers: Dict[str, ServerQueue] = {}
+        self._share_slots: Dict[str, asyncio.Semaphore] = {}
+
+    def configure(self, max_per_server: int, max_per_share: int, max_bytes_per_server: Optional[int] = None) -> None:
+        # действует на серверы и папки, по которым еще не было восстановлений
+        self.max_per_server = max_per_server
+        self.max_per_share = max_per_share
+        self.max_bytes_per_server = max_bytes_per_server
+
+    @staticmethod
+    def _get_semaphore(slots: Dict[str, asyncio.Semaphore], key: str, limit: int) -> asyncio.Semaphore:
+        semaphore = slots.get(key)
+        if semaphore is None:
+            semaphore = slots[key] = asyncio.Semaphore(limit)
+        return semaphore
+
+    def _get_server(self, server: str) -> ServerQueue:
+        queue = self._servers.get(server.lower())
+        if queue is None:
+            queue = self._servers[server.lower()] = ServerQueue(self.max_per_server, self.max_bytes_per_server)
+        return queue
+
+    def predict_start(self, server: str, size: int = 0, duration: Optional[float] = None) -> Optional[float]:
+        """Через сколько секунд сервер примет восстановление размером size, None - неизвестно."""
+        return self._get_server(server).predict_start(size, duration)
+
+    @asynccontextmanager
+    async def slot(self, server: str, backup_path: str):
+        # всегда сначала сервер, потом папка - одинаковый порядок захвата исключает взаимную блокировку
+        async with self.server_slot(server), self.share_slot(backup_path):
+            yield
+
+    @asynccontextmanager
+    async def server_slot(self, server: str, size: int = 0, duration: Optional[float] = None,
+                          on_wait: Optional[Callable[[Optional[float]], None]] = None):
+        """Только ограничение на сервер - для операций без файлов бекапа.
+
+        size и duration - размер бекапов и прогноз длительности; on_wait(start_in) вызывается, если
+        восстановление встало в очередь, start_in - через сколько секунд ожидается начало.
+        """
+        queue = self._get_server(server)
+        admission = Admission(size, duration)
+        await queue.acquire(admission, on_wait)
+        try:
+            yield
+        finally:
+            queue.release(admission)
+
+    @asynccontextmanager
+    async def share_slot(self, backup_path: str):
+        """Ограничение на папку бекапов; захватывается только внутри server_slot."""
+        async with self._get_semaphore(self._share_slots, get_share(backup_path), self.max_per_share):
+            yield
+
+
+restore_scheduler = RestoreScheduler()
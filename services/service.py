@@ -2,111 +2,847 @@ import asyncio
 import datetime
 import logging
 import os.path
+import time
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from typing import Dict, List, Optional, Tuple
 
 import dateutil.parser as dt_parser
-from anyio import to_thread
+import pyodbc
+from anyio import CancelScope, CapacityLimiter, create_task_group, to_thread
+from pydantic import BaseModel
 
-from services.rac_tools import get_infobase, RacClient
+from services.backup_catalog import BackupSet, RestoreChain, get_backup_catalog
+from services.estimate import RestoreEstimate, describe_start, estimate_restore
+from services.exceptions import BDInvalidName, BackupFilesError, ConnectionPoolTimeout, SnapshotNotFound
+from services.metrics import PhaseTimer, RestoreHistory, RestoreRun, get_restore_history
+from services.progress import ProgressEvent, RestoreProgress
+from services.rac_tools import AsyncRacClient, InfoBase, async_get_infobase, get_async_cluster
+from services.restore_state import (
+    RecoveryMode,
+    RestoredBackup,
+    can_roll_forward,
+    get_last_restored,
+    get_log_chain_start,
+    get_roll_forward,
+    is_current
+)
+from services.post_restore import PostRestoreOptions, run_post_restore
+from services.restore_plan import EXIT_CODES, PlanJobResult, RestorePlan
+from services.restore_tuning import RestoreTuning, get_restore_tuning
+from services.scheduler import RestoreScheduler, get_share, restore_scheduler
+from services.snapshots import (
+    Snapshot,
+    create_snapshot,
+    drop_snapshots,
+    get_revert_script,
+    get_revert_snapshot,
+    list_snapshots
+)
+from services.staging import GB, MB, StagingError, get_staging_cache
 from services.sql_tools import (
     SQLServer,
-    BackupType,
-    get_backup_path,
     get_connection,
-    prepare_sql_query_for_restore,
+    get_restore_chain,
+    prepare_restore_steps,
+    prepare_roll_forward_steps,
     get_nextset
 )
+from services.worker import run_in_worker
 
 logger = logging.getLogger(__name__)
 
+# ошибки одного приемника, которые не прерывают восстановление остальных
+RESTORE_ERRORS = (ChildProcessError, BDInvalidName, FileNotFoundError, ValueError, BackupFilesError,
+                  ConnectionPoolTimeout, StagingError, SnapshotNotFound, pyodbc.Error)
+
+
+class SourceBackups(BaseModel):
+    infobase: InfoBase
+    chain: RestoreChain
+    # на какой момент восстановить базу
+    as_of: datetime.datetime
+    full_backup_paths: List[str]
+    diff_backup_paths: List[str] = []
+    log_backups: List[BackupSet] = []
+    log_backup_paths: List[List[str]] = []
+    phases: Dict[str, float] = {}
+
+    @property
+    def last_backup(self) -> BackupSet:
+        """Бекап, которым закончится восстановление."""
+        if self.log_backups:
+            return self.log_backups[-1]
+        return self.chain.diff if self.diff_backup_paths else self.chain.full
+
+    @property
+    def backup_sets(self) -> List[BackupSet]:
+        """Бекапы полного восстановления: полный, диф, если его файлы доступны, и журнал."""
+        return [self.chain.full] + ([self.chain.diff] if self.diff_backup_paths else []) + self.log_backups
+
+    @property
+    def stop_at(self) -> Optional[datetime.datetime]:
+        # STOPAT позже конца журнала оставляет базу невосстановленной, поэтому только внутри последнего бекапа
+        if self.log_backups and self.log_backups[-1].backup_finish_date >= self.as_of:
+            return self.as_of
+        return None
+
+    @property
+    def backup_date(self) -> datetime.datetime:
+        return self.stop_at or self.last_backup.backup_finish_date
+
+    def roll_forward(self, log_backups: List[BackupSet]) -> 'SourceBackups':
+        """Только бекапы журнала - для "теплой" базы приемника."""
+        return self.copy(update={
+            'full_backup_paths': [],
+            'diff_backup_paths': [],
+            'log_backups': log_backups,
+            'log_backup_paths': [log.devices for log in log_backups],
+        })
+
+
+class RestoreResult(BaseModel):
+    target: str
+    receiver_server: Optional[str]
+    receiver_db: Optional[str]
+    status: str = 'done'
+    error: Optional[str]
+    tuning: Optional[RestoreTuning]
+    wait_time: float = 0
+    duration: float = 0
+    phases: Dict[str, float] = {}
+    snapshot: Optional[str]
+    # размер примененных бекапов: при накате журнала это только бекапы журнала
+    backup_size: Optional[int]
+    compressed_backup_size: Optional[int]
+    estimate: Optional[RestoreEstimate]
+
+
+class PrefixedQueue:
+    """Добавляет имя базы приемника к сообщениям, когда в очередь пишут несколько восстановлений."""
+
+    def __init__(self, queue, prefix):
+        self.queue = queue
+        self.prefix = prefix
+
+    def put_nowait(self, msg):
+        if isinstance(msg, ProgressEvent):
+            self.queue.put_nowait(msg.copy(update={'target': self.prefix}))
+        else:
+            self.queue.put_nowait(f'[{self.prefix}] {msg}')
+
+
+class NullQueue:
+    """Сообщения никому не нужны, например при оценке восстановления до его запуска."""
+
+    def put_nowait(self, msg):
+        pass
+
 
 def put_log_msg(queue, msg):
     queue.put_nowait(msg)
     logger.debug(f'submit message: {msg}')
 
 
-async def async_do_restore(messages_queue, source_path, target_path, raw_backup_date, settings):
-    log_msg = 'START!'
-    put_log_msg(messages_queue, log_msg)
-    await asyncio.sleep(0)
+def get_missing_files(paths: List[str]) -> List[str]:
+    return [path for path in paths if not os.path.exists(path)]
+
+
+def describe_error(exc: Exception) -> str:
+    if isinstance(exc, pyodbc.OperationalError):
+        return 'Сервер не найден или недоступен. Операция прервана!'
+    if isinstance(exc, BackupFilesError):
+        return 'Не удалось найти пути файлов бекапов. Операция прервана!'
+    if isinstance(exc, pyodbc.ProgrammingError):
+        return 'БД приемник недоступна. Операция прервана!'
+    if isinstance(exc, ConnectionPoolTimeout):
+        return 'Нет свободных соединений с сервером SQL. Операция прервана!'
+    if isinstance(exc, SnapshotNotFound):
+        return f'{exc}. Операция прервана!'
+    return f'Что-то пошло не так \n {str(exc)}'
+
+
+def get_rac_client(settings) -> AsyncRacClient:
+    return AsyncRacClient(
+        exe_path=settings.rac_path,
+        timeout=settings.rac_timeout,
+        max_concurrency=settings.rac_max_concurrency
+    )
+
+
+async def async_get_restore_points(source_path, settings, limit=50, rac_client: Optional[AsyncRacClient] = None):
+    rac_client = rac_client or get_rac_client(settings)
+    source_infobase = await async_get_infobase(rac_client, source_path, settings.ib_username, settings.ib_user_pwd)
+    catalog = get_backup_catalog(settings.backup_catalog_path, settings.backup_catalog_max_age)
+    source_sql_server = SQLServer(server=source_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
 
+    def get_restore_points(channel):
+        if not catalog.is_fresh(source_sql_server.server, source_infobase.db_name):
+            with get_connection(source_sql_server) as conn:
+                catalog.sync(conn, source_sql_server.server, [source_infobase.db_name])
+        return catalog.restore_points(source_sql_server.server, source_infobase.db_name, limit)
+
+    return await run_in_worker(get_restore_points, name=f'restore_points {source_path}')
+
+
+def get_available_logs(logs: List[BackupSet]) -> List[BackupSet]:
+    """Бекапы журнала до первого недоступного файла: после разрыва цепочки применять нечего."""
+    available = []
+    for log in logs:
+        if get_missing_files(log.devices):
+            logger.debug(f'Нет файла бекапа журнала {log.devices}')
+            break
+        available.append(log)
+    return available
+
+
+def use_log_backups(settings) -> bool:
+    return settings.restore_logs or settings.restore_mode in RecoveryMode.warm
+
+
+def find_source_backups(messages_queue, catalog, source_sql_server: SQLServer, db_name, backup_date,
+                        timer: PhaseTimer, with_logs=False) -> Tuple[RestoreChain, List[str], List[BackupSet]]:
+    """Цепочка бекапов и доступные файлы диф бекапа и журнала. Выполняется в рабочем потоке."""
+    with timer.span('msdb'):
+        chain = get_restore_chain(catalog, source_sql_server, db_name, backup_date)
+    with timer.span('check_files'):
+        missing = get_missing_files(chain.full.devices)
+        if missing:
+            raise FileNotFoundError(f'Файлы бекапа не найдены: {", ".join(missing)}')
+
+        diff_backup_paths = []
+        if chain.diff and not get_missing_files(chain.diff.devices):
+            diff_backup_paths = chain.diff.devices
+        else:
+            logger.debug('Нет файла диф бекапа')
+
+        log_backups = []
+        # журнал продолжает диф бекап цепочки, без него не применяется
+        if with_logs and (diff_backup_paths or not chain.diff):
+            log_backups = get_available_logs(chain.logs)
+    return chain, diff_backup_paths, log_backups
+
+
+async def async_list_snapshots(target_path, settings, rac_client: Optional[AsyncRacClient] = None) -> List[Snapshot]:
+    rac_client = rac_client or get_rac_client(settings)
+    receiver_infobase = await async_get_infobase(rac_client, target_path, settings.ib_username, settings.ib_user_pwd)
+    target_sql_server = SQLServer(server=receiver_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
+
+    def get_snapshots(channel):
+        with get_connection(target_sql_server) as conn:
+            return list_snapshots(conn, receiver_infobase.db_name)
+
+    return await run_in_worker(get_snapshots, name=f'snapshots {target_path}')
+
+
+async def async_resolve_source(messages_queue, rac_client, source_path, raw_backup_date, settings) -> SourceBackups:
+    timer = PhaseTimer()
     messages_queue.put_nowait('Получение информации о базе источнике')
     await asyncio.sleep(0)
 
-    rac_client = RacClient(exe_path=settings.rac_path)
-    source_infobase = await to_thread.run_sync(get_infobase, rac_client, source_path, settings.ib_username,
-                                               settings.ib_user_pwd)
+    with timer.span('rac_source'):
+        source_infobase = await async_get_infobase(rac_client, source_path, settings.ib_username,
+                                                   settings.ib_user_pwd)
     log_msg = f'база источник: {source_infobase}'
     put_log_msg(messages_queue, log_msg)
-    await asyncio.sleep(0)
-
-    messages_queue.put_nowait('Получение информации о базе приемнике')
-    await asyncio.sleep(0)
-    receiver_infobase = await to_thread.run_sync(get_infobase, rac_client, target_path, settings.ib_username,
-                                                 settings.ib_user_pwd)
-    log_msg = f'база приемник: {receiver_infobase}'
-    put_log_msg(messages_queue, log_msg)
-    await asyncio.sleep(0)
 
     log_msg = f'Получение путей файлов бекапа для базы: {source_infobase.db_name}'
     put_log_msg(messages_queue, log_msg)
     await asyncio.sleep(0)
 
     backup_date = dt_parser.parse(raw_backup_date)
-    diff_backup_date = None
+    catalog = get_backup_catalog(settings.backup_catalog_path, settings.backup_catalog_max_age)
     source_sql_server = SQLServer(server=source_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
-    with get_connection(source_sql_server) as source_conn:
-        full_backup_path, full_backup_date = await to_thread.run_sync(
-            get_backup_path,
-            source_conn,
-            source_infobase.db_name,
-            BackupType.full,
-            backup_date
-        )
-        diff_backup_path, diff_backup_date = await to_thread.run_sync(
-            get_backup_path,
-            source_conn,
-            source_infobase.db_name,
-            BackupType.diff,
-            backup_date
-        )
-        if not os.path.exists(diff_backup_path):
-            logger.debug('Нет файла диф бекапа')
-            diff_backup_path = None
-            diff_backup_date = datetime.datetime(2000,1,1)
-        logger.debug(f'{full_backup_path=} {full_backup_date=}')
-        logger.debug(f'{diff_backup_path=} {diff_backup_date=}')
-    await asyncio.sleep(0)
+    chain, diff_backup_paths, log_backups = await run_in_worker(
+        find_source_backups,
+        catalog,
+        source_sql_server,
+        source_infobase.db_name,
+        backup_date,
+        timer,
+        use_log_backups(settings),
+        messages_queue=messages_queue,
+        name=f'source {source_infobase.db_name}'
+    )
+    source = SourceBackups(
+        infobase=source_infobase,
+        chain=chain,
+        as_of=backup_date,
+        full_backup_paths=chain.full.devices,
+        diff_backup_paths=diff_backup_paths,
+        log_backups=log_backups,
+        log_backup_paths=[log.devices for log in log_backups],
+        phases=timer.phases
+    )
+    logger.debug(f'{source.full_backup_paths=} {source.diff_backup_paths=}')
 
-    backup_date = max(full_backup_date, diff_backup_date)
-    log_msg = f'\nБаза будет восстановлена на  {backup_date.strftime("%H:%M:%S %d.%m.%Y")}\n'
+    log_msg = f'\nБаза будет восстановлена на  {source.backup_date.strftime("%H:%M:%S %d.%m.%Y")}\n'
     put_log_msg(messages_queue, log_msg)
+    return source
+
+
+@contextmanager
+def staged_backups(messages_queue, source: SourceBackups, receiver_server, settings,
+                   timer: Optional[PhaseTimer] = None):
+    """Подменяет пути бекапов на локальные копии рядом с сервером приемником, если задан staging_dir."""
+    if not settings.staging_dir:
+        yield source
+        return
 
+    cache = get_staging_cache(
+        settings.staging_dir.format(server=receiver_server),
+        settings.staging_budget_gb * GB,
+        settings.staging_chunk_mb * MB,
+        settings.staging_workers
+    )
+    put_log_msg(messages_queue, f'Копирование бекапа в {cache.directory}')
+    timer = timer or PhaseTimer()
+    staged = []
+    with timer.span('staging'):
+        try:
+            for paths in [source.full_backup_paths, source.diff_backup_paths, *source.log_backup_paths]:
+                staged.append(cache.acquire(paths))
+        except BaseException:
+            for staged_paths in staged:
+                cache.release(staged_paths)
+            raise
+    put_log_msg(messages_queue, f'Бекап скопирован за {timer.phases["staging"]:.0f} с')
+    try:
+        yield source.copy(update={
+            'full_backup_paths': staged[0],
+            'diff_backup_paths': staged[1],
+            'log_backup_paths': staged[2:],
+        })
+    finally:
+        for staged_paths in staged:
+            cache.release(staged_paths)
+
+
+def get_receiver_state(messages_queue, receiver_infobase: InfoBase, settings) -> Optional[RestoredBackup]:
     target_sql_server = SQLServer(server=receiver_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
     with get_connection(target_sql_server) as receiver_conn:
-        script = await to_thread.run_sync(
-            prepare_sql_query_for_restore,
-            receiver_conn,
-            full_backup_path,
-            receiver_infobase.db_name,
-            diff_backup_path,
-        )
-        log_msg = f'Начало восстановления {source_infobase.db_name} ===> {receiver_infobase.db_name}'
-        put_log_msg(messages_queue, log_msg)
+        return get_last_restored(receiver_conn, receiver_infobase.db_name)
+
+
+def find_roll_forward(source: SourceBackups, receiver_infobase: InfoBase, settings) -> Optional[List[BackupSet]]:
+    """Бекапы журнала для наката на "теплую" базу приемник; None - нужно полное восстановление."""
+    target_sql_server = SQLServer(server=receiver_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
+    with get_connection(target_sql_server) as receiver_conn:
+        restored = get_last_restored(receiver_conn, receiver_infobase.db_name)
+    if not can_roll_forward(restored, source.infobase.db_name) or source.as_of < restored.restored_to:
+        return None
+
+    catalog = get_backup_catalog(settings.backup_catalog_path, settings.backup_catalog_max_age)
+    logs = catalog.log_chain(source.infobase.db_server, source.infobase.db_name, *get_log_chain_start(restored),
+                             source.as_of)
+    return get_roll_forward(restored, get_available_logs(logs))
+
 
-        await asyncio.sleep(0)
+def restore_backups(messages_queue, source: SourceBackups, receiver_infobase: InfoBase, settings, timer: PhaseTimer,
+                    result: RestoreResult) -> None:
+    """Копирование бекапа и RESTORE на сервере приемнике. Выполняется в рабочем потоке задания,
+    messages_queue - канал в цикл событий."""
+    target_sql_server = SQLServer(server=receiver_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
+    mode = settings.restore_mode
+
+    roll_forward = None
+    if use_log_backups(settings):
+        with timer.span('check_warm'):
+            roll_forward = find_roll_forward(source, receiver_infobase, settings)
+    if roll_forward is not None:
+        if not roll_forward and mode != RecoveryMode.recovery:
+            result.status = 'current'
+            put_log_msg(messages_queue, 'Новых бекапов журнала нет, база уже актуальна')
+            return
+        source = source.roll_forward(roll_forward)
+        put_log_msg(messages_queue, f'Накат {len(roll_forward)} бекапов журнала на базу {receiver_infobase.db_name}')
+
+    backup_sets = source.backup_sets if roll_forward is None else source.log_backups
+    result.backup_size = sum(backup_set.backup_size or 0 for backup_set in backup_sets)
+    result.compressed_backup_size = sum(backup_set.compressed_backup_size or 0 for backup_set in backup_sets)
+    backup_sizes = {
+        'full': source.chain.full.backup_size,
+        'diff': source.chain.diff.backup_size if source.chain.diff else None,
+    }
+    log_sizes = iter([log.backup_size for log in source.log_backups])
+
+    with staged_backups(messages_queue, source, receiver_infobase.db_server, settings, timer) as backups, \
+            get_connection(target_sql_server) as receiver_conn:
+        with timer.span('prepare'):
+            result.tuning = get_restore_tuning(
+                receiver_conn,
+                backup_size=source.chain.full.backup_size if roll_forward is None else result.backup_size,
+                devices=len(source.full_backup_paths) or 1,
+                **settings.restore_tuning_options()
+            )
+            put_log_msg(messages_queue, f'Параметры восстановления: {result.tuning}')
+            if roll_forward is None:
+                steps = prepare_restore_steps(
+                    receiver_conn,
+                    backups.full_backup_paths,
+                    receiver_infobase.db_name,
+                    backups.diff_backup_paths,
+                    result.tuning,
+                    backups.log_backup_paths,
+                    mode,
+                    source.stop_at,
+                )
+            else:
+                steps = prepare_roll_forward_steps(
+                    receiver_conn,
+                    receiver_infobase.db_name,
+                    backups.log_backup_paths,
+                    result.tuning,
+                    mode,
+                    source.stop_at,
+                )
+        log_msg = f'Начало восстановления {source.infobase.db_name} ===> {receiver_infobase.db_name}'
+        put_log_msg(messages_queue, log_msg)
 
+        progress = RestoreProgress()
         cursor = receiver_conn.cursor()
+        # при отмене задания прерываем выполняющийся RESTORE
+        messages_queue.on_cancel(cursor.cancel)
         # устанавливаем режим автосохранения транзакций
         receiver_conn.autocommit = True
-        cursor.execute(script)
-        while True:
-            msg = await to_thread.run_sync(get_nextset, cursor)
-            if not msg:
-                break
-            messages_queue.put_nowait(msg)
-            await asyncio.sleep(0)
+        if roll_forward is None:
+            with timer.span('drop_snapshots'):
+                for snapshot in drop_snapshots(receiver_conn, receiver_infobase.db_name):
+                    put_log_msg(messages_queue,
+                                f'Удален снимок {snapshot.name} от {snapshot.create_date:%d.%m.%Y %H:%M}')
+        for step in steps:
+            size = next(log_sizes, None) if step.phase == 'log' else backup_sizes.get(step.phase)
+            progress.start_phase(step.phase, size)
+            with timer.span(step.phase):
+                cursor.execute(step.script)
+                while True:
+                    msg = get_nextset(cursor)
+                    if not msg:
+                        break
+                    messages_queue.put_nowait(progress.parse(msg))
+
+        if mode != RecoveryMode.recovery:
+            put_log_msg(messages_queue, f'База оставлена в режиме {mode.upper()} для наката следующих бекапов журнала')
+
+
+def needs_finish(result: RestoreResult, settings) -> bool:
+    # базу в NORECOVERY/STANDBY менять нельзя, ее ждут следующие бекапы журнала
+    return (result.status == 'done' and settings.restore_mode == RecoveryMode.recovery
+            and (settings.post_restore or settings.snapshot_after_restore))
+
+
+def finish_restore(messages_queue, receiver_infobase: InfoBase, settings, timer: PhaseTimer,
+                   result: RestoreResult) -> None:
+    """Обработка восстановленной базы и снимок для быстрого сброса. Выполняется в рабочем потоке задания."""
+    target_sql_server = SQLServer(server=receiver_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
+    with get_connection(target_sql_server) as receiver_conn:
+        receiver_conn.autocommit = True
+        cursor = receiver_conn.cursor()
+        messages_queue.on_cancel(cursor.cancel)
+        if settings.post_restore:
+            options = PostRestoreOptions(**settings.post_restore_options())
+            put_log_msg(messages_queue, f'Обработка базы после восстановления: {options}')
+            run_post_restore(cursor, receiver_infobase.db_name, options, timer, messages_queue)
+        # снимок после обработки: сброс к нему возвращает уже обработанную базу
+        if settings.snapshot_after_restore:
+            with timer.span('snapshot'):
+                result.snapshot = create_snapshot(receiver_conn, receiver_infobase.db_name).name
+            put_log_msg(messages_queue, f'Создан снимок {result.snapshot} для быстрого сброса базы')
+
+
+def revert_to_snapshot(messages_queue, receiver_infobase: InfoBase, settings, timer: PhaseTimer,
+                       result: RestoreResult) -> None:
+    """Откат базы приемника к снимку, созданному после восстановления. Выполняется в рабочем потоке задания."""
+    target_sql_server = SQLServer(server=receiver_infobase.db_server, user=settings.sql_user, pw=settings.sql_user_pwd)
+    with get_connection(target_sql_server) as receiver_conn:
+        snapshot = get_revert_snapshot(receiver_conn, receiver_infobase.db_name)
+        result.snapshot = snapshot.name
+        put_log_msg(messages_queue, f'Сброс {receiver_infobase.db_name} к снимку от '
+                                    f'{snapshot.create_date:%H:%M:%S %d.%m.%Y}')
+        cursor = receiver_conn.cursor()
+        messages_queue.on_cancel(cursor.cancel)
+        receiver_conn.autocommit = True
+        with timer.span('revert'):
+            cursor.execute(get_revert_script(receiver_infobase.db_name, snapshot))
+            while True:
+                msg = get_nextset(cursor)
+                if not msg:
+                    break
+                put_log_msg(messages_queue, msg)
+
+
+@asynccontextmanager
+async def sessions_denied(messages_queue, rac_client, target_path, receiver_infobase: InfoBase, settings,
+                          timer: PhaseTimer):
+    """Запрещает новые сеансы 1С базы приемника и завершает текущие, после восстановления снимает запрет.
+
+    Иначе рабочие процессы 1С переподключаются к базе, а SINGLE_USER WITH ROLLBACK IMMEDIATE ждет отката их
+    транзакций.
+    """
+    if not settings.terminate_sessions:
+        yield
+        return
+
+    cluster = get_async_cluster(rac_client, target_path)
+    message = settings.sessions_deny_message
+    with timer.span('sessions'):
+        await cluster.set_sessions_deny(receiver_infobase, settings.ib_username, settings.ib_user_pwd, True, message)
+    try:
+        with timer.span('sessions'):
+            sessions = await cluster.get_sessions(receiver_infobase.id)
+            terminated = await cluster.terminate_sessions(sessions, message)
+            put_log_msg(messages_queue, f'Начало сеансов 1С запрещено, завершено сеансов: {terminated}')
+            connections = await cluster.get_connections(receiver_infobase.id)
+            if connections:
+                logger.info(f'{receiver_infobase.name}: connections after terminate: '
+                            f'{[(connection.application, connection.host) for connection in connections]}')
+        yield
+    finally:
+        # запрет нужно снять и при отмене восстановления
+        with CancelScope(shield=True):
+            try:
+                await cluster.restore_sessions_deny(receiver_infobase, settings.ib_username, settings.ib_user_pwd)
+                put_log_msg(messages_queue, 'Запрет сеансов 1С снят')
+            except (ChildProcessError, FileNotFoundError) as e:
+                logger.exception(e)
+                put_log_msg(messages_queue, f'Не удалось снять запрет сеансов 1С, снимите его вручную: {e}')
+
+
+def get_estimate(source: SourceBackups, target_server, settings) -> RestoreEstimate:
+    """Прогноз по истории восстановлений; для "теплой" базы, на которую накатится только журнал, он завышен."""
+    backup_sets = source.backup_sets
+    return estimate_restore(
+        get_restore_history(settings.history_path),
+        sum(backup_set.backup_size or 0 for backup_set in backup_sets),
+        sum(backup_set.compressed_backup_size or 0 for backup_set in backup_sets),
+        get_share(source.full_backup_paths[0]),
+        target_server,
+        settings.restore_default_throughput
+    )
+
+
+async def async_restore_target(messages_queue, rac_client, source: SourceBackups, target_path, settings,
+                               scheduler: RestoreScheduler = restore_scheduler,
+                               result: Optional[RestoreResult] = None) -> RestoreResult:
+    result = result or RestoreResult(target=target_path)
+    timer = PhaseTimer()
+    result.phases = timer.phases
+    messages_queue.put_nowait('Получение информации о базе приемнике')
+    await asyncio.sleep(0)
+    with timer.span('rac_receiver'):
+        receiver_infobase = await async_get_infobase(rac_client, target_path, settings.ib_username,
+                                                     settings.ib_user_pwd)
+    log_msg = f'база приемник: {receiver_infobase}'
+    put_log_msg(messages_queue, log_msg)
+    result.receiver_server, result.receiver_db = receiver_infobase.db_server, receiver_infobase.db_name
+    await asyncio.sleep(0)
+
+    if settings.skip_if_current:
+        with timer.span('check_current'):
+            restored = await run_in_worker(get_receiver_state, receiver_infobase, settings,
+                                           name=f'state {receiver_infobase.db_server}/{receiver_infobase.db_name}')
+        if is_current(restored, source.last_backup, source.stop_at):
+            result.status = 'current'
+            put_log_msg(messages_queue, f'База уже актуальна: восстановлена {restored.restore_date:%H:%M:%S %d.%m.%Y} '
+                                        f'из бекапа на {restored.backup_finish_date:%H:%M:%S %d.%m.%Y}')
+            return result
+
+    result.estimate = await to_thread.run_sync(get_estimate, source, receiver_infobase.db_server, settings)
+    put_log_msg(messages_queue, result.estimate.describe())
+
+    def report_wait(start_in: Optional[float]):
+        put_log_msg(messages_queue, describe_start(receiver_infobase.db_server, start_in))
+
+    queued = time.monotonic()
+    server_slot = scheduler.server_slot(receiver_infobase.db_server, result.estimate.backup_size,
+                                        result.estimate.duration, report_wait)
+    # запрет сеансов 1С держится до конца обработки базы, а папка бекапов освобождается сразу после RESTORE
+    async with server_slot, AsyncExitStack() as sessions:
+        async with scheduler.share_slot(source.full_backup_paths[0]):
+            result.wait_time = time.monotonic() - queued
+            timer.phases['queue'] = result.wait_time
+            await sessions.enter_async_context(
+                sessions_denied(messages_queue, rac_client, target_path, receiver_infobase, settings, timer)
+            )
+            await run_in_worker(
+                restore_backups,
+                source,
+                receiver_infobase,
+                settings,
+                timer,
+                result,
+                messages_queue=messages_queue,
+                name=f'restore {receiver_infobase.db_server}/{receiver_infobase.db_name}'
+            )
+        if needs_finish(result, settings):
+            await run_in_worker(
+                finish_restore,
+                receiver_infobase,
+                settings,
+                timer,
+                result,
+                messages_queue=messages_queue,
+                name=f'finish {receiver_infobase.db_server}/{receiver_infobase.db_name}'
+            )
+
+    return result
+
+
+async def async_do_restore(messages_queue, source_path, target_path, raw_backup_date, settings,
+                           rac_client: Optional[AsyncRacClient] = None):
+    log_msg = 'START!'
+    put_log_msg(messages_queue, log_msg)
+    await asyncio.sleep(0)
+
+    rac_client = rac_client or get_rac_client(settings)
+    source = await async_resolve_source(messages_queue, rac_client, source_path, raw_backup_date, settings)
+    await async_restore_target(messages_queue, rac_client, source, target_path, settings)
 
     await asyncio.sleep(0)
 
     log_msg = 'DONE!'
     put_log_msg(messages_queue, log_msg)
+
+
+async def async_estimate_restore(source_path, target_paths: List[str], raw_backup_date, settings,
+                                 rac_client: Optional[AsyncRacClient] = None,
+                                 scheduler: RestoreScheduler = restore_scheduler) -> List[RestoreEstimate]:
+    """Прогноз длительности и начала восстановления в каждый приемник, без запуска восстановления."""
+    rac_client = rac_client or get_rac_client(settings)
+    source = await async_resolve_source(NullQueue(), rac_client, source_path, raw_backup_date, settings)
+    estimates = []
+    for target_path in target_paths:
+        receiver_infobase = await async_get_infobase(rac_client, target_path, settings.ib_username,
+                                                     settings.ib_user_pwd)
+        estimate = await to_thread.run_sync(get_estimate, source, receiver_infobase.db_server, settings)
+        estimate.target = target_path
+        estimate.start_in = scheduler.predict_start(receiver_infobase.db_server, estimate.backup_size,
+                                                    estimate.duration)
+        estimates.append(estimate)
+    return estimates
+
+
+def get_restore_run(source: SourceBackups, result: RestoreResult, started_at: datetime.datetime) -> RestoreRun:
+    phases = {**source.phases, **result.phases}
+    return RestoreRun(
+        started_at=started_at,
+        source_server=source.infobase.db_server,
+        source_db=source.infobase.db_name,
+        target_server=result.receiver_server,
+        target_db=result.receiver_db,
+        status=result.status,
+        backup_size=result.backup_size,
+        compressed_backup_size=result.compressed_backup_size,
+        duration=result.duration,
+        throughput=RestoreRun.get_throughput(result.backup_size, phases),
+        phases=phases,
+        backup_share=get_share(source.full_backup_paths[0])
+    )
+
+
+async def async_restore_recorded(messages_queue, rac_client, source: SourceBackups, result: RestoreResult, settings,
+                                 history: RestoreHistory) -> RestoreResult:
+    """Восстановление одного приемника, ошибка которого не прерывает остальные; результат пишется в историю."""
+    started_at, started = datetime.datetime.now(), time.monotonic()
+    try:
+        await async_restore_target(messages_queue, rac_client, source, result.target, settings, result=result)
+        if result.status == 'done':
+            put_log_msg(messages_queue, 'DONE!')
+    except Exception as e:
+        # не только RESTORE_ERRORS: любая ошибка одного приемника не должна отменять восстановление остальных
+        logger.exception(e)
+        result.status, result.error = 'error', describe_error(e)
+        put_log_msg(messages_queue, result.error)
+    result.duration = time.monotonic() - started
+    try:
+        await to_thread.run_sync(history.add, get_restore_run(source, result, started_at))
+    except Exception as e:
+        logger.exception(e)
+    return result
+
+
+async def async_do_fan_out(messages_queue, source_path, target_paths: List[str], raw_backup_date,
+                           settings, rac_client: Optional[AsyncRacClient] = None) -> List[RestoreResult]:
+    """Восстанавливает один источник в несколько приемников. Бекапы ищутся один раз."""
+    log_msg = 'START!'
+    put_log_msg(messages_queue, log_msg)
+    await asyncio.sleep(0)
+
+    rac_client = rac_client or get_rac_client(settings)
+    source = await async_resolve_source(messages_queue, rac_client, source_path, raw_backup_date, settings)
+    results = [RestoreResult(target=target_path) for target_path in target_paths]
+    history = get_restore_history(settings.history_path)
+
+    async with create_task_group() as tg:
+        for result in results:
+            target_queue = PrefixedQueue(messages_queue, result.target) if len(results) > 1 else messages_queue
+            tg.start_soon(async_restore_recorded, target_queue, rac_client, source, result, settings, history)
+
+    for result in results:
+        log_msg = f'{result.target}: {result.status} за {result.duration:.0f} с, ' \
+                  f'из них в очереди {result.wait_time:.0f} с' + (f' ({result.error})' if result.error else '')
+        put_log_msg(messages_queue, log_msg)
+    return results
+
+
+async def async_reset_target(messages_queue, rac_client, target_path, settings,
+                             scheduler: RestoreScheduler = restore_scheduler,
+                             result: Optional[RestoreResult] = None) -> RestoreResult:
+    result = result or RestoreResult(target=target_path)
+    timer = PhaseTimer()
+    result.phases = timer.phases
+    with timer.span('rac_receiver'):
+        receiver_infobase = await async_get_infobase(rac_client, target_path, settings.ib_username,
+                                                     settings.ib_user_pwd)
+    put_log_msg(messages_queue, f'база приемник: {receiver_infobase}')
+    result.receiver_server, result.receiver_db = receiver_infobase.db_server, receiver_infobase.db_name
+
+    queued = time.monotonic()
+    # откат нагружает диски сервера, поэтому тоже идет через ограничение на сервер
+    async with scheduler.server_slot(receiver_infobase.db_server):
+        result.wait_time = time.monotonic() - queued
+        timer.phases['queue'] = result.wait_time
+        async with sessions_denied(messages_queue, rac_client, target_path, receiver_infobase, settings, timer):
+            await run_in_worker(
+                revert_to_snapshot,
+                receiver_infobase,
+                settings,
+                timer,
+                result,
+                messages_queue=messages_queue,
+                name=f'reset {receiver_infobase.db_server}/{receiver_infobase.db_name}'
+            )
+    return result
+
+
+async def async_do_reset(messages_queue, target_paths: List[str], settings,
+                         rac_client: Optional[AsyncRacClient] = None) -> List[RestoreResult]:
+    """Откатывает базы приемники к снимкам, созданным после восстановления."""
+    put_log_msg(messages_queue, 'START!')
+    rac_client = rac_client or get_rac_client(settings)
+    results = [RestoreResult(target=target_path) for target_path in target_paths]
+
+    async def reset_target(result: RestoreResult, target_queue):
+        started = time.monotonic()
+        try:
+            await async_reset_target(target_queue, rac_client, result.target, settings, result=result)
+            put_log_msg(target_queue, 'DONE!')
+        except RESTORE_ERRORS as e:
+            logger.exception(e)
+            result.status, result.error = 'error', describe_error(e)
+            put_log_msg(target_queue, result.error)
+        result.duration = time.monotonic() - started
+
+    async with create_task_group() as tg:
+        for result in results:
+            target_queue = PrefixedQueue(messages_queue, result.target) if len(results) > 1 else messages_queue
+            tg.start_soon(reset_target, result, target_queue)
+
+    for result in results:
+        log_msg = f'{result.target}: {result.status} за {result.duration:.0f} с' + \
+                  (f' ({result.error})' if result.error else '')
+        put_log_msg(messages_queue, log_msg)
+    return results
+
+
+async def async_run_reset_job(job, log, settings, rac_client: Optional[AsyncRacClient] = None) -> list:
+    results = await async_do_reset(log, job.params['targets'], apply_restore_options(settings, job.params),
+                                   rac_client=rac_client)
+    return [result.dict() for result in results]
+
+
+async def async_run_job(job, log, settings, rac_client: Optional[AsyncRacClient] = None) -> list:
+    """rac_client - общий клиент сервера, чтобы ограничение rac_max_concurrency действовало на все задания."""
+    runners = {'restore': async_run_restore_job, 'reset': async_run_reset_job}
+    return await runners[job.kind](job, log, settings, rac_client=rac_client)
+
+
+def apply_restore_options(settings, params: dict):
+    """Параметры восстановления задания или плана поверх настроек."""
+    options = {
+        'snapshot_after_restore': params.get('snapshot'),
+        'skip_if_current': params.get('skip_if_current'),
+        'restore_logs': params.get('logs'),
+        'restore_mode': params.get('mode'),
+        'terminate_sessions': params.get('terminate_sessions'),
+        'post_restore': params.get('optimize'),
+    }
+    return settings.copy(update={name: value for name, value in options.items() if value is not None})
+
+
+async def async_run_restore_job(job, log, settings, rac_client: Optional[AsyncRacClient] = None) -> list:
+    params = job.params
+    settings = apply_restore_options(settings, params)
+    try:
+        results = await async_do_fan_out(log, params['source'], params['targets'], params['backup_date'], settings,
+                                         rac_client=rac_client)
+    except RESTORE_ERRORS as e:
+        logger.exception(e)
+        put_log_msg(log, describe_error(e))
+        put_log_msg(log, 'Операция прервана!')
+        raise
+    return [result.dict() for result in results]
+
+
+async def async_do_plan(messages_queue, plan: RestorePlan, settings, rac_client: Optional[AsyncRacClient] = None,
+                        results: Optional[List[PlanJobResult]] = None) -> List[PlanJobResult]:
+    """Пакетное восстановление по плану.
+
+    Бекапы каждого источника ищутся один раз, восстановления идут не больше чем по plan.max_workers
+    одновременно (и с ограничениями планировщика на сервер и папку бекапов), любая ошибка одного задания
+    не прерывает остальные. Итоги заданий добавляются в results по мере завершения - они остаются у вызывающего,
+    даже если план прерван.
+    """
+    put_log_msg(messages_queue, 'START!')
+    settings = apply_restore_options(settings, plan.options.dict())
+    rac_client = rac_client or get_rac_client(settings)
+    history = get_restore_history(settings.history_path)
+    limiter = CapacityLimiter(plan.max_workers)
+    default_date = datetime.datetime.now().isoformat(timespec='seconds')
+    sources = plan.get_sources(default_date)
+    results = [] if results is None else results
+
+    async def restore_target(source: SourceBackups, source_path, backup_date, target_path):
+        target_queue = PrefixedQueue(messages_queue, target_path)
+        result = RestoreResult(target=target_path)
+        # ошибки приемника перехватывает async_restore_recorded, остальные задания плана продолжаются
+        async with limiter:
+            await async_restore_recorded(target_queue, rac_client, source, result, settings, history)
+        results.append(PlanJobResult(
+            source=source_path, target=target_path, backup_date=backup_date, status=result.status,
+            exit_code=EXIT_CODES[result.status], error=result.error, wait_time=result.wait_time,
+            duration=result.duration, phases={**source.phases, **result.phases}
+        ))
+
+    async def restore_source(source_path, backup_date, target_paths: List[str]):
+        source_queue = PrefixedQueue(messages_queue, source_path)
+        started = time.monotonic()
+        try:
+            async with limiter:
+                source = await async_resolve_source(source_queue, rac_client, source_path, backup_date, settings)
+        except Exception as e:
+            logger.exception(e)
+            error = describe_error(e)
+            put_log_msg(source_queue, error)
+            results.extend(
+                PlanJobResult(source=source_path, target=target_path, backup_date=backup_date, status='error',
+                              exit_code=EXIT_CODES['error'], error=error, duration=time.monotonic() - started)
+                for target_path in target_paths
+            )
+            return
+        async with create_task_group() as source_tg:
+            for target_path in target_paths:
+                source_tg.start_soon(restore_target, source, source_path, backup_date, target_path)
+
+    async with create_task_group() as tg:
+        for (source_path, backup_date), target_paths in sources.items():
+            tg.start_soon(restore_source, source_path, backup_date, target_paths)
+
+    # порядок как в плане, а не по времени завершения
+    order = [(source_path, backup_date, target)
+             for (source_path, backup_date), targets in sources.items() for target in targets]
+    results.sort(key=lambda result: order.index((result.source, result.backup_date, result.target)))
+    for result in results:
+        log_msg = f'{result.source} -> {result.target}: {result.status} за {result.duration:.0f} с' + \
+                  (f' ({result.error})' if result.error else '')
+        put_log_msg(messages_queue, log_msg)
+    return results
@@ -0,0 +1,102 @@
+import datetime
+import logging
+import ntpath
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from services.exceptions import SnapshotNotFound
+from services.file_mapping import join_path, quote
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SUFFIX = '_reset_snapshot'
+
+SNAPSHOTS_QUERY = '''
+SELECT name, DB_NAME(source_database_id) AS source_db, create_date
+FROM   sys.databases
+WHERE  source_database_id IS NOT NULL
+'''
+DATA_FILES_QUERY = '''
+SELECT name, physical_name FROM sys.master_files WHERE database_id = DB_ID(?) AND type = 0 ORDER BY file_id
+'''
+
+
+class Snapshot(BaseModel):
+    name: str
+    source_db: str
+    create_date: datetime.datetime
+
+    def age(self, now: Optional[datetime.datetime] = None) -> datetime.timedelta:
+        return (now or datetime.datetime.now()) - self.create_date
+
+
+def get_snapshot_name(db_name) -> str:
+    return f'{db_name}{SNAPSHOT_SUFFIX}'
+
+
+def list_snapshots(conn, db_name=None) -> List[Snapshot]:
+    """Снимки баз на сервере, самые новые первыми; db_name - только снимки этой базы."""
+    cursor = conn.cursor()
+    if db_name:
+        cursor.execute(f'{SNAPSHOTS_QUERY} AND source_database_id = DB_ID(?) ORDER BY create_date DESC', db_name)
+    else:
+        cursor.execute(f'{SNAPSHOTS_QUERY} ORDER BY create_date DESC')
+    return [Snapshot(name=name, source_db=source_db, create_date=create_date)
+            for name, source_db, create_date in cursor.fetchall()]
+
+
+def get_create_snapshot_script(conn, db_name) -> str:
+    """CREATE DATABASE ... AS SNAPSHOT OF: разреженный файл рядом с каждым файлом данных базы."""
+    cursor = conn.cursor()
+    cursor.execute(DATA_FILES_QUERY, db_name)
+    snapshot_name = get_snapshot_name(db_name)
+    files = ', '.join(
+        f"(NAME = N'{quote(logical_name)}', "
+        f"FILENAME = N'{quote(join_path(ntpath.dirname(physical_name), f'{snapshot_name}_{logical_name}.ss'))}')"
+        for logical_name, physical_name in cursor.fetchall()
+    )
+    return f'CREATE DATABASE [{snapshot_name}] ON {files} AS SNAPSHOT OF [{db_name}]'
+
+
+def get_drop_snapshots_script(snapshots: List[Snapshot]) -> str:
+    return '\n'.join(f'DROP DATABASE [{snapshot.name}]' for snapshot in snapshots)
+
+
+def get_revert_script(db_name, snapshot: Snapshot) -> str:
+    return f'''
+        USE [master]
+        ALTER DATABASE [{db_name}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE
+        RESTORE DATABASE [{db_name}] FROM DATABASE_SNAPSHOT = N'{quote(snapshot.name)}'
+        ALTER DATABASE [{db_name}] SET MULTI_USER
+        '''
+
+
+def drop_snapshots(conn, db_name) -> List[Snapshot]:
+    """Удаляет снимки базы: с ними RESTORE DATABASE невозможен. Нужен autocommit."""
+    snapshots = list_snapshots(conn, db_name)
+    if snapshots:
+        logger.info(f'drop snapshots of {db_name}: {[snapshot.name for snapshot in snapshots]}')
+        cursor = conn.cursor()
+        cursor.execute(get_drop_snapshots_script(snapshots))
+        while cursor.nextset():
+            pass
+    return snapshots
+
+
+def create_snapshot(conn, db_name) -> Snapshot:
+    """Снимок только что восстановленной базы, к которому ее можно быстро откатить. Нужен autocommit."""
+    drop_snapshots(conn, db_name)
+    cursor = conn.cursor()
+    cursor.execute(get_create_snapshot_script(conn, db_name))
+    while cursor.nextset():
+        pass
+    return list_snapshots(conn, db_name)[0]
+
+
+def get_revert_snapshot(conn, db_name) -> Snapshot:
+    # откатить базу можно, только если снимок у нее один
+    snapshots = list_snapshots(conn, db_name)
+    if len(snapshots) != 1:
+        raise SnapshotNotFound(f'У базы {db_name} {len(snapshots)} снимков, для сброса нужен ровно один')
+    return snapshots[0]
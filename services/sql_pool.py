@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Hashable, Tuple
+
+from pydantic import BaseModel
+
+from services.exceptions import ConnectionPoolTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats(BaseModel):
+    size: int = 0
+    idle: int = 0
+    hits: int = 0
+    misses: int = 0
+    waits: int = 0
+    wait_time: float = 0
+    timeouts: int = 0
+    evicted: int = 0
+    broken: int = 0
+
+
+class ConnectionPool:
+    """Пул соединений к одному серверу.
+
+    При выдаче соединение проверяется запросом SELECT 1, при возврате сбрасываются autocommit
+    и контекст базы. Соединения, простаивающие дольше idle_timeout, закрываются.
+
+    min_size - нижняя граница вытеснения: столько уже открытых соединений остаются в пуле и после простоя.
+    Заранее пул их не открывает, соединения создаются по первому запросу.
+    """
+
+    def __init__(self, connect: Callable[[], Any], min_size=0, max_size=8, idle_timeout: float = 300,
+                 checkout_timeout: float = 30, reset_db='master', discard_on: Tuple[type, ...] = (Exception,),
+                 clock=time.monotonic):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.reset_db = reset_db
+        self.discard_on = discard_on
+        self._clock = clock
+        self._idle: Deque[Tuple[Any, float]] = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = PoolStats()
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        try:
+            conn.cursor().execute('SELECT 1').fetchone()
+        except Exception as e:
+            logger.debug(f'connection check failed: {e}')
+            return False
+        return True
+
+    @staticmethod
+    def _close(conn) -> None:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f'connection close failed: {e}')
+
+    def _reset(self, conn) -> None:
+        conn.rollback()
+        conn.cursor().execute(f'USE [{self.reset_db}]')
+        conn.autocommit = False
+
+    def _drop(self, conn) -> None:
+        self._close(conn)
+        with self._cond:
+            self._stats.broken += 1
+            self._size -= 1
+            self._cond.notify()
+
+    def acquire(self):
+        deadline = self._clock() + self.checkout_timeout
+        waited = False
+        started = self._clock()
+        while True:
+            with self._cond:
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                elif self._size < self.max_size:
+                    conn = None
+                    self._size += 1
+                    self._stats.misses += 1
+                else:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        self._stats.timeouts += 1
+                        raise ConnectionPoolTimeout('Нет свободных соединений с сервером SQL')
+                    if not waited:
+                        waited = True
+                        self._stats.waits += 1
+                    self._cond.wait(remaining)
+                    continue
+                if waited:
+                    self._stats.wait_time += self._clock() - started
+
+            if conn is None:
+                try:
+                    return self.connect()
+                except BaseException:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_alive(conn):
+                with self._cond:
+                    self._stats.hits += 1
+                return conn
+
+            self._drop(conn)
+
+    def release(self, conn, broken=False) -> None:
+        if not broken:
+            try:
+                self._reset(conn)
+            except Exception as e:
+                logger.debug(f'connection reset failed: {e}')
+                broken = True
+
+        if broken:
+            self._drop(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, self._clock()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except self.discard_on:
+            self.release(conn, broken=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def evict_idle(self) -> int:
+        expired = []
+        now = self._clock()
+        with self._cond:
+            # самые давние соединения лежат в начале очереди
+            while self._idle and self._size - len(expired) > self.min_size:
+                conn, last_used = self._idle[0]
+                if now - last_used < self.idle_timeout:
+                    break
+                self._idle.popleft()
+                expired.append(conn)
+            self._size -= len(expired)
+            self._stats.evicted += len(expired)
+        for conn in expired:
+            self._close(conn)
+        return len(expired)
+
+    def close(self) -> None:
+        with self._cond:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> PoolStats:
+        with self._cond:
+            return self._stats.copy(update={'size': self._size, 'idle': len(self._idle)})
+
+
+class ConnectionPools:
+    """Пулы соединений, по одному на каждый сервер (ключ задает вызывающий код)."""
+
+    def __init__(self, eviction_interval: float = 60, **pool_options):
+        self.eviction_interval = eviction_interval
+        self.pool_options: Dict[str, Any] = pool_options
+        self._pools: Dict[Hashable, ConnectionPool] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._evictor = None
+
+    def configure(self, **pool_options) -> None:
+        """Меняет настройки для новых и уже созданных пулов."""
+        with self._lock:
+            self.pool_options.update(pool_options)
+            for pool in self._pools.values():
+                for name, value in pool_options.items():
+                    setattr(pool, name, value)
+
+    def get_pool(self, key: Hashable, connect: Callable[[], Any], **pool_options) -> ConnectionPool:
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = ConnectionPool(connect, **{**self.pool_options, **pool_options})
+                self._start_evictor()
+            else:
+                # в строке подключения мог смениться пароль
+                pool.connect = connect
+            return pool
+
+    def _start_evictor(self) -> None:
+        if self._evictor is None:
+            self._stop = threading.Event()
+            self._evictor = threading.Thread(target=self._evict_loop, name='sql-pool-evictor', daemon=True)
+            self._evictor.start()
+
+    def _evict_loop(self) -> None:
+        while not self._stop.wait(self.eviction_interval):
+            self.evict_idle()
+
+    def evict_idle(self) -> int:
+        with self._lock:
+            pools = list(self._pools.values())
+        return sum(pool.evict_idle() for pool in pools)
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            pools = list(self._pools.items())
+        return {'/'.join(str(part) for part in key): pool.stats().dict() for key, pool in pools}
+
+    def close(self) -> None:
+        self._stop.set()
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+            self._evictor = None
+        for pool in pools:
+            pool.close()
@@ -1,13 +1,26 @@
 import datetime
 import logging
-import os
 from contextlib import contextmanager
 from enum import Enum
+from typing import List, Optional, Tuple, Union
 
 import pyodbc
 from pydantic import BaseModel
 
+from services.backup_catalog import BackupCatalog, RestoreChain
 from services.exceptions import BackupFilesError
+from services.file_mapping import (
+    file_list_cache,
+    get_disks,
+    get_move_options,
+    get_receiver_directories,
+    join_path,
+    map_files,
+    quote
+)
+from services.restore_state import RecoveryMode
+from services.restore_tuning import RestoreTuning
+from services.sql_pool import ConnectionPools
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +28,7 @@ logger = logging.getLogger(__name__)
 class BackupType(Enum):
     full = 'D'
     diff = 'I'
+    log = 'L'
 
 
 class SQLServer(BaseModel):
@@ -25,54 +39,68 @@ class SQLServer(BaseModel):
     port: int = 1433
     db: str = 'master'
 
+    @property
+    def pool_key(self):
+        return self.server.lower(), self.port, self.db, self.user
+
     def get_connection_string(self):
         return ';'.join([self.driver, f'SERVER={self.server}', f'PORT={self.port}', f'DATABASE={self.db}',
                          f'UID={self.user}', f'PWD={self.pw}'])
 
 
-def get_backup_path(conn, source_db, backup_type=BackupType.full, backup_date=datetime.datetime.now()):
+def get_backup_path(conn, source_db, backup_type=BackupType.full,
+                    backup_date=datetime.datetime.now()) -> Tuple[List[str], Optional[datetime.datetime]]:
+    """Файлы последнего бекапа на дату: все устройства набора, если бекап разбит на несколько файлов."""
     logger.debug('get_backup_path')
     cursor = conn.cursor()
 
-    backup_start_date = backup_date.strftime('%Y-%m-%d %H:%M:%S')
-
-    query = f'''
-SELECT TOP (1) bmf.physical_device_name, bs.backup_finish_date
-FROM   msdb.dbo.backupset AS bs LEFT OUTER JOIN msdb.dbo.backupmediafamily AS bmf ON bs.media_set_id = bmf.media_set_id
-WHERE  (bs.database_name = N'{source_db}') AND (bs.type = '{backup_type.value}')
-AND (bs.backup_finish_date <= CONVERT(DATETIME, '{backup_start_date}', 102)) AND bs.is_snapshot=0
-ORDER BY bs.backup_finish_date DESC'''
+    query = '''
+SELECT bmf.physical_device_name, bs.backup_finish_date
+FROM   (SELECT TOP (1) media_set_id, backup_finish_date
+        FROM   msdb.dbo.backupset
+        WHERE  (database_name = ?) AND (type = ?) AND (backup_finish_date <= ?) AND is_snapshot=0
+        ORDER BY backup_finish_date DESC) AS bs
+       INNER JOIN msdb.dbo.backupmediafamily AS bmf ON bs.media_set_id = bmf.media_set_id
+ORDER BY bmf.family_sequence_number'''
 
     logger.debug(f'execute query {query}')
 
-    cursor.execute(query)
-    response = cursor.fetchone()
+    cursor.execute(query, source_db, backup_type.value, backup_date)
+    response = cursor.fetchall()
 
     if not response and backup_type == BackupType.full:
         raise BackupFilesError
 
-    logger.debug(response)    
+    logger.debug(response)
 
-    backup_path, backup_finish_date = response
-    logger.debug(f'backup_path {backup_type}: {backup_path}')
-    return backup_path, backup_finish_date
+    backup_paths = [backup_path for backup_path, _ in response]
+    backup_finish_date = response[0][1] if response else None
+    logger.debug(f'backup_path {backup_type}: {backup_paths}')
+    return backup_paths, backup_finish_date
 
 
-def get_files_names(conn, source_db) -> list:
-    cursor = conn.cursor()
+def get_restore_chain(catalog: BackupCatalog, db: SQLServer, source_db,
+                      backup_date: datetime.datetime) -> RestoreChain:
+    # к msdb обращаемся, только если локальный индекс устарел
+    if not catalog.is_fresh(db.server, source_db):
+        with get_connection(db) as conn:
+            catalog.sync(conn, db.server, [source_db])
 
-    query = f'''
-SELECT name, physical_name FROM [{source_db}].[sys].[database_files]
-ORDER BY type
-    '''
+    chain = catalog.restore_chain(db.server, source_db, backup_date)
+    if not chain or not chain.full.devices:
+        raise BackupFilesError
+    logger.debug(f'restore chain {source_db}: {chain}')
+    return chain
 
-    cursor.execute(query)
-    logical_name_files = cursor.fetchall()
 
-    return logical_name_files
+class RestoreStep(BaseModel):
+    phase: str
+    script: str
 
 
-def restore_db(conn, restored_base_name, full_backup_path, dif_backup_path=None):
+def restore_db(conn, restored_base_name, full_backup_path: Union[str, List[str]],
+               dif_backup_path: Union[str, List[str], None] = None,
+               tuning: Optional[RestoreTuning] = None):
     logger.info('start restore BD')
 
     cursor = conn.cursor()
@@ -80,7 +108,7 @@ def restore_db(conn, restored_base_name, full_backup_path, dif_backup_path=None)
     # устанавливаем режим автосохранения транзакций
     conn.autocommit = True
 
-    script = prepare_sql_query_for_restore(conn, full_backup_path, restored_base_name, dif_backup_path)
+    script = prepare_sql_query_for_restore(conn, full_backup_path, restored_base_name, dif_backup_path, tuning)
 
     cursor.execute(script)
 
@@ -91,55 +119,135 @@ def restore_db(conn, restored_base_name, full_backup_path, dif_backup_path=None)
         logger.info(msg)
 
 
-def prepare_sql_query_for_restore(conn, full_backup_path, restored_base_name, dif_backup_path=None):
-    # получаем логические имена файлов и их пути для целевой базы
-    data_file, log_file = get_files_names(conn, restored_base_name)
-    data_file_name, data_file_path = data_file
-    log_file_name, log_file_path = log_file
-    data_file_path = get_right_path(data_file_path, restored_base_name)
-    log_file_path = get_right_path(log_file_path, f'{restored_base_name}_log')
+def get_exclusive_access_script(restored_base_name) -> str:
+    name = quote(restored_base_name)
+    # база в STANDBY только для чтения и не переводится в SINGLE_USER, читателей отключаем KILL;
+    # база в RESTORING подключений не имеет
+    return f'''
+        USE [master]
+        IF DATABASEPROPERTYEX(N'{name}', 'IsInStandBy') = 1
+        BEGIN
+            DECLARE @kill nvarchar(max) = N''
+            SELECT @kill += N'KILL ' + CAST(session_id AS nvarchar(10)) + N'; '
+            FROM   sys.dm_exec_sessions WHERE database_id = DB_ID(N'{name}') AND session_id <> @@SPID
+            EXEC (@kill)
+        END
+        ELSE IF DATABASEPROPERTYEX(N'{name}', 'Status') = 'ONLINE'
+            ALTER DATABASE [{restored_base_name}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE
+        '''
 
-    no_recovery = ''
-    diff_script = ''
 
-    if dif_backup_path:
-        no_recovery = 'NORECOVERY,'
-        diff_script = f"RESTORE DATABASE [{restored_base_name}] FROM  DISK = N'{dif_backup_path}' " \
-                      f"WITH  FILE = 1,  NOUNLOAD,  STATS = 5"
-
-    script = f'''
-        USE [master]
-        ALTER DATABASE [{restored_base_name}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE
+def get_recovery_option(data_dir, restored_base_name, mode=RecoveryMode.recovery, last=True) -> str:
+    """Опция для WITH, с завершающей запятой: RECOVERY только после последнего бекапа и если приемник не "теплый"."""
+    if not last or mode == RecoveryMode.norecovery:
+        return 'NORECOVERY, '
+    if mode == RecoveryMode.standby:
+        return f"STANDBY = N'{quote(join_path(data_dir, f'{restored_base_name}_undo.dat'))}', "
+    return 'RECOVERY, '
+
+
+def get_log_steps(data_dir, restored_base_name, log_backup_paths: List[List[str]], tuning_options='',
+                  mode=RecoveryMode.recovery, stop_at: Optional[datetime.datetime] = None) -> List[RestoreStep]:
+    stop_at_option = f"STOPAT = N'{stop_at:%Y-%m-%dT%H:%M:%S}', " if stop_at else ''
+    return [
+        RestoreStep(
+            phase='log',
+            script=f"RESTORE LOG [{restored_base_name}] FROM  {get_disks(paths)} WITH  FILE = 1,  "
+                   f"{get_recovery_option(data_dir, restored_base_name, mode, n == len(log_backup_paths) - 1)}"
+                   f"{stop_at_option}{tuning_options}NOUNLOAD,  STATS = 5"
+        )
+        for n, paths in enumerate(log_backup_paths)
+    ]
+
+
+def prepare_restore_steps(conn, full_backup_path: Union[str, List[str]], restored_base_name,
+                          dif_backup_path: Union[str, List[str], None] = None,
+                          tuning: Optional[RestoreTuning] = None,
+                          log_backup_paths: Optional[List[List[str]]] = None,
+                          mode: str = RecoveryMode.recovery,
+                          stop_at: Optional[datetime.datetime] = None) -> List[RestoreStep]:
+    """Скрипт восстановления, разбитый на шаги, чтобы засекать время каждого."""
+    if isinstance(full_backup_path, str):
+        full_backup_path = [full_backup_path]
+    # все файлы из бекапа переносим в папки базы приемника
+    backup_files = file_list_cache.get(conn, full_backup_path)
+    data_dir, log_dir = get_receiver_directories(conn, restored_base_name)
+    move_options = get_move_options(map_files(backup_files, restored_base_name, data_dir, log_dir))
+
+    tuning_options = tuning.get_options() if tuning else ''
+    log_backup_paths = log_backup_paths or []
+    full_recovery = get_recovery_option(data_dir, restored_base_name, mode,
+                                        last=not dif_backup_path and not log_backup_paths)
+
+    steps = [
+        RestoreStep(phase='single_user', script=get_exclusive_access_script(restored_base_name)),
+        RestoreStep(phase='full', script=f'''
         RESTORE DATABASE [{restored_base_name}] FROM
-        DISK = N'{full_backup_path}' WITH  FILE = 1,
-        MOVE N'{data_file_name}' TO N'{data_file_path}',
-        MOVE N'{log_file_name}' TO N'{log_file_path}',
-        {no_recovery}  NOUNLOAD, REPLACE, STATS = 5
-        '''
+        {get_disks(full_backup_path)} WITH  FILE = 1,
+        {move_options}
+        {full_recovery}  {tuning_options}NOUNLOAD, REPLACE, STATS = 5
+        '''),
+    ]
 
-    script = f'{script}{diff_script}'
+    if dif_backup_path:
+        diff_recovery = get_recovery_option(data_dir, restored_base_name, mode, last=not log_backup_paths)
+        steps.append(RestoreStep(
+            phase='diff',
+            script=f"RESTORE DATABASE [{restored_base_name}] FROM  {get_disks(dif_backup_path)} "
+                   f"WITH  FILE = 1,  {diff_recovery}{tuning_options}NOUNLOAD,  STATS = 5"
+        ))
+
+    steps.extend(get_log_steps(data_dir, restored_base_name, log_backup_paths, tuning_options, mode, stop_at))
+
+    logger.debug(steps)
+    return steps
+
+
+def prepare_roll_forward_steps(conn, restored_base_name, log_backup_paths: List[List[str]],
+                               tuning: Optional[RestoreTuning] = None, mode: str = RecoveryMode.recovery,
+                               stop_at: Optional[datetime.datetime] = None) -> List[RestoreStep]:
+    """Применение к "теплой" базе приемнику только новых бекапов журнала."""
+    data_dir, _ = get_receiver_directories(conn, restored_base_name)
+    steps = [RestoreStep(phase='single_user', script=get_exclusive_access_script(restored_base_name))]
+    if log_backup_paths:
+        tuning_options = tuning.get_options() if tuning else ''
+        steps.extend(get_log_steps(data_dir, restored_base_name, log_backup_paths, tuning_options, mode, stop_at))
+    else:
+        # новых бекапов журнала нет, база только переводится в нужный режим
+        steps.append(RestoreStep(
+            phase='recover',
+            script=f"RESTORE DATABASE [{restored_base_name}] WITH "
+                   f"{get_recovery_option(data_dir, restored_base_name, mode).rstrip(', ')}"
+        ))
+
+    logger.debug(steps)
+    return steps
+
+
+def prepare_sql_query_for_restore(conn, full_backup_path: Union[str, List[str]], restored_base_name,
+                                  dif_backup_path: Union[str, List[str], None] = None,
+                                  tuning: Optional[RestoreTuning] = None):
+    steps = prepare_restore_steps(conn, full_backup_path, restored_base_name, dif_backup_path, tuning)
+    script = ''.join(step.script for step in steps)
 
     logger.debug(script)
     return script
 
 
-def get_right_path(data_file_path, restored_base_name):
-    file_path, _ = os.path.split(data_file_path)
-    _, ext = os.path.splitext(data_file_path)
-    return os.path.join(file_path, f'{restored_base_name}{ext}')
+sql_pools = ConnectionPools(discard_on=(pyodbc.Error,))
 
 
 @contextmanager
-def get_connection(db: SQLServer):
+def get_connection(db: SQLServer, pools: ConnectionPools = sql_pools):
     conn_str = db.get_connection_string()
-    logger.debug(f'setup connection {conn_str}')
-    base_conn = None
-    try:
-        base_conn = pyodbc.connect(conn_str, timeout=2)
-        yield base_conn
-    finally:
-        if base_conn:
-            base_conn.close()
+
+    def connect():
+        logger.debug(f'setup connection {conn_str}')
+        return pyodbc.connect(conn_str, timeout=2)
+
+    pool = pools.get_pool(db.pool_key, connect, reset_db=db.db)
+    with pool.connection() as conn:
+        yield conn
 
 
 def get_nextset(cursor):
@@ -0,0 +1,256 @@
+import functools
+import hashlib
+import json
+import logging
+import ntpath
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+GB = 1024 * MB
+INDEX_FILE = 'staging_index.json'
+
+
+class StagedFile(BaseModel):
+    source: str
+    file: str
+    size: int
+    mtime: float
+    checksum: str
+    last_used: float
+
+
+class StagingError(OSError):
+    pass
+
+
+def drop_page_cache(f, offset: int, length: int) -> None:
+    """Сбрасывает записанное на диск и убирает из кеша страниц, чтобы проверка читала файл с диска.
+
+    Где posix_fadvise нет (Windows), проверка может прочитать кеш страниц, но не копию в памяти процесса.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        if f.writable():
+            os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def get_file_name(path: str) -> str:
+    # пути бекапов приходят из msdb в виде путей Windows
+    return ntpath.basename(path)
+
+
+class StagingCache:
+    """Локальная копия файлов бекапа рядом с сервером приемником.
+
+    Файл копируется параллельно кусками. Контрольные суммы кусков считаются по прочитанному из источника,
+    копия после записи на диск перечитывается и сверяется с ними, а при повторном использовании проверяется
+    заново: поврежденная копия вытесняется и копируется еще раз.
+    Копии хранятся по ключу (путь, размер, время изменения) и вытесняются по LRU, когда не хватает места.
+    """
+
+    def __init__(self, directory: str, budget: int, chunk_size: int = 64 * MB, workers: int = 4, clock=time.time):
+        self.directory = directory
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._in_use: Dict[str, int] = {}
+        # место под файлы, которые сейчас копируются
+        self._reserved = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index: Dict[str, StagedFile] = self._load_index()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def _load_index(self) -> Dict[str, StagedFile]:
+        try:
+            with open(self._index_path, encoding='utf-8') as f:
+                index = {key: StagedFile(**value) for key, value in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning(f'staging index is broken, start from scratch: {e}')
+            return {}
+        # файлы могли удалить вручную
+        return {key: staged for key, staged in index.items() if os.path.exists(staged.file)}
+
+    def _save_index(self) -> None:
+        tmp_path = f'{self._index_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({key: staged.dict() for key, staged in self._index.items()}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
+
+    @staticmethod
+    def _key(path, size, mtime) -> str:
+        return hashlib.sha1(f'{path.lower()}|{size}|{mtime}'.encode()).hexdigest()
+
+    def _get_key_lock(self, key) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def acquire(self, paths: List[str]) -> List[str]:
+        """Возвращает локальные копии файлов, копируя недостающие. Копии не вытесняются до release."""
+        staged_paths = []
+        try:
+            for path in paths:
+                staged_paths.append(self._acquire_one(path))
+        except BaseException:
+            self.release(staged_paths)
+            raise
+        return staged_paths
+
+    def release(self, staged_paths: List[str]) -> None:
+        with self._lock:
+            for staged_path in staged_paths:
+                self._in_use[staged_path] -= 1
+                if not self._in_use[staged_path]:
+                    del self._in_use[staged_path]
+
+    def _acquire_one(self, path) -> str:
+        stat = os.stat(path)
+        key = self._key(path, stat.st_size, stat.st_mtime)
+        with self._get_key_lock(key):
+            with self._lock:
+                staged = self._index.get(key)
+                if staged and not os.path.exists(staged.file):
+                    del self._index[key]
+                    staged = None
+                if staged:
+                    # пока копия проверяется, ее не вытеснят
+                    self._in_use[staged.file] = self._in_use.get(staged.file, 0) + 1
+
+            if staged:
+                if self._checksum(staged.file, staged.size) == staged.checksum:
+                    logger.debug(f'staging hit {path}')
+                    with self._lock:
+                        staged.last_used = self._clock()
+                        self._save_index()
+                    return staged.file
+                logger.warning(f'staging copy is damaged, copy again: {staged.file}')
+                self.release([staged.file])
+                with self._lock:
+                    if self._in_use.get(staged.file):
+                        raise StagingError(f'Копия повреждена, но используется другим восстановлением: {staged.file}')
+                    self._remove(key, staged)
+                    self._save_index()
+
+            with self._lock:
+                self._make_room(stat.st_size)
+                self._reserved += stat.st_size
+
+            file = os.path.join(self.directory, f'{key[:12]}_{get_file_name(path)}')
+            try:
+                checksum = self._copy(path, file, stat.st_size)
+            finally:
+                with self._lock:
+                    self._reserved -= stat.st_size
+            with self._lock:
+                self._index[key] = StagedFile(source=path, file=file, size=stat.st_size, mtime=stat.st_mtime,
+                                              checksum=checksum, last_used=self._clock())
+                self._in_use[file] = self._in_use.get(file, 0) + 1
+                self._save_index()
+            return file
+
+    def _remove(self, key, staged: StagedFile) -> None:
+        try:
+            os.remove(staged.file)
+        except FileNotFoundError:
+            pass
+        del self._index[key]
+
+    def _make_room(self, size) -> None:
+        if size > self.budget:
+            raise StagingError(f'Файл {size} байт больше бюджета кеша {self.budget} байт')
+
+        used = sum(staged.size for staged in self._index.values()) + self._reserved
+        for key, staged in sorted(self._index.items(), key=lambda item: item[1].last_used):
+            if used + size <= self.budget:
+                break
+            if self._in_use.get(staged.file):
+                continue
+            logger.info(f'staging evict {staged.file}')
+            self._remove(key, staged)
+            used -= staged.size
+
+        if used + size > self.budget:
+            raise StagingError('Недостаточно места в кеше бекапов: все копии используются')
+        self._save_index()
+
+    def _copy_chunk(self, source, target, size, offset) -> int:
+        with open(source, 'rb') as src:
+            src.seek(offset)
+            data = src.read(self.chunk_size)
+        if len(data) != min(self.chunk_size, size - offset):
+            raise StagingError(f'Файл изменился во время копирования: {source}')
+        with open(target, 'r+b') as dst:
+            dst.seek(offset)
+            dst.write(data)
+            dst.flush()
+            drop_page_cache(dst, offset, len(data))
+        return zlib.crc32(data)
+
+    def _chunk_checksum(self, file, offset) -> int:
+        with open(file, 'rb') as f:
+            drop_page_cache(f, offset, self.chunk_size)
+            f.seek(offset)
+            return zlib.crc32(f.read(self.chunk_size))
+
+    @staticmethod
+    def _combine(checksums: List[int]) -> str:
+        return hashlib.sha1(b''.join(checksum.to_bytes(4, 'little') for checksum in checksums)).hexdigest()
+
+    def _checksum(self, file, size) -> str:
+        """Контрольная сумма файла на диске по кускам chunk_size, в том же виде, что у _copy."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return self._combine(list(executor.map(functools.partial(self._chunk_checksum, file),
+                                                   range(0, size, self.chunk_size))))
+
+    def _copy(self, source, target, size) -> str:
+        logger.info(f'staging copy {source} -> {target}')
+        part_path = f'{target}.part'
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+
+        try:
+            offsets = range(0, size, self.chunk_size)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                checksums = list(executor.map(functools.partial(self._copy_chunk, source, part_path, size), offsets))
+            if os.path.getsize(part_path) != size:
+                raise StagingError(f'Размер копии не совпал: {target}')
+            checksum = self._combine(checksums)
+            if self._checksum(part_path, size) != checksum:
+                raise StagingError(f'Контрольная сумма копии не совпала с источником: {target}')
+            os.replace(part_path, target)
+        except BaseException:
+            try:
+                os.remove(part_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        return checksum
+
+
+_caches: Dict[str, StagingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_staging_cache(directory: str, budget: int, chunk_size: int = 64 * MB, workers: int = 4) -> StagingCache:
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = StagingCache(directory, budget, chunk_size, workers)
+        return cache
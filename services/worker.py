@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import threading
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerCancelled(Exception):
+    pass
+
+
+class Channel:
+    """Очередь сообщений из рабочего потока в цикл событий.
+
+    Повторяет put_nowait очереди, поэтому блокирующий код пишет в нее так же, как async код в очередь браузера.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback: Callable):
+        self._loop = loop
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._cancel_callbacks: List[Callable] = []
+        self.cancelled = threading.Event()
+
+    def put_nowait(self, msg) -> None:
+        if self.cancelled.is_set():
+            raise WorkerCancelled('Задание отменено')
+        try:
+            self._loop.call_soon_threadsafe(self._callback, msg)
+        except RuntimeError:
+            # цикл событий уже закрыт, сообщение некому доставить
+            raise WorkerCancelled('Цикл событий остановлен')
+
+    def on_cancel(self, callback: Callable) -> None:
+        """callback вызывается из цикла событий при отмене, например cursor.cancel прерывает RESTORE."""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled.set()
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f'cancel callback failed: {e}')
+
+
+def _set_result(future: asyncio.Future, result) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exc: BaseException) -> None:
+    if not future.done():
+        future.set_exception(exc)
+
+
+async def run_in_worker(func: Callable, *args, messages_queue=None, name: Optional[str] = None):
+    """Выполняет func(channel, *args) в отдельном потоке задания и ждет результат, не блокируя цикл событий.
+
+    Сообщения из channel попадают в messages_queue в порядке отправки и до возврата результата.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    channel = Channel(loop, messages_queue.put_nowait if messages_queue is not None else lambda msg: None)
+
+    def target():
+        try:
+            result = func(channel, *args)
+        except BaseException as e:
+            callback, value = _set_exception, e
+        else:
+            callback, value = _set_result, result
+        try:
+            loop.call_soon_threadsafe(callback, future, value)
+        except RuntimeError:
+            logger.warning(f'worker {name} finished after event loop was closed')
+
+    threading.Thread(target=target, name=name, daemon=True).start()
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        channel.cancel()
+        raise
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseSettings
 
 
@@ -7,6 +9,95 @@ class Settings(BaseSettings):
     sql_user: str
     sql_user_pwd: str
     rac_path: str
+    rac_cache_ttl: int = 300
+    rac_timeout: float = 30
+    rac_max_concurrency: int = 8
+    # сколько открытых соединений к серверу не закрывать при простое; заранее они не открываются
+    sql_pool_min_size: int = 0
+    sql_pool_max_size: int = 8
+    sql_pool_idle_timeout: int = 300
+    backup_catalog_path: str = 'backup_catalog.sqlite3'
+    backup_catalog_max_age: int = 300
+    restore_max_per_server: int = 1
+    restore_max_per_share: int = 2
+    # сколько ГБ бекапов одновременно восстанавливать на одном сервере приемнике, остальные ждут в очереди;
+    # пусто - без ограничения. Бекап больше лимита восстанавливается, когда сервер свободен
+    restore_max_gb_per_server: Optional[float] = None
+    # скорость восстановления для прогноза, пока в истории нет восстановлений на сервер, МБ/с
+    restore_default_throughput: float = 100
+    job_store_path: str = 'jobs.sqlite3'
+    job_workers: int = 4
+    # сколько секунд при остановке сервера ждать завершения выполняющихся заданий
+    job_shutdown_timeout: float = 60
+    # сообщений в буфере одного браузера и как часто отправлять накопленное, секунд
+    ws_buffer_size: int = 1000
+    ws_batch_interval: float = 0.1
+    restore_tuning: str = 'default'
+    restore_buffer_count: Optional[int] = None
+    restore_max_transfer_size: Optional[int] = None
+    restore_block_size: Optional[int] = None
+    # папка для локальных копий бекапов, доступная серверу приемнику; {server} - имя сервера приемника
+    staging_dir: Optional[str] = None
+    staging_budget_gb: int = 500
+    staging_chunk_mb: int = 64
+    staging_workers: int = 4
+    history_path: str = 'restore_history.sqlite3'
+    # снимок базы после восстановления, чтобы сбрасывать ее за секунды вместо повторного восстановления
+    snapshot_after_restore: bool = False
+    # не восстанавливать базу, если она уже восстановлена из выбранного бекапа
+    skip_if_current: bool = False
+    # применять бекапы журнала до точного момента восстановления (STOPAT)
+    restore_logs: bool = False
+    # recovery, norecovery или standby: в двух последних база остается "теплой" и следующие
+    # обновления накатывают на нее только новые бекапы журнала
+    restore_mode: str = 'recovery'
+    # перед восстановлением запретить начало сеансов 1С базы приемника и завершить текущие через rac
+    terminate_sessions: bool = False
+    sessions_deny_message: str = 'База перезаливается, вход временно запрещен'
+    # обработка тестовой базы после восстановления: SIMPLE, сжатие журнала, статистика, индексы
+    post_restore: bool = False
+    post_restore_simple_recovery: bool = True
+    # до какого размера сжать журнал, МБ; пусто - не сжимать
+    post_restore_log_size_mb: Optional[int] = 1024
+    post_restore_statistics_async: bool = True
+    post_restore_update_statistics: bool = False
+    post_restore_rebuild_indexes: bool = False
+    # перестраивать индексы с фрагментацией от, % и размером от, страниц; не дольше index_budget секунд
+    post_restore_fragmentation: float = 30
+    post_restore_min_pages: int = 1000
+    post_restore_index_budget: int = 600
+
+    def sql_pool_options(self):
+        return {
+            'min_size': self.sql_pool_min_size,
+            'max_size': self.sql_pool_max_size,
+            'idle_timeout': self.sql_pool_idle_timeout,
+        }
+
+    def restore_max_bytes_per_server(self) -> Optional[int]:
+        if self.restore_max_gb_per_server is None:
+            return None
+        return int(self.restore_max_gb_per_server * 1024 ** 3)
+
+    def restore_tuning_options(self):
+        return {
+            'profile': self.restore_tuning,
+            'buffer_count': self.restore_buffer_count,
+            'max_transfer_size': self.restore_max_transfer_size,
+            'block_size': self.restore_block_size,
+        }
+
+    def post_restore_options(self):
+        return {
+            'simple_recovery': self.post_restore_simple_recovery,
+            'log_size_mb': self.post_restore_log_size_mb,
+            'statistics_async': self.post_restore_statistics_async,
+            'update_statistics': self.post_restore_update_statistics,
+            'rebuild_indexes': self.post_restore_rebuild_indexes,
+            'fragmentation': self.post_restore_fragmentation,
+            'min_pages': self.post_restore_min_pages,
+            'index_budget': self.post_restore_index_budget,
+        }
 
     class Config:
         env_file_encoding = 'utf-8'
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from benchmarks import fake_pyodbc, fake_rac
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+def fake_sql_server(tmp_path, monkeypatch):
+    # каждое сообщение RESTORE - блокирующее ожидание в nextset, как у настоящего драйвера
+    server = fake_pyodbc.FakeSqlServer(tmp_path / 'backup', history_days=2, message_delay=0.01)
+    try:
+        import pyodbc
+    except ImportError:
+        # без unixODBC драйвер не загружается - вместо него модуль-заглушка, сервисы импортируются после
+        pyodbc = fake_pyodbc.install(server)
+    monkeypatch.setattr(pyodbc, 'connect', server.connect, raising=False)
+    return server
+
+
+@pytest.fixture
+def pipeline_settings(fake_sql_server, tmp_path, monkeypatch):
+    """Клиент поддельного rac и настройки для восстановления на fake_sql_server."""
+    if os.name == 'nt':
+        pytest.skip('поддельный rac запускается только на Linux')
+    from services.rac_tools import AsyncRacClient
+    from settings import Settings
+
+    monkeypatch.setenv('FAKE_RAC_INFOBASES', '5')
+    monkeypatch.setenv('FAKE_RAC_LATENCY', '0')
+    rac_client = AsyncRacClient(exe_path=fake_rac.install(tmp_path))
+    settings = Settings(
+        _env_file=None,
+        ib_username='test',
+        ib_user_pwd='test',
+        sql_user='test',
+        sql_user_pwd='test',
+        rac_path=str(tmp_path),
+        backup_catalog_path=str(tmp_path / 'backup_catalog.sqlite3'),
+        history_path=str(tmp_path / 'restore_history.sqlite3'),
+    )
+    return rac_client, settings
+
+
+class FakeCursor:
+    """Курсор pyodbc для тестов: запоминает запросы, результат - rows или rows(query, params)."""
+
+    def __init__(self, rows=(), queries=None, description=None):
+        self.rows = rows
+        self.queries = [] if queries is None else queries
+        self.description = description
+        self.params = ()
+        self._result = []
+
+    def execute(self, query, *params):
+        self.queries.append(query)
+        self.params = params
+        self._result = list(self.rows(query, params) if callable(self.rows) else self.rows)
+        return self
+
+    def fetchall(self):
+        return self._result
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def nextset(self):
+        return False
+
+    def cancel(self):
+        pass
+
+
+class FakeConnection:
+    """Соединение pyodbc: каждый cursor() - новый FakeCursor с общим списком запросов."""
+
+    def __init__(self, rows=(), description=None):
+        self.rows = rows
+        self.description = description
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self.rows, self.queries, self.description)
+
+
+class FakeQueue:
+    """Очередь сообщений восстановления."""
+
+    def __init__(self):
+        self.messages = []
+
+    def put_nowait(self, msg):
+        self.messages.append(msg)
@@ -0,0 +1,107 @@
+import datetime
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+from services.backup_catalog import BackupCatalog
+from services.restore_state import RestoredBackup, get_log_chain_start, get_roll_forward
+
+
+def msdb_row(backup_set_id, backup_type, finish, first_lsn, last_lsn, checkpoint_lsn=None, base_lsn=None,
+             devices=('\\\\backup\\base.bak',)):
+    finish = datetime.datetime(2023, 3, 1) + datetime.timedelta(hours=finish)
+    return [
+        (backup_set_id, 'base', backup_type, finish - datetime.timedelta(minutes=5), finish, 1024, 512,
+         Decimal(first_lsn), Decimal(last_lsn), Decimal(checkpoint_lsn or first_lsn), None,
+         Decimal(base_lsn) if base_lsn else None, False, False, number, device)
+        for number, device in enumerate(devices, start=1)
+    ]
+
+
+def make_conn(*rows):
+    conn = MagicMock()
+    conn.cursor.return_value.fetchall.return_value = [row for backup_set in rows for row in backup_set]
+    return conn
+
+
+def test_restore_chain():
+    catalog = BackupCatalog(':memory:')
+    conn = make_conn(
+        msdb_row(1, 'D', 0, 100, 200, checkpoint_lsn=150, devices=('a1.bak', 'a2.bak')),
+        msdb_row(2, 'I', 6, 300, 400, base_lsn=150),
+        msdb_row(3, 'L', 7, 200, 500),
+        msdb_row(4, 'L', 8, 500, 600),
+        msdb_row(5, 'L', 9, 600, 700),
+        msdb_row(6, 'D', 12, 700, 800, checkpoint_lsn=750),
+    )
+    assert catalog.sync(conn, 'SQL-01', ['base']) == 6
+
+    chain = catalog.restore_chain('sql-01', 'base', datetime.datetime(2023, 3, 1, 7, 30))
+    assert chain.full.backup_set_id == 1
+    assert chain.full.devices == ['a1.bak', 'a2.bak']
+    assert chain.diff.backup_set_id == 2
+    assert [log.backup_set_id for log in chain.logs] == [3, 4]
+
+    chain = catalog.restore_chain('sql-01', 'base', datetime.datetime(2023, 3, 1, 13))
+    assert chain.full.backup_set_id == 6
+    assert chain.diff is None
+
+
+def test_sync_is_incremental():
+    now = [0]
+    catalog = BackupCatalog(':memory:', max_age=60, clock=lambda: now[0])
+    assert not catalog.is_fresh('sql-01', 'base')
+
+    catalog.sync(make_conn(msdb_row(1, 'D', 0, 100, 200)), 'sql-01', ['base'])
+    assert catalog.is_fresh('sql-01', 'base')
+
+    conn = make_conn(msdb_row(2, 'I', 1, 200, 300, base_lsn=100))
+    catalog.sync(conn, 'sql-01', ['base'])
+    conn.cursor.return_value.execute.assert_called_once()
+    assert conn.cursor.return_value.execute.call_args.args[1:] == ('base', 1)
+    assert [point.type for point in catalog.restore_points('sql-01', 'base')] == ['I', 'D']
+
+    now[0] = 61
+    assert not catalog.is_fresh('sql-01', 'base')
+
+
+def test_log_chain_from_receiver_lsn():
+    catalog = BackupCatalog(':memory:')
+    catalog.sync(make_conn(
+        msdb_row(1, 'D', 0, 100, 200),
+        msdb_row(3, 'L', 7, 200, 500),
+        msdb_row(4, 'L', 8, 500, 600),
+        msdb_row(5, 'L', 9, 600, 700),
+        msdb_row(7, 'L', 11, 800, 900),
+    ), 'sql-01', ['base'])
+
+    # приемник уже восстановлен до LSN 500 - нужны только следующие бекапы журнала
+    restored_finish = datetime.datetime(2023, 3, 1, 7)
+    logs = catalog.log_chain('sql-01', 'base', 500, restored_finish, datetime.datetime(2023, 3, 1, 12))
+    # после LSN 700 разрыв цепочки
+    assert [log.backup_set_id for log in logs] == [4, 5]
+
+    logs = catalog.log_chain('sql-01', 'base', 500, restored_finish, datetime.datetime(2023, 3, 1, 7, 30))
+    assert [log.backup_set_id for log in logs] == [4]
+
+
+def test_log_chain_after_stop_at():
+    catalog = BackupCatalog(':memory:')
+    catalog.sync(make_conn(
+        msdb_row(1, 'D', 0, 100, 200),
+        msdb_row(3, 'L', 7, 200, 500),
+        msdb_row(4, 'L', 8, 500, 600),
+        msdb_row(5, 'L', 9, 600, 700),
+    ), 'sql-01', ['base'])
+    log = catalog.log_chain('sql-01', 'base', 200, datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 1, 12))[1]
+
+    # журнал 4 применен только до 07:30, его last_lsn 600 приемник еще не достиг
+    restored = RestoredBackup(database_name='base', type='L', first_lsn=log.first_lsn, last_lsn=log.last_lsn,
+                              checkpoint_lsn=log.checkpoint_lsn, backup_finish_date=log.backup_finish_date,
+                              restore_date=datetime.datetime(2023, 3, 1, 8, 30),
+                              stop_at=datetime.datetime(2023, 3, 1, 7, 30), status='RESTORING', recovery=False)
+    logs = catalog.log_chain('sql-01', 'base', *get_log_chain_start(restored), datetime.datetime(2023, 3, 1, 12))
+    assert [log.backup_set_id for log in get_roll_forward(restored, logs)] == [4, 5]
+
+    restored = restored.copy(update={'stop_at': None})
+    logs = catalog.log_chain('sql-01', 'base', *get_log_chain_start(restored), datetime.datetime(2023, 3, 1, 12))
+    assert [log.backup_set_id for log in logs] == [5]
@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import pytest
+
+from services.broadcast import Broadcast, Subscriber, send_batches, to_frame
+from services.progress import ProgressEvent, coalesce_key, to_message
+
+
+def progress(percent, target='test_image'):
+    return ProgressEvent(target=target, phase='full', percent=percent, elapsed=1, text=f'{percent} percent processed.')
+
+
+def publish(broadcast, msg):
+    broadcast.publish(to_message(msg), coalesce_key(msg))
+
+
+@pytest.mark.anyio
+async def test_progress_coalesces_for_slow_subscriber():
+    broadcast = Broadcast()
+    subscriber = broadcast.subscribe()
+    publish(broadcast, 'START!')
+    for percent in range(5, 100, 5):
+        publish(broadcast, progress(percent))
+    publish(broadcast, progress(10, target='other'))
+    publish(broadcast, ProgressEvent(type='phase_done', phase='full', percent=100, elapsed=1, text='done'))
+
+    batch = [json.loads(message) for message in await subscriber.get()]
+    assert [(event['type'], event.get('percent')) for event in batch] == [
+        ('log', None), ('progress', 95), ('progress', 10), ('phase_done', 100)
+    ]
+
+
+@pytest.mark.anyio
+async def test_buffer_is_bounded():
+    broadcast = Broadcast(maxsize=10)
+    subscriber = broadcast.subscribe()
+    for n in range(1000):
+        publish(broadcast, f'line {n}')
+    assert len(subscriber) == 10
+
+    batch = [json.loads(message)['text'] for message in await subscriber.get()]
+    assert batch[0].startswith('Пропущено сообщений: 990')
+    assert batch[1:] == [f'line {n}' for n in range(990, 1000)]
+
+
+@pytest.mark.anyio
+async def test_close_delivers_rest_then_none():
+    broadcast = Broadcast()
+    subscriber = broadcast.subscribe()
+    publish(broadcast, 'DONE!')
+    broadcast.close()
+    publish(broadcast, 'late')
+    assert len(await subscriber.get()) == 1
+    assert await subscriber.get() is None
+
+
+@pytest.mark.anyio
+async def test_send_batches_drops_dead_subscriber():
+    subscriber = Subscriber()
+
+    async def send(frame):
+        raise ConnectionResetError
+
+    subscriber.put(to_message('START!'))
+    await asyncio.wait_for(send_batches(subscriber, send, tick=0), 1)
+    assert subscriber.closed
+    subscriber.put(to_message('lost'))
+    assert len(subscriber) == 0
+
+
+@pytest.mark.anyio
+async def test_send_batches_frames():
+    subscriber = Subscriber()
+    frames = []
+
+    async def send(frame):
+        frames.append(json.loads(frame))
+
+    sender = asyncio.create_task(send_batches(subscriber, send, tick=0.01))
+    subscriber.put(to_message('first'))
+    await asyncio.sleep(0)
+    subscriber.put(to_message('second'))
+    subscriber.put(to_message('third'))
+    subscriber.close()
+    await asyncio.wait_for(sender, 1)
+    assert frames == [{'type': 'log', 'text': 'first'}, [{'type': 'log', 'text': 'second'},
+                                                         {'type': 'log', 'text': 'third'}]]
+    assert to_frame(['1']) == '1'
@@ -0,0 +1,47 @@
+import datetime
+
+import pytest
+
+from services.estimate import estimate_restore, get_overhead
+from services.metrics import MB, RestoreHistory, RestoreRun
+
+SHARE = '\\\\backup-01\\sql'
+
+
+def make_run(throughput, share=SHARE, target='sql-test-01', status='done', minutes_ago=0):
+    return RestoreRun(
+        started_at=datetime.datetime(2023, 3, 1, 12) - datetime.timedelta(minutes=minutes_ago),
+        source_server='sql-prod-01',
+        source_db='image',
+        target_server=target,
+        target_db='test_image',
+        status=status,
+        backup_size=1000 * MB,
+        compressed_backup_size=300 * MB,
+        duration=1000 / throughput + 30,
+        throughput=throughput,
+        phases={'queue': 10, 'full': 1000 / throughput},
+        backup_share=share
+    )
+
+
+def test_get_overhead():
+    assert get_overhead(make_run(100)) == pytest.approx(20)
+
+
+def test_estimate_uses_share_history_first():
+    history = RestoreHistory(':memory:')
+    for minutes_ago, throughput in enumerate([50, 40, 60]):
+        history.add(make_run(throughput, minutes_ago=minutes_ago))
+    history.add(make_run(500, share='d:'))
+    history.add(make_run(5, status='error'))
+
+    estimate = estimate_restore(history, 2000 * MB, 500 * MB, SHARE, 'SQL-TEST-01', 100)
+    assert (estimate.basis, estimate.samples, estimate.throughput) == ('share', 3, 50)
+    assert estimate.duration == pytest.approx(2000 / 50 + 20)
+
+    estimate = estimate_restore(history, 2000 * MB, 500 * MB, '\\\\backup-02\\sql', 'sql-test-01', 100)
+    assert (estimate.basis, estimate.samples) == ('server', 4)
+
+    estimate = estimate_restore(history, 2000 * MB, 500 * MB, SHARE, 'sql-test-02', 100)
+    assert (estimate.basis, estimate.duration) == ('default', 20)
@@ -0,0 +1,71 @@
+from services.file_mapping import BackupFile, FileListCache, get_move_options, get_receiver_directories, map_files
+from tests.conftest import FakeConnection
+
+
+FILE_LIST_COLUMNS = [('LogicalName',), ('PhysicalName',), ('Type',), ('FileGroupName',), ('FileId',)]
+
+
+def make_connection(receiver_files=()):
+    def rows(query, params):
+        if 'FILELISTONLY' in query:
+            return [
+                ('image', r'D:\data\image.mdf', 'D', 'PRIMARY', 1),
+                ('image_log', r'E:\log\image_log.ldf', 'L', None, 2),
+                ('image_2', r'D:\data\image_2.ndf', 'D', 'SECONDARY', 3),
+            ]
+        if 'master_files' in query:
+            return receiver_files
+        return [('/var/opt/mssql/data/', '/var/opt/mssql/log/')]
+
+    return FakeConnection(rows, description=FILE_LIST_COLUMNS)
+
+
+def test_every_backup_file_is_moved():
+    files = [
+        BackupFile(logical_name='image', physical_name=r'D:\data\image.mdf', type='D', file_id=1),
+        BackupFile(logical_name='image_log', physical_name=r'E:\log\image_log.ldf', type='L', file_id=2),
+        BackupFile(logical_name='image_2', physical_name=r'D:\data\image_2.ndf', type='D', file_id=3),
+        BackupFile(logical_name='ftc', physical_name=r'D:\data\ftc', type='F', file_id=4),
+    ]
+    mapping = map_files(files, 'test_image', r'F:\SQL\Data', r'G:\SQL\Log')
+    assert mapping == [
+        ('image', r'F:\SQL\Data\test_image.mdf'),
+        ('image_log', r'G:\SQL\Log\test_image_log.ldf'),
+        ('image_2', r'F:\SQL\Data\test_image_image_2.ndf'),
+        ('ftc', r'F:\SQL\Data\test_image_ftc'),
+    ]
+    assert get_move_options(mapping[:1]) == r"MOVE N'image' TO N'F:\SQL\Data\test_image.mdf', "
+
+
+def test_linux_paths():
+    files = [BackupFile(logical_name="o'db", physical_name=r'D:\data\odb.mdf', type='D', file_id=1)]
+    mapping = map_files(files, 'test', '/var/opt/mssql/data', '/var/opt/mssql/log')
+    assert mapping == [("o'db", '/var/opt/mssql/data/test.mdf')]
+    assert get_move_options(mapping) == "MOVE N'o''db' TO N'/var/opt/mssql/data/test.mdf', "
+
+
+def test_receiver_directories():
+    conn = make_connection([(0, r'F:\SQL\Data\test.mdf'), (1, r'G:\SQL\Log\test_log.ldf')])
+    assert get_receiver_directories(conn, 'test') == (r'F:\SQL\Data', r'G:\SQL\Log')
+    # новой базы нет на сервере - папки по умолчанию
+    assert get_receiver_directories(make_connection(), 'new') == ('/var/opt/mssql/data', '/var/opt/mssql/log')
+
+
+def test_file_list_is_cached_by_size_and_mtime(tmp_path):
+    backup = tmp_path / 'image.bak'
+    backup.write_bytes(b'backup')
+    cache = FileListCache()
+    conn = make_connection()
+
+    files = cache.get(conn, [str(backup)])
+    assert [file.logical_name for file in files] == ['image', 'image_log', 'image_2']
+    assert cache.get(conn, [str(backup)]) is files
+    assert len(conn.queries) == 1
+
+    backup.write_bytes(b'new backup')
+    cache.get(conn, [str(backup)])
+    assert len(conn.queries) == 2
+
+    # файл виден только серверу SQL - читаем без кеша
+    cache.get(conn, [str(tmp_path / 'missing.bak')])
+    assert len(conn.queries) == 3
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+from services.jobs import JobManager, JobStatus, JobStore
+from services.progress import ProgressEvent
+
+
+async def read_all(subscriber):
+    messages = []
+    while True:
+        batch = await asyncio.wait_for(subscriber.get(), 1)
+        if batch is None:
+            return messages
+        messages.extend(json.loads(message)['text'] for message in batch)
+
+
+@pytest.mark.anyio
+async def test_job_runs_in_background():
+    release = asyncio.Event()
+
+    async def runner(job, log):
+        log.put_nowait('START!')
+        await release.wait()
+        log.put_nowait('DONE!')
+        return [{'target': target} for target in job.params['targets']]
+
+    manager = JobManager(JobStore(':memory:'), runner, workers=2)
+    await manager.start()
+    job = await manager.submit({'source': 'src', 'targets': ['t1', 't2'], 'backup_date': '2023-03-01'})
+
+    first = await manager.subscribe(job.id)
+    await asyncio.sleep(0.01)
+    # подписчик отключился, задание продолжает работу
+    manager.unsubscribe(job.id, first)
+    release.set()
+
+    late = await manager.subscribe(job.id)
+    assert await read_all(late) == ['START!', 'DONE!']
+    job = await manager.get(job.id)
+    assert job.status == JobStatus.done
+    assert job.results == [{'target': 't1'}, {'target': 't2'}]
+    await manager.stop()
+
+
+@pytest.mark.anyio
+async def test_interrupted_jobs_are_marked_on_start():
+    store = JobStore(':memory:')
+
+    async def runner(job, log):
+        raise ValueError('boom')
+
+    manager = JobManager(store, runner)
+    await manager.start()
+    failed = await manager.submit({'source': 'src', 'targets': ['t1'], 'backup_date': ''})
+    await read_all(await manager.subscribe(failed.id))
+    await manager.stop()
+    assert store.get(failed.id).error == 'boom'
+
+    running = failed.copy(update={'id': 'running', 'status': JobStatus.running, 'error': None})
+    store.save(running)
+    await JobManager(store, runner).start()
+    assert store.get('running').status == JobStatus.error
+
+
+@pytest.mark.anyio
+async def test_stop_drains_running_jobs():
+    release = asyncio.Event()
+
+    async def runner(job, log):
+        await release.wait()
+        return []
+
+    store = JobStore(':memory:')
+    manager = JobManager(store, runner, workers=1)
+    await manager.start()
+    running = await manager.submit({'targets': ['t1']})
+    queued = await manager.submit({'targets': ['t2']})
+    await asyncio.sleep(0.01)
+
+    stopping = asyncio.create_task(manager.stop(timeout=5))
+    await asyncio.sleep(0.01)
+    assert not stopping.done()
+    # задание, отправленное во время остановки, ждет перезапуска
+    late = await manager.submit({'targets': ['t3']})
+    release.set()
+    await stopping
+
+    assert store.get(running.id).status == JobStatus.done
+    assert store.get(queued.id).status == JobStatus.queued
+    assert store.get(late.id).status == JobStatus.queued
+
+
+@pytest.mark.anyio
+async def test_stop_interrupts_jobs_after_timeout():
+    async def runner(job, log):
+        await asyncio.sleep(10)
+
+    store = JobStore(':memory:')
+    manager = JobManager(store, runner, workers=1)
+    await manager.start()
+    job = await manager.submit({'targets': ['t1']})
+    await asyncio.sleep(0.01)
+    await manager.stop(timeout=0.05)
+    assert store.get(job.id).error == 'Задание прервано остановкой сервера'
+
+
+class ThreadCheckingStore(JobStore):
+    """Запоминает обращения к SQLite из цикла событий и размеры пачек сообщений."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.on_loop = []
+        self.batches = []
+
+    def _check(self, name):
+        if threading.current_thread() is threading.main_thread():
+            self.on_loop.append(name)
+
+    def save(self, job):
+        self._check('save')
+        super().save(job)
+
+    def get(self, job_id):
+        self._check('get')
+        return super().get(job_id)
+
+    def list(self, limit=100, statuses=None):
+        self._check('list')
+        return super().list(limit, statuses)
+
+    def messages(self, job_id):
+        self._check('messages')
+        return super().messages(job_id)
+
+    def add_messages(self, messages):
+        self._check('add_messages')
+        self.batches.append(len(messages))
+        super().add_messages(messages)
+
+
+@pytest.mark.anyio
+async def test_store_is_used_off_loop_and_messages_coalesced():
+    async def runner(job, log):
+        log.put_nowait('START!')
+        for percent in range(100):
+            log.put_nowait(ProgressEvent(target='t1', phase='restore', percent=percent, elapsed=0,
+                                         text=f'{percent} percent processed.'))
+        log.put_nowait('DONE!')
+        return []
+
+    store = ThreadCheckingStore(':memory:')
+    manager = JobManager(store, runner, flush_interval=10)
+    await manager.start()
+    job = await manager.submit({'targets': ['t1']})
+    texts = await read_all(await manager.subscribe(job.id))
+    assert len(await manager.messages(job.id)) == 3
+    assert (await manager.get(job.id)).status == JobStatus.done
+    assert len(await manager.list()) == 1
+    await manager.stop()
+
+    # SQLite только в потоках, а из 100 сообщений прогресса в журнал попадает последнее
+    assert store.batches and not store.on_loop
+    messages = [json.loads(message) for message in store.messages(job.id)]
+    assert [message['text'] for message in messages] == ['START!', '99 percent processed.', 'DONE!']
+    assert texts[0] == 'START!' and texts[-1] == 'DONE!'
@@ -0,0 +1,110 @@
+import datetime
+import sqlite3
+
+import pytest
+
+from services.metrics import (
+    MB,
+    PhaseTimer,
+    RestoreHistory,
+    RestoreRun,
+    format_report,
+    get_phase_stats,
+    percentile,
+    render_prometheus,
+)
+
+
+def make_run(duration, full, status='done', target='sql-test-01', minutes_ago=0):
+    phases = {'rac_source': 1.0, 'single_user': 2.0, 'full': full}
+    return RestoreRun(
+        started_at=datetime.datetime(2023, 3, 1, 12) - datetime.timedelta(minutes=minutes_ago),
+        source_server='sql-prod-01',
+        source_db='image',
+        target_server=target,
+        target_db='test_image',
+        status=status,
+        backup_size=100 * MB,
+        compressed_backup_size=40 * MB,
+        duration=duration,
+        throughput=RestoreRun.get_throughput(100 * MB, phases),
+        phases=phases
+    )
+
+
+def test_phase_timer_accumulates():
+    now = [0.0]
+    timer = PhaseTimer(clock=lambda: now[0])
+    with timer.span('full'):
+        now[0] += 5
+    with pytest.raises(RuntimeError):
+        with timer.span('full'):
+            now[0] += 2
+            raise RuntimeError
+    assert timer.phases == {'full': 7}
+
+
+def test_percentile():
+    assert percentile([], 0.5) == 0
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile([1, 2, 3, 4], 0.5) == 2.5
+    assert percentile(list(range(1, 101)), 0.95) == pytest.approx(95.05)
+
+
+def test_history_roundtrip():
+    history = RestoreHistory(':memory:')
+    history.add(make_run(60, 50, minutes_ago=10))
+    history.add(make_run(90, 80))
+
+    runs = history.runs()
+    assert [run.duration for run in runs] == [90, 60]
+    assert runs[0].phases == {'rac_source': 1.0, 'single_user': 2.0, 'full': 80}
+    assert runs[0].throughput == pytest.approx(100 / 80)
+
+    since = datetime.datetime(2023, 3, 1, 11, 55)
+    assert [run.duration for run in history.runs(since=since)] == [90]
+
+    history.add(make_run(5, 1, status='error'))
+    assert history.status_counts() == {'done': 2, 'error': 1}
+    assert len(history.runs(limit=1)) == 1
+
+
+def test_stats_skip_failed_runs():
+    runs = [make_run(60, 50), make_run(100, 90), make_run(5, 1, status='error'), make_run(30, 20, target='sql-test-02')]
+    stats = get_phase_stats(runs)
+    assert stats['sql-prod-01 -> sql-test-01']['full'] == {'p50': 70, 'p95': 88, 'count': 2, 'sum': 140}
+    assert stats['sql-prod-01 -> sql-test-01']['total']['count'] == 2
+    assert stats['sql-prod-01 -> sql-test-02']['total']['p50'] == 30
+
+
+def test_render_prometheus():
+    text = render_prometheus([make_run(60, 50), make_run(5, 1, status='error')], {'done': 12000, 'error': 1})
+    # счетчик - по всей истории, а не по последним восстановлениям
+    assert 'restore_runs_total{status="done"} 12000' in text
+    assert 'restore_runs_total{status="error"} 1' in text
+    assert 'restore_phase_seconds_sum{source="sql-prod-01",target="sql-test-01",phase="full"} 50.000' in text
+    assert 'restore_phase_seconds{source="sql-prod-01",target="sql-test-01",phase="full",quantile="0.95"} 50.000' \
+        in text
+    assert 'restore_throughput_mb_per_second{source="sql-prod-01",target="sql-test-01"} 2.000' in text
+    assert text.endswith('\n')
+
+
+def test_format_report():
+    assert 'пуста' in format_report([])
+    report = format_report([make_run(60, 50)])
+    assert report.splitlines()[0] == 'sql-prod-01 -> sql-test-01'
+    assert 'full' in report
+
+
+def test_history_adds_new_columns(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE restore_runs (id INTEGER PRIMARY KEY AUTOINCREMENT, started_at TEXT NOT NULL, '
+               'source_server TEXT, source_db TEXT, target_server TEXT, target_db TEXT, status TEXT NOT NULL, '
+               'backup_size INTEGER, compressed_backup_size INTEGER, duration REAL NOT NULL, throughput REAL, '
+               'phases TEXT NOT NULL)')
+    db.close()
+
+    history = RestoreHistory(path)
+    history.add(make_run(60, 20).copy(update={'backup_share': 'd:'}))
+    assert history.recent('sql-test-01', 'd:')[0].backup_share == 'd:'
@@ -0,0 +1,96 @@
+import threading
+
+from services.metrics import PhaseTimer
+from services.post_restore import (
+    LOG_FILES_QUERY,
+    PostRestoreOptions,
+    get_shrink_log_script,
+    rebuild_indexes,
+    run_post_restore
+)
+from tests.conftest import FakeCursor, FakeQueue
+
+
+class IndexCursor(FakeCursor):
+    """Фрагментированные индексы и файлы журнала; перестроение индекса идет 100 страниц в секунду по clock."""
+
+    def __init__(self, indexes, log_names, clock=None):
+        super().__init__(self._get_rows)
+        self.indexes = indexes
+        self.log_names = log_names
+        self.clock = clock
+
+    def _get_rows(self, query, params):
+        if query.startswith('ALTER INDEX') and self.clock:
+            index_name = query.split('[')[1].split(']')[0]
+            self.clock[0] += next(index[4] for index in self.indexes if index[2] == index_name) / 100
+        if query == LOG_FILES_QUERY:
+            return [(name,) for name in self.log_names]
+        if 'dm_db_index_physical_stats' in query:
+            assert params == ('test', 30, 1000)
+            return self.indexes
+        return []
+
+
+def test_shrink_log_script():
+    assert get_shrink_log_script('test', ["test_log", "o'log"], 512) == (
+        "EXEC [test].sys.sp_executesql N'CHECKPOINT; DBCC SHRINKFILE (N''test_log'', 512) WITH NO_INFOMSGS; "
+        "DBCC SHRINKFILE (N''o''''log'', 512) WITH NO_INFOMSGS;'"
+    )
+
+
+def test_post_restore_steps_and_index_budget():
+    indexes = [('dbo', '_Reference1', '_Reference1_ByCode', 90.0, 50000),
+               ('dbo', '_Document2', '_Document2_ByDate', 60.0, 20000),
+               ('dbo', '_InfoRg3', '_InfoRg3_ByDims', 40.0, 10000)]
+    now = [0.0]
+    cursor = IndexCursor(indexes, ['test_log'], clock=now)
+    timer, queue = PhaseTimer(), FakeQueue()
+    options = PostRestoreOptions(rebuild_indexes=True, index_budget=650, update_statistics=True, log_size_mb=256)
+
+    run_post_restore(cursor, 'test', options, timer, queue, clock=lambda: now[0])
+
+    assert cursor.queries[0] == 'ALTER DATABASE [test] SET RECOVERY SIMPLE WITH NO_WAIT'
+    rebuilt = [query for query in cursor.queries if query.startswith('ALTER INDEX')]
+    # первый занял 500 с из 650, второй по этой скорости займет 200 с и пропускается, третий успевает
+    assert rebuilt == [
+        'ALTER INDEX [_Reference1_ByCode] ON [test].[dbo].[_Reference1] REBUILD WITH (SORT_IN_TEMPDB = ON)',
+        'ALTER INDEX [_InfoRg3_ByDims] ON [test].[dbo].[_InfoRg3] REBUILD WITH (SORT_IN_TEMPDB = ON)',
+    ]
+    assert 'Время на перестроение индексов истекло, осталось индексов: 1' in queue.messages
+    assert 'EXEC [test].sys.sp_updatestats' in cursor.queries[-3]
+    assert cursor.queries[-1].startswith("EXEC [test].sys.sp_executesql N'CHECKPOINT; DBCC SHRINKFILE")
+    assert set(timer.phases) == {'post_recovery', 'post_indexes', 'post_statistics', 'post_shrink'}
+
+
+def test_post_restore_defaults():
+    cursor = IndexCursor([], ['test_log'])
+    run_post_restore(cursor, 'test', PostRestoreOptions(), PhaseTimer(), FakeQueue())
+    assert not any('INDEX' in query for query in cursor.queries)
+    assert cursor.queries[1] == 'ALTER DATABASE [test] SET AUTO_UPDATE_STATISTICS_ASYNC ON WITH NO_WAIT'
+
+
+class BlockingCursor(IndexCursor):
+    """ALTER INDEX выполняется, пока запрос не отменят."""
+
+    def __init__(self, indexes):
+        super().__init__(indexes, [])
+        self.cancelled = threading.Event()
+
+    def execute(self, query, *params):
+        super().execute(query, *params)
+        if query.startswith('ALTER INDEX'):
+            assert self.cancelled.wait(5)
+            raise RuntimeError('Operation canceled')
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def test_rebuild_is_cancelled_at_budget():
+    cursor, queue = BlockingCursor([('dbo', '_Reference1', '_Reference1_ByCode', 90.0, 50000)]), FakeQueue()
+    options = PostRestoreOptions(rebuild_indexes=True, index_budget=0.05)
+    assert rebuild_indexes(cursor, 'test', options, queue) == 0
+    assert cursor.cancelled.is_set()
+    assert queue.messages == ['Перестроение индекса _Reference1_ByCode отменено по истечении времени',
+                              'Время на перестроение индексов истекло, осталось индексов: 1']
@@ -0,0 +1,24 @@
+from services.progress import MB, ProgressEvent, RestoreProgress
+
+
+def test_restore_progress():
+    now = [0]
+    progress = RestoreProgress(clock=lambda: now[0])
+    progress.start_phase('full', 1000 * MB)
+
+    now[0] = 10
+    event = progress.parse('10 percent processed.')
+    assert isinstance(event, ProgressEvent)
+    assert (event.phase, event.percent, event.mb_per_sec, event.eta) == ('full', 10, 10, 90)
+
+    assert progress.parse("Processed 1000 pages for database 'test', file 'test' on file 1.").pages == 1000
+    event = progress.parse('RESTORE DATABASE successfully processed 12800 pages in 99.500 seconds (1.005 MB/sec).')
+    assert (event.type, event.phase, event.pages, event.mb_per_sec) == ('phase_done', 'full', 12800, 1.005)
+
+    now[0] = 10
+    progress.start_phase('diff', 100 * MB)
+    now[0] = 15
+    event = progress.parse('50 percent processed.')
+    assert (event.phase, event.mb_per_sec) == ('diff', 10)
+
+    assert progress.parse('Changed database context to master.') == 'Changed database context to master.'
@@ -1,6 +1,16 @@
+import inspect
+import os
+import sys
+import time
 from unittest.mock import MagicMock
 
-from services.rac_tools import Cluster1C, RacClient
+import pytest
+
+from benchmarks import fake_rac
+from services.rac_tools import (
+    AsyncCluster1C, AsyncRacClient, Cluster1C, InfoBase, RacCache, RacClient, async_get_infobase, get_async_cluster,
+    get_infobase, iter_records
+)
 
 
 def test_get_infobases():
@@ -10,3 +20,197 @@ def test_get_infobases():
     assert cluster._get_cluster_id() == 1
     cluster._get_infobases = MagicMock(return_value=1)
     assert cluster._get_infobases() == 1
+
+
+def make_rac_client():
+    rac_client = MagicMock()
+    responses = {
+        'cluster list': [{'cluster': 'c1'}],
+        'infobase summary list': [{'name': 'Test_Base', 'infobase': 'ib1'}],
+        'infobase info': [{'infobase': 'ib1', 'name': 'test_base', 'db-server': 'sql-01', 'db-name': 'test_base'}],
+    }
+
+    def get(command, server_name, ras_port):
+        return next(value for key, value in responses.items() if command.startswith(key))
+
+    rac_client.get.side_effect = get
+    return rac_client
+
+
+def test_get_infobase_uses_cache():
+    rac_client = make_rac_client()
+    cache = RacCache(ttl=60)
+    con_str = 'Srvr="pg-test-01";Ref="test_base";'
+
+    get_infobase(rac_client, con_str, 'user', 'pwd', cache=cache)
+    assert rac_client.get.call_count == 3
+
+    infobase = get_infobase(rac_client, con_str, 'user', 'pwd', cache=cache)
+    assert rac_client.get.call_count == 4
+    assert infobase.db_server == 'sql-01'
+
+
+def test_cache_expires_and_invalidates():
+    now = [0]
+    cache = RacCache(ttl=10, clock=lambda: now[0])
+    cache.set_cluster_id('PG-TEST-01', 1545, 'c1')
+    assert cache.get_cluster_id('pg-test-01', 1545) == 'c1'
+
+    now[0] = 11
+    assert cache.get_cluster_id('pg-test-01', 1545) is None
+
+    cache.set_infobases('pg-test-01', 1545, {'test_base': 'ib1'})
+    cache.invalidate('pg-test-01')
+    assert cache.get_infobases('pg-test-01', 1545) is None
+
+
+def test_cache_miss_refreshes_infobases():
+    rac_client = make_rac_client()
+    cache = RacCache(ttl=60)
+    cache.set_cluster_id('pg-test-01', 1545, 'c1')
+    cache.set_infobases('pg-test-01', 1545, {'other_base': 'ib2'})
+
+    infobase = get_infobase(rac_client, 'Srvr="pg-test-01";Ref="test_base";', 'user', 'pwd', cache=cache)
+    assert infobase.id == 'ib1'
+    assert cache.get_infobases('pg-test-01', 1545) == {'test_base': 'ib1'}
+
+
+class SleepingRacClient(AsyncRacClient):
+    def _get_args(self, command, server_name, ras_port):
+        return [sys.executable, '-c', 'import time; time.sleep(30)']
+
+
+@pytest.mark.anyio
+async def test_async_rac_client_kills_on_timeout():
+    rac_client = SleepingRacClient(timeout=0.5)
+    started = time.monotonic()
+    with pytest.raises(ChildProcessError):
+        await rac_client.get('cluster list', 'pg-test-01', 1545)
+    assert time.monotonic() - started < 5
+
+
+@pytest.mark.anyio
+async def test_async_get_infobase_uses_cache():
+    rac_client = make_rac_client()
+    sync_get = rac_client.get.side_effect
+
+    async def get(command, server_name, ras_port):
+        return sync_get(command, server_name, ras_port)
+
+    rac_client.get.side_effect = get
+    cache = RacCache(ttl=60)
+    con_str = 'Srvr="pg-test-01";Ref="test_base";'
+
+    await async_get_infobase(rac_client, con_str, 'user', 'pwd', cache=cache)
+    infobase = await async_get_infobase(rac_client, con_str, 'user', 'pwd', cache=cache)
+    assert rac_client.get.call_count == 4
+    assert infobase.db_name == 'test_base'
+
+
+def test_iter_records():
+    output = [
+        'infobase : 3f2b2c10-0000-0000-0000-000000000001\r\n',
+        'name     : test_base\r\n',
+        'descr    : "Тестовая база"\r\n',
+        '\r\n',
+        'infobase : 3f2b2c10-0000-0000-0000-000000000002\r\n',
+        'name     : image\r\n',
+        'descr    :\r\n',
+        '\r\n',
+    ]
+    records = list(iter_records(output))
+    assert len(records) == 2
+    assert dict(records[0]) == {
+        'infobase': '3f2b2c10-0000-0000-0000-000000000001',
+        'name': 'test_base',
+        'descr': '"Тестовая база"',
+    }
+    assert records[1]['name'] == 'image'
+    assert records[1]['descr'] == ''
+    assert RacClient._process_output(output[:3]) == [records[0]]
+
+
+class ScriptRacClient(RacClient):
+    script = 'for i in range(100000): print(f"infobase : {i}\\nname : base_{i}\\n")'
+
+    def _get_command(self, command, server_name, ras_port):
+        return [sys.executable, '-c', self.script]
+
+
+def test_rac_client_find_stops_early():
+    record = ScriptRacClient().find('infobase summary list', 'pg-test-01', 1545,
+                                    lambda ib: ib['name'] == 'base_10')
+    assert record['infobase'] == '10'
+
+
+def test_rac_client_reads_large_stderr_and_exit_code():
+    # stderr больше буфера канала: при чтении stdout до конца rac не должен зависнуть
+    client = ScriptRacClient()
+    client.script = 'import sys; print("infobase : 1"); sys.stderr.write("x" * 200000)'
+    with pytest.raises(ChildProcessError, match='x' * 100):
+        client.get('infobase summary list', 'pg-test-01', 1545)
+
+    client.script = 'import sys; print("infobase : 1"); sys.exit(3)'
+    with pytest.raises(ChildProcessError, match='код возврата rac 3'):
+        client.get('infobase summary list', 'pg-test-01', 1545)
+
+
+@pytest.mark.anyio
+async def test_terminate_sessions_and_restore_deny():
+    calls = []
+
+    async def get(command, server_name, ras_port):
+        calls.append(command)
+        if command.startswith('session list'):
+            return [{'session': 's1', 'infobase': 'ib1', 'user-name': 'ivanov', 'app-id': '1CV8C'},
+                    {'session': 's2', 'infobase': 'ib1', 'user-name': 'petrov', 'app-id': 'BackgroundJob'}]
+        if command.startswith('session terminate') and '--session=s2' in command:
+            raise ChildProcessError('Error сеанс не найден')
+        return []
+
+    rac_client = MagicMock()
+    rac_client.get.side_effect = get
+    cache = RacCache(ttl=60)
+    cache.set_cluster_id('pg-test-01', 1545, 'c1')
+    cluster = get_async_cluster(rac_client, 'Srvr="pg-test-01";Ref="test_base";', cache=cache)
+    infobase = InfoBase.parse_obj({'infobase': 'ib1', 'name': 'test_base', 'db-server': 'sql-01',
+                                   'db-name': 'test_base', 'sessions-deny': 'off', 'scheduled-jobs-deny': 'on'})
+
+    await cluster.set_sessions_deny(infobase, 'user', 'pwd', True, 'База перезаливается')
+    sessions = await cluster.get_sessions(infobase.id)
+    assert [session.user_name for session in sessions] == ['ivanov', 'petrov']
+    # второй сеанс завершился сам, пока завершался первый
+    assert await cluster.terminate_sessions(sessions) == 1
+    await cluster.restore_sessions_deny(infobase, 'user', 'pwd')
+
+    assert calls[0].startswith('infobase update --infobase=ib1')
+    assert '--sessions-deny=on --scheduled-jobs-deny=on --denied-message="База перезаливается"' in calls[0]
+    assert calls[1] == 'session list --cluster=c1 --infobase=ib1'
+    assert sorted(calls[2:4]) == ['session terminate --cluster=c1 --session=s1',
+                                  'session terminate --cluster=c1 --session=s2']
+    # регламентные задания были запрещены и до восстановления
+    assert '--sessions-deny=off --scheduled-jobs-deny=on' in calls[4]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('newline', ['crlf', 'lf'])
+@pytest.mark.skipif(os.name == 'nt', reason='поддельный rac запускается только на Linux')
+async def test_async_rac_client_line_endings(newline, tmp_path, monkeypatch):
+    # rac на Windows выводит \r\n, на Linux - \n
+    monkeypatch.setenv('FAKE_RAC_NEWLINE', newline)
+    monkeypatch.setenv('FAKE_RAC_INFOBASES', '3')
+    monkeypatch.setenv('FAKE_RAC_LATENCY', '0')
+    rac_client = AsyncRacClient(exe_path=fake_rac.install(tmp_path))
+    cluster, = await rac_client.get('cluster list', 'pg-test-01', 1545)
+    infobases = await rac_client.get(f'infobase summary list --cluster={cluster["cluster"]}', 'pg-test-01', 1545)
+    assert [infobase['name'] for infobase in infobases] == ['test_base_0', 'test_base_1', 'test_base_2']
+
+
+def test_sync_and_async_clusters_share_only_base():
+    # синхронные методы с обращениями к rac не наследуются асинхронным кластером
+    assert not issubclass(AsyncCluster1C, Cluster1C)
+    for name, member in vars(Cluster1C).items():
+        if callable(member) and hasattr(AsyncCluster1C, name):
+            assert inspect.iscoroutinefunction(getattr(AsyncCluster1C, name)), name
+    with pytest.raises(RuntimeError):
+        AsyncCluster1C('pg-test-01', AsyncRacClient())._session_list_method()
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from services.restore_plan import PlanJobResult, RestorePlan, get_summary, load_plan
+
+IMAGE = 'Srvr="pg-1c-01";Ref="image";'
+
+
+def test_load_plan_json_and_toml(tmp_path):
+    path = tmp_path / 'plan.json'
+    path.write_text(json.dumps({
+        'max_workers': 2,
+        'options': {'logs': True},
+        'jobs': [{'source': IMAGE, 'target': 'Srvr="pg-test-01";Ref="test_1";'}],
+    }), encoding='utf-8')
+    plan = load_plan(str(path))
+    assert plan.max_workers == 2
+    assert plan.options.logs is True
+    assert plan.options.mode is None
+    assert plan.jobs[0].targets == ['Srvr="pg-test-01";Ref="test_1";']
+
+    path = tmp_path / 'plan.toml'
+    path.write_text(
+        'max_per_server = 1\n'
+        '[[jobs]]\n'
+        "source = 'Srvr=\"pg-1c-01\";Ref=\"image\";'\n"
+        "targets = ['Srvr=\"pg-test-01\";Ref=\"test_1\";', 'Srvr=\"pg-test-02\";Ref=\"test_2\";']\n"
+        "backup_date = '2023-03-01T07:00:00'\n",
+        encoding='utf-8'
+    )
+    pytest.importorskip('tomllib')
+    plan = load_plan(str(path))
+    assert plan.max_per_server == 1
+    assert len(plan.jobs[0].targets) == 2
+
+
+def test_job_without_targets():
+    with pytest.raises(ValueError):
+        RestorePlan.parse_obj({'jobs': [{'source': IMAGE}]})
+
+
+def test_sources_are_shared():
+    plan = RestorePlan.parse_obj({'backup_date': '2023-03-01', 'jobs': [
+        {'source': IMAGE, 'target': 'test_1'},
+        {'source': IMAGE, 'targets': ['test_2', 'test_1']},
+        {'source': IMAGE, 'target': 'test_3', 'backup_date': '2023-02-01'},
+        {'source': 'other', 'target': 'test_4'},
+    ]})
+    assert plan.get_sources('2023-03-10') == {
+        (IMAGE, '2023-03-01'): ['test_1', 'test_2'],
+        (IMAGE, '2023-02-01'): ['test_3'],
+        ('other', '2023-03-01'): ['test_4'],
+    }
+
+
+def test_options_are_validated():
+    plan = RestorePlan.parse_obj({'options': {'mode': 'standby'}, 'jobs': [{'source': IMAGE, 'target': 'test_1'}]})
+    assert plan.options.mode == 'standby'
+    for options in ({'mode': 'bogus'}, {'snapshots': True}):
+        with pytest.raises(ValueError):
+            RestorePlan.parse_obj({'options': options, 'jobs': [{'source': IMAGE, 'target': 'test_1'}]})
+
+
+def test_duplicate_targets_are_rejected():
+    with pytest.raises(ValueError):
+        RestorePlan.parse_obj({'jobs': [
+            {'source': IMAGE, 'target': 'test_1'},
+            {'source': 'other', 'targets': ['test_2', 'TEST_1']},
+        ]})
+    with pytest.raises(ValueError):
+        RestorePlan.parse_obj({'backup_date': '2023-03-01', 'jobs': [
+            {'source': IMAGE, 'target': 'test_1'},
+            {'source': IMAGE, 'target': 'test_1', 'backup_date': '2023-02-01'},
+        ]})
+
+
+def test_summary():
+    results = [
+        PlanJobResult(source=IMAGE, target='test_1', backup_date='2023-03-01', status='done', exit_code=0,
+                      duration=10),
+        PlanJobResult(source=IMAGE, target='test_2', backup_date='2023-03-01', status='error', exit_code=1,
+                      error='Сервер не найден или недоступен. Операция прервана!'),
+        PlanJobResult(source=IMAGE, target='test_3', backup_date='2023-03-01', status='current', exit_code=0),
+    ]
+    summary = get_summary(results, 12.3456)
+    assert summary['exit_code'] == 1
+    assert summary['duration'] == 12.346
+    assert summary['statuses'] == {'done': 1, 'error': 1, 'current': 1}
+    assert [job['target'] for job in summary['jobs']] == ['test_1', 'test_2', 'test_3']
+    assert get_summary(results[:1], 1)['exit_code'] == 0
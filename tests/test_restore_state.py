@@ -0,0 +1,70 @@
+import datetime
+from decimal import Decimal
+
+from services.backup_catalog import BackupSet
+from services.restore_state import can_roll_forward, get_last_restored, get_roll_forward, is_current
+from tests.conftest import FakeConnection
+
+
+def make_backup_set(backup_type='I', last_lsn=200, checkpoint_lsn=150):
+    return BackupSet(server='sql-prod-01', backup_set_id=10, database_name='image', type=backup_type,
+                     backup_finish_date=datetime.datetime(2023, 3, 1, 12), first_lsn=100, last_lsn=last_lsn,
+                     checkpoint_lsn=checkpoint_lsn)
+
+
+def restored_row(status='ONLINE', last_lsn=Decimal(200), recovery=True, backup_type='I', stop_at=None):
+    return ('IMAGE', backup_type, Decimal(100), last_lsn, Decimal(150), datetime.datetime(2023, 3, 1, 12),
+            datetime.datetime(2023, 3, 1, 13), stop_at, status, 0, recovery)
+
+
+def test_current_when_same_backup_set():
+    restored = get_last_restored(FakeConnection([restored_row()]), 'test_image')
+    assert restored.last_lsn == 200
+    assert is_current(restored, make_backup_set())
+
+
+def test_not_current():
+    assert not is_current(get_last_restored(FakeConnection(), 'test_image'), make_backup_set())
+    # вышел новый диф бекап
+    assert not is_current(get_last_restored(FakeConnection([restored_row()]), 'test_image'),
+                          make_backup_set(last_lsn=300, checkpoint_lsn=250))
+    # восстановление прервалось
+    assert not is_current(get_last_restored(FakeConnection([restored_row(status='RESTORING')]), 'test_image'),
+                          make_backup_set())
+    # тот же LSN, но полный бекап
+    assert not is_current(get_last_restored(FakeConnection([restored_row()]), 'test_image'), make_backup_set('D'))
+
+
+def test_current_needs_same_stop_at_in_log_backup():
+    log_backup = make_backup_set('L')
+    stop_at = datetime.datetime(2023, 3, 1, 11, 30)
+    restored = get_last_restored(FakeConnection([restored_row(backup_type='L', stop_at=stop_at)]), 'test_image')
+    assert is_current(restored, log_backup, stop_at)
+    # другой момент внутри того же бекапа журнала
+    assert not is_current(restored, log_backup, datetime.datetime(2023, 3, 1, 11, 45))
+    assert not is_current(restored, log_backup)
+
+    # бекап журнала применен целиком: STOPAT на его конец - то же самое
+    restored = get_last_restored(FakeConnection([restored_row(backup_type='L')]), 'test_image')
+    assert is_current(restored, log_backup, log_backup.backup_finish_date)
+    assert not is_current(restored, log_backup, stop_at)
+
+
+def test_roll_forward():
+    warm = get_last_restored(FakeConnection([restored_row(status='RESTORING', recovery=False)]), 'test_image')
+    assert can_roll_forward(warm, 'image')
+    assert not can_roll_forward(warm, 'other_image')
+    # прерванное полное восстановление поверх базы, восстановленной WITH RECOVERY
+    interrupted = get_last_restored(FakeConnection([restored_row(status='RESTORING')]), 'test_image')
+    assert not can_roll_forward(interrupted, 'image')
+    assert not can_roll_forward(get_last_restored(FakeConnection([restored_row()]), 'test_image'), 'image')
+    assert not can_roll_forward(None, 'image')
+
+    def log(first_lsn, last_lsn):
+        return make_backup_set('L', last_lsn=last_lsn).copy(update={'first_lsn': first_lsn})
+
+    assert get_roll_forward(warm, []) == []
+    logs = [log(180, 300), log(300, 400)]
+    assert get_roll_forward(warm, logs) == logs
+    # между LSN приемника и первым бекапом журнала разрыв
+    assert get_roll_forward(warm, [log(250, 300)]) is None
@@ -0,0 +1,34 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from services.restore_tuning import GB, MB, RestoreTuning, auto_tuning, get_restore_tuning
+
+
+def test_auto_tuning():
+    assert auto_tuning(500 * MB, 8, 16 * GB).get_options() == ''
+
+    tuning = auto_tuning(500 * GB, 16, 32 * GB)
+    assert (tuning.buffer_count, tuning.max_transfer_size) == (64, 4 * MB)
+
+    # буферы не должны занять больше 10% свободной памяти
+    tuning = auto_tuning(500 * GB, 16, 1 * GB)
+    assert tuning.buffer_count * tuning.max_transfer_size <= 0.1 * GB
+
+
+def test_explicit_values_override_auto():
+    conn = MagicMock()
+    conn.cursor.return_value.fetchone.return_value = (16, 32 * 1024 * 1024)
+    tuning = get_restore_tuning(conn, 'auto', backup_size=20 * GB, buffer_count=100)
+    assert tuning.get_options() == f'BUFFERCOUNT = 100, MAXTRANSFERSIZE = {4 * MB}, '
+    assert tuning.profile == 'auto'
+
+
+def test_invalid_max_transfer_size():
+    with pytest.raises(ValueError):
+        RestoreTuning(max_transfer_size=5 * MB)
+
+
+def test_auto_tuning_striped_backup():
+    tuning = auto_tuning(500 * GB, 2, 32 * GB, devices=4)
+    assert tuning.buffer_count == 32
@@ -0,0 +1,92 @@
+import asyncio
+
+import anyio
+import pytest
+
+from services.scheduler import Admission, RestoreScheduler, ServerQueue, get_share
+
+
+def test_get_share():
+    assert get_share('\\\\Backup-01\\SQL\\image\\full.bak') == '\\\\backup-01\\sql'
+    assert get_share('D:\\backup\\full.bak') == 'd:'
+
+
+@pytest.mark.anyio
+async def test_scheduler_limits_per_server():
+    scheduler = RestoreScheduler(max_per_server=1, max_per_share=3)
+    running = {'sql-01': 0, 'sql-02': 0}
+    peak = {'sql-01': 0, 'sql-02': 0}
+
+    async def restore(server):
+        async with scheduler.slot(server, '\\\\backup-01\\sql\\full.bak'):
+            running[server.lower()] += 1
+            peak[server.lower()] = max(peak[server.lower()], running[server.lower()])
+            await anyio.sleep(0.01)
+            running[server.lower()] -= 1
+
+    async with anyio.create_task_group() as tg:
+        for server in ['sql-01', 'SQL-01', 'sql-02', 'sql-02']:
+            tg.start_soon(restore, server)
+
+    assert peak == {'sql-01': 1, 'sql-02': 1}
+
+
+@pytest.mark.anyio
+async def test_server_queue_limits_bytes_in_order():
+    queue = ServerQueue(max_jobs=3, max_bytes=100)
+    big, small, late = Admission(80, 10), Admission(50, 5), Admission(10, 1)
+    waits = []
+    await queue.acquire(big)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(queue.acquire, small, waits.append)
+        await anyio.sleep(0.01)
+        # поместился бы, но не обгоняет ждущий впереди
+        tg.start_soon(queue.acquire, late)
+        await anyio.sleep(0.01)
+        assert queue.active == [big]
+        queue.release(big)
+
+    assert queue.active == [small, late]
+    assert waits == [pytest.approx(10, abs=1)]
+
+
+def test_server_queue_predict_start():
+    now = [0.0]
+    queue = ServerQueue(max_jobs=2, max_bytes=100, clock=lambda: now[0])
+    first, second = Admission(60, 100), Admission(30, 50)
+    queue._admit(first)
+    queue._admit(second)
+    now[0] = 10
+
+    # по числу место освобождает second через 40 с, а 70 поместятся только после first
+    assert queue.predict_start(size=10) == 40
+    assert queue.predict_start(size=70) == 90
+    # больше лимита - только на свободный сервер
+    assert queue.predict_start(size=500) == 90
+    queue._admit(Admission(5))
+    assert queue.predict_start(size=500) is None
+
+
+def test_oversized_backup_runs_on_free_server():
+    queue = ServerQueue(max_jobs=1, max_bytes=100)
+    assert queue.predict_start(size=500) == 0
+
+
+@pytest.mark.anyio
+async def test_cancelled_waiter_is_skipped_on_release():
+    queue = ServerQueue(max_jobs=1)
+    first, cancelled, next_one = Admission(), Admission(), Admission()
+    await queue.acquire(first)
+    waiting = asyncio.create_task(queue.acquire(cancelled))
+    admitted = asyncio.create_task(queue.acquire(next_one))
+    await asyncio.sleep(0)
+
+    # отмена и освобождение в одном шаге цикла: обработчик отмены ожидающего еще не выполнился
+    waiting.cancel()
+    queue.release(first)
+    await admitted
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert queue.active == [next_one]
+    assert not queue.waiting
@@ -0,0 +1,35 @@
+import pytest
+
+
+class ListQueue(list):
+    put_nowait = list.append
+
+
+@pytest.mark.anyio
+async def test_fan_out_isolates_unexpected_target_error(fake_sql_server, pipeline_settings, monkeypatch):
+    from services import service
+    from services.metrics import get_restore_history
+    from services.sql_tools import sql_pools
+
+    rac_client, settings = pipeline_settings
+    restore_target = service.async_restore_target
+
+    async def broken_restore_target(messages_queue, rac_client, source, target_path, settings, **kwargs):
+        if 'test_base_2' in target_path:
+            raise RuntimeError('каталог бекапов недоступен')
+        return await restore_target(messages_queue, rac_client, source, target_path, settings, **kwargs)
+
+    monkeypatch.setattr(service, 'async_restore_target', broken_restore_target)
+    queue = ListQueue()
+    targets = [f'Srvr="pg-test-01";Ref="test_base_{n}";' for n in range(1, 4)]
+    try:
+        results = await service.async_do_fan_out(queue, 'Srvr="pg-1c-01";Ref="test_base_0";', targets,
+                                                 fake_sql_server.now.isoformat(), settings, rac_client=rac_client)
+    finally:
+        sql_pools.close()
+
+    # ошибка не из RESTORE_ERRORS касается одного приемника, остальные восстановлены и все попали в историю
+    assert [result.status for result in results] == ['done', 'error', 'done']
+    assert 'каталог бекапов недоступен' in results[1].error
+    assert len(get_restore_history(settings.history_path).runs()) == 3
+    assert any(str(msg).startswith(f'{targets[1]}: error') for msg in queue)
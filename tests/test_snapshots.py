@@ -0,0 +1,42 @@
+import datetime
+
+import pytest
+
+from services.exceptions import SnapshotNotFound
+from services.snapshots import (
+    Snapshot,
+    get_create_snapshot_script,
+    get_drop_snapshots_script,
+    get_revert_script,
+    get_revert_snapshot,
+)
+from tests.conftest import FakeConnection
+
+
+def test_create_snapshot_script():
+    conn = FakeConnection([('test', r'F:\Data\test.mdf'), ('test_2', r'F:\Data\test_2.ndf')])
+    assert get_create_snapshot_script(conn, 'test') == (
+        "CREATE DATABASE [test_reset_snapshot] ON "
+        r"(NAME = N'test', FILENAME = N'F:\Data\test_reset_snapshot_test.ss'), "
+        r"(NAME = N'test_2', FILENAME = N'F:\Data\test_reset_snapshot_test_2.ss') "
+        "AS SNAPSHOT OF [test]"
+    )
+
+
+def test_revert_needs_exactly_one_snapshot():
+    created = datetime.datetime(2023, 3, 1, 12)
+    snapshot = ('test_reset_snapshot', 'test', created)
+    assert get_revert_snapshot(FakeConnection([snapshot]), 'test').name == 'test_reset_snapshot'
+    with pytest.raises(SnapshotNotFound):
+        get_revert_snapshot(FakeConnection([]), 'test')
+    with pytest.raises(SnapshotNotFound):
+        get_revert_snapshot(FakeConnection([snapshot, ('manual', 'test', created)]), 'test')
+
+
+def test_scripts():
+    snapshot = Snapshot(name='test_reset_snapshot', source_db='test', create_date=datetime.datetime(2023, 3, 1, 12))
+    assert snapshot.age(datetime.datetime(2023, 3, 1, 15)) == datetime.timedelta(hours=3)
+    assert get_drop_snapshots_script([snapshot]) == 'DROP DATABASE [test_reset_snapshot]'
+    script = get_revert_script('test', snapshot)
+    assert "RESTORE DATABASE [test] FROM DATABASE_SNAPSHOT = N'test_reset_snapshot'" in script
+    assert script.index('SINGLE_USER') < script.index('DATABASE_SNAPSHOT') < script.index('MULTI_USER')
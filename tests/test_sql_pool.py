@@ -0,0 +1,81 @@
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from services.exceptions import ConnectionPoolTimeout
+from services.sql_pool import ConnectionPool, ConnectionPools
+
+
+def test_pool_reuses_and_resets_connection():
+    pool = ConnectionPool(MagicMock, max_size=2)
+
+    with pool.connection() as conn:
+        conn.autocommit = True
+    with pool.connection() as same_conn:
+        assert same_conn is conn
+        assert same_conn.autocommit is False
+        same_conn.cursor.return_value.execute.assert_any_call('USE [master]')
+
+    stats = pool.stats()
+    assert (stats.hits, stats.misses, stats.size, stats.idle) == (1, 1, 1, 1)
+
+
+def test_pool_drops_broken_connection():
+    pool = ConnectionPool(MagicMock, max_size=2, discard_on=(OSError,))
+
+    with pytest.raises(OSError):
+        with pool.connection():
+            raise OSError
+    assert pool.stats().size == 0
+
+    with pool.connection() as conn:
+        conn.cursor.return_value.execute.side_effect = OSError
+    with pool.connection() as new_conn:
+        assert new_conn is not conn
+    assert pool.stats().broken == 2
+
+
+def test_pool_waits_for_free_connection():
+    pool = ConnectionPool(MagicMock, max_size=1, checkout_timeout=0.1)
+    conn = pool.acquire()
+    with pytest.raises(ConnectionPoolTimeout):
+        pool.acquire()
+
+    pool.checkout_timeout = 5
+    threading.Timer(0.1, pool.release, args=(conn,)).start()
+    assert pool.acquire() is conn
+    assert pool.stats().waits == 2
+
+
+def test_pools_evict_idle_connections():
+    now = [0]
+    pools = ConnectionPools(idle_timeout=10, min_size=1, clock=lambda: now[0])
+    pool = pools.get_pool(('sql-01', 1433), MagicMock)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+
+    now[0] = 11
+    assert pools.evict_idle() == 1
+    assert pools.stats()['sql-01/1433']['size'] == 1
+    first.close.assert_called_once()
+    pools.close()
+
+
+def test_pool_stats_are_consistent_under_threads():
+    pool = ConnectionPool(MagicMock, max_size=4)
+
+    def work():
+        for _ in range(200):
+            with pool.connection():
+                pass
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.stats()
+    assert stats.hits + stats.misses == 8 * 200
+    assert stats.misses == stats.size <= 4
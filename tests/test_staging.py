@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from services.staging import StagingCache, StagingError
+
+
+def make_backup(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_staging_copies_once(tmp_path):
+    backup = make_backup(tmp_path / 'full.bak', 10_000)
+    cache = StagingCache(str(tmp_path / 'staging'), budget=100_000, chunk_size=1024, workers=3)
+
+    staged, = cache.acquire([backup])
+    assert read(staged) == read(backup)
+    cache.release([staged])
+
+    # новый экземпляр подхватывает индекс с диска
+    cache = StagingCache(str(tmp_path / 'staging'), budget=100_000)
+    assert cache.acquire([backup]) == [staged]
+
+
+def test_staging_evicts_least_recently_used(tmp_path):
+    now = [0]
+    backups = [make_backup(tmp_path / f'{i}.bak', 4000) for i in range(3)]
+    cache = StagingCache(str(tmp_path / 'staging'), budget=10_000, chunk_size=1024, clock=lambda: now[0])
+
+    first, = cache.acquire(backups[:1])
+    cache.release([first])
+    now[0] = 1
+    second, = cache.acquire(backups[1:2])
+    now[0] = 2
+    cache.acquire(backups[2:])
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+
+    # оба файла в работе, вытеснять нечего
+    with pytest.raises(StagingError):
+        cache.acquire(backups[:1])
+
+
+def test_staging_recopies_damaged_copy(tmp_path):
+    backup = make_backup(tmp_path / 'full.bak', 10_000)
+    cache = StagingCache(str(tmp_path / 'staging'), budget=100_000, chunk_size=1024)
+    staged, = cache.acquire([backup])
+    cache.release([staged])
+
+    with open(staged, 'r+b') as f:
+        f.seek(5000)
+        f.write(bytes([read(backup)[5000] ^ 0xFF]))
+    assert cache.acquire([backup]) == [staged]
+    assert read(staged) == read(backup)
+
+
+class DamagingStagingCache(StagingCache):
+    """Запись куска на диск портит байт - как сбой диска или сети после чтения источника."""
+
+    def _copy_chunk(self, source, target, size, offset) -> int:
+        checksum = super()._copy_chunk(source, target, size, offset)
+        if offset == self.chunk_size:
+            with open(target, 'r+b') as f:
+                f.seek(offset)
+                f.write(b'\0')
+        return checksum
+
+
+def test_staging_verifies_copy_against_source(tmp_path):
+    backup = make_backup(tmp_path / 'full.bak', 10_000)
+    cache = DamagingStagingCache(str(tmp_path / 'staging'), budget=100_000, chunk_size=1024)
+    with pytest.raises(StagingError, match='Контрольная сумма'):
+        cache.acquire([backup])
+    assert not [name for name in os.listdir(tmp_path / 'staging') if name.endswith('.bak.part')]
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from anyio import to_thread
+
+from services.worker import WorkerCancelled, run_in_worker
+
+
+class ListQueue(list):
+    put_nowait = list.append
+
+
+def fake_restore(channel, steps, step_time):
+    # имитация RESTORE: блокирующее ожидание сервера и сообщения STATS
+    for percent in range(steps):
+        time.sleep(step_time)
+        channel.put_nowait(f'{percent} percent processed.')
+    return threading.current_thread().name
+
+
+async def measure_latency(stop: asyncio.Event, interval=0.005) -> float:
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        worst = max(worst, loop.time() - started - interval)
+    return worst
+
+
+@pytest.mark.anyio
+async def test_loop_stays_responsive_during_restore():
+    queue = ListQueue()
+    stop = asyncio.Event()
+    probe = asyncio.create_task(measure_latency(stop))
+
+    restores = [
+        run_in_worker(fake_restore, 20, 0.02, messages_queue=queue, name=f'restore {n}') for n in range(4)
+    ]
+    names = await asyncio.gather(*restores)
+    stop.set()
+
+    # каждое восстановление в своем потоке, цикл не ждал ни одного из них
+    assert sorted(names) == [f'restore {n}' for n in range(4)]
+    assert len(queue) == 80
+    assert await probe < 0.05
+
+
+@pytest.mark.anyio
+async def test_messages_arrive_in_order_before_result():
+    queue = ListQueue()
+    result = await run_in_worker(fake_restore, 5, 0, messages_queue=queue)
+    assert queue == [f'{percent} percent processed.' for percent in range(5)]
+    assert result
+
+
+@pytest.mark.anyio
+async def test_worker_exception_is_raised_in_loop():
+    def broken(channel):
+        channel.put_nowait('start')
+        raise FileNotFoundError('backup.bak')
+
+    queue = ListQueue()
+    with pytest.raises(FileNotFoundError):
+        await run_in_worker(broken, messages_queue=queue)
+    assert queue == ['start']
+
+
+@pytest.mark.anyio
+async def test_cancel_stops_worker():
+    cancelled = threading.Event()
+    finished = threading.Event()
+
+    def restore(channel):
+        # так на отмене прерывается cursor.execute
+        channel.on_cancel(cancelled.set)
+        try:
+            while True:
+                cancelled.wait(1)
+                channel.put_nowait('5 percent processed.')
+        except WorkerCancelled:
+            finished.set()
+            raise
+
+    task = asyncio.create_task(run_in_worker(restore))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert await to_thread.run_sync(finished.wait, 1)
+
+
+@pytest.mark.anyio
+async def test_loop_stays_responsive_during_restore_pipeline(fake_sql_server, pipeline_settings):
+    from services.scheduler import RestoreScheduler
+    from services.service import async_resolve_source, async_restore_target
+    from services.sql_tools import sql_pools
+
+    rac_client, settings = pipeline_settings
+    scheduler = RestoreScheduler(max_per_server=4, max_per_share=4)
+    backup_date = fake_sql_server.now.isoformat()
+    queue = ListQueue()
+    stop = asyncio.Event()
+    probe = asyncio.create_task(measure_latency(stop))
+    try:
+        # поиск бекапов: msdb, каталог и проверка файлов; затем connect, execute и nextset каждого RESTORE
+        source = await async_resolve_source(queue, rac_client, 'Srvr="pg-1c-01";Ref="test_base_0";', backup_date,
+                                            settings)
+        results = await asyncio.gather(*[
+            async_restore_target(queue, rac_client, source, f'Srvr="pg-test-01";Ref="test_base_{n}";', settings,
+                                 scheduler=scheduler)
+            for n in range(1, 5)
+        ])
+    finally:
+        stop.set()
+        sql_pools.close()
+
+    assert [result.status for result in results] == ['done'] * 4
+    assert fake_sql_server.messages >= 4 * 20
+    assert await probe < 0.05